@@ -12,8 +12,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import pbr.version
+import sys
 
 
-__version__ = pbr.version.VersionInfo(
-    'molteniron').version_string()
+def _version_string():
+    import pbr.version
+
+    return pbr.version.VersionInfo('molteniron').version_string()
+
+
+if sys.version_info >= (3, 7):
+    # Importing pbr is slow, so only do it when __version__ is asked for.
+    def __getattr__(name):
+        if name == '__version__':
+            return _version_string()
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+else:
+    __version__ = _version_string()
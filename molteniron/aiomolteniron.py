@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+
+"""
+This is the asyncio MoltenIron client class that speaks to a MoltenIron
+server.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import asyncio
+import json
+import os
+
+from molteniron.molteniron import Client, MoltenIronMethods
+from molteniron.molteniron import accept_encoding, decode_body
+from molteniron.molteniron import request_timeout
+
+
+class AsyncMoltenIron(MoltenIronMethods):
+    """This is the asyncio MoltenIron client object.
+
+    Requests are sent over a pool of at most max_connections keep-alive
+    connections, over the Unix socket socket_path when it is configured and
+    exists.  Every server method is a coroutine, for example:
+
+        client = AsyncMoltenIron(conf)
+        response = await client.allocate("hamzy", 1)
+        await client.close()
+    """
+
+    def __init__(self, conf, max_connections=10):
+        self.conf = conf
+        self.host = str(conf['serverIP'])
+        self.port = int(conf['mi_port'])
+        self.timeout = conf.get('timeout')
+        self.retry = int(conf.get('retry', 0))
+        self.socket_path = conf.get('socket_path')
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+
+    # Requests which the server turned away are retried as the synchronous
+    # client retries them
+    BUSY_STATUSES = Client.BUSY_STATUSES
+    RETRY_DELAY = Client.RETRY_DELAY
+    MAX_RETRY_DELAY = Client.MAX_RETRY_DELAY
+    backoff = Client.backoff
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def call(self, request):
+        """Send the request and return the response map"""
+        responses = await self.send([request])
+
+        return responses[0]
+
+    def pipeline(self):
+        """Return a Pipeline which sends several requests back to back"""
+        return Pipeline(self)
+
+    async def send(self, requests):
+        """Send the requests over one connection and return the responses
+
+        All of the requests are written before any response is read.  The
+        requests are retried up to retry times if the connection fails,
+        and those which the server was too busy to run are sent again
+        after a while, see backoff().  This is safe as every request
+        carries a request_id.
+        """
+        timeout = self.timeout
+        for request in requests:
+            this_timeout = request_timeout(request, self.timeout)
+            if this_timeout is not None and this_timeout > timeout:
+                timeout = this_timeout
+
+        responses = [None] * len(requests)
+        # The indexes of the requests still to be answered
+        pending = list(range(len(requests)))
+        fresh = False
+        attempt = 0
+        while True:
+            data = b"".join([self.encode(requests[index])
+                             for index in pending])
+            async with self.slots:
+                conn = await self.acquire(fresh=fresh)
+                try:
+                    replies = await asyncio.wait_for(
+                        self.exchange(conn, data, len(pending)),
+                        timeout)
+                except (OSError, EOFError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError):
+                    conn[1].close()
+                    if attempt == self.retry:
+                        raise
+                    fresh = True
+                    attempt += 1
+                    continue
+
+                (keep_alive, replies) = replies
+                if keep_alive:
+                    self.idle.append(conn)
+                else:
+                    conn[1].close()
+
+            fresh = False
+            busy = []
+            wait = 0
+            for (index, (status, retry_after, response)) in zip(pending,
+                                                                replies):
+                responses[index] = response
+                if status in self.BUSY_STATUSES:
+                    busy.append(index)
+                    wait = max(wait, self.backoff(attempt, retry_after))
+
+            if not busy or attempt == self.retry:
+                return responses
+
+            await asyncio.sleep(wait)
+            attempt += 1
+            pending = busy
+
+    async def acquire(self, fresh=False):
+        """Return an idle connection, opening a new one if need be"""
+        while self.idle and not fresh:
+            conn = self.idle.pop()
+            if not conn[0].at_eof():
+                return conn
+            conn[1].close()
+
+        if self.socket_path and os.path.exists(self.socket_path):
+            return await asyncio.open_unix_connection(self.socket_path)
+
+        return await asyncio.open_connection(self.host, self.port)
+
+    def encode(self, request):
+        """Return the HTTP request bytes for a request map"""
+        body = json.dumps(request).encode("utf-8")
+        head = ("POST / HTTP/1.1\r\n"
+                "Host: %s:%d\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: %d\r\n"
+                "Accept-Encoding: %s\r\n"
+                "\r\n") % (self.host,
+                           self.port,
+                           len(body),
+                           accept_encoding(), )
+
+        return head.encode("latin-1") + body
+
+    async def exchange(self, conn, data, count):
+        """Write data and read count responses from conn, returns
+        (keep_alive, [(status, Retry-After, response map), ...])"""
+        (reader, writer) = conn
+
+        writer.write(data)
+        await writer.drain()
+
+        responses = []
+        keep_alive = True
+        for _ in range(count):
+            (keep_alive, status, headers, body) = \
+                await self.read_response(reader)
+            responses.append((status,
+                              headers.get("retry-after"),
+                              json.loads(body.decode("utf-8"))))
+
+        return (keep_alive, responses)
+
+    async def read_response(self, reader):
+        """Read one HTTP response, returns (keep_alive, status, headers,
+        body), where the header names are lower case"""
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError("The server closed the connection")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, _, value) = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        keep_alive = keep_alive and not status_line.startswith(b"HTTP/1.0")
+
+        if "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        body = decode_body(body, headers.get("content-encoding"))
+
+        return (keep_alive, status, headers, body)
+
+    async def close(self):
+        """Close every idle connection"""
+        while self.idle:
+            (_, writer) = self.idle.pop()
+            writer.close()
+
+
+class Pipeline(MoltenIronMethods):
+    """Queues requests to send them back to back over one connection.
+
+        pipe = client.pipeline()
+        pipe.allocate("hamzy", 1)
+        pipe.allocate("mjturek", 1)
+        responses = await pipe.execute()
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+
+    def call(self, request):
+        """Queue the request"""
+        self.requests.append(request)
+
+    async def execute(self):
+        """Send the queued requests and return their responses in order"""
+        requests = self.requests
+        self.requests = []
+
+        if not requests:
+            return []
+
+        return await self.client.send(requests)
@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+
+"""
+This finds and loads the MoltenIron configuration file.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+# NOTE: This module is imported by every command line invocation, so it only
+# imports what it needs when it needs it.
+import json
+import os
+
+
+def conf_path(conf_dir=None):
+    """Return the path of conf.yaml, either in conf_dir or the package's"""
+    if conf_dir:
+        return os.path.realpath("%s/conf.yaml" % (conf_dir, ))
+
+    # The package is almost always installed as plain files, so avoid the
+    # cost of importing pkg_resources when it is.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "conf.yaml")
+    if os.path.isfile(path):
+        return path
+
+    from pkg_resources import resource_filename
+
+    return resource_filename("molteniron", "conf.yaml")
+
+
+def cache_path(path):
+    """Return the path of the parsed copy of the configuration file path"""
+    import hashlib
+
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+                               os.path.expanduser("~/.cache"))
+    name = hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+    return os.path.join(cache_dir, "molteniron", "conf-%s.json" % (name, ))
+
+
+def load_conf(path):
+    """Return the parsed configuration file path.
+
+    The parsed configuration is cached as JSON, which is much quicker to
+    load than YAML, until the configuration file changes.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = "%s:%d:%d" % (path, stat.st_mtime_ns, stat.st_size, )
+    cache = cache_path(path)
+
+    try:
+        with open(cache, "r") as fobj:
+            cached = json.load(fobj)
+        if cached["key"] == key:
+            return cached["conf"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml
+
+    with open(path, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    try:
+        data = json.dumps({"key": key, "conf": conf})
+        os.makedirs(os.path.dirname(cache), mode=0o700, exist_ok=True)
+        # The configuration holds passwords, so only the user may read it
+        temp = "%s.%d" % (cache, os.getpid(), )
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as fobj:
+            fobj.write(data)
+        os.replace(temp, cache)
+    except (OSError, TypeError, ValueError):
+        # Caching is only an optimization
+        pass
+
+    return conf
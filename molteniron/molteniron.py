@@ -23,12 +23,12 @@ This is the MoltenIron client class that speaks to a MoltenIron server.
 # pylint: disable=redefined-outer-name
 
 import argparse
+import collections
 import json
+import os
 import sys
-if sys.version_info >= (3, 0):
-    import http.client  # noqa
-else:
-    import httplib  # noqa
+import threading
+import time
 
 
 # Create a decorator pattern that maintains a registry
@@ -50,11 +50,596 @@ def makeRegistrar():
 command = makeRegistrar()
 
 
+def http_client():
+    """Return the HTTP client module.
+
+    It is only imported when a request is sent, as it is slow to import and
+    the command line client often exits before sending anything.
+    """
+    if sys.version_info >= (3, 0):
+        import http.client as client  # noqa
+    else:
+        import httplib as client  # noqa
+
+    return client
+
+
+def unix_http_connection(socket_path, timeout=None):
+    """Return an HTTPConnection which talks over the Unix socket_path"""
+    client = http_client()
+
+    class UnixHTTPConnection(client.HTTPConnection):
+        """HTTPConnection over a Unix domain socket"""
+
+        def connect(self):
+            """Connect to socket_path instead of host:port"""
+            import socket
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(socket_path)
+            except Exception:
+                sock.close()
+                raise
+            self.sock = sock
+
+    return UnixHTTPConnection("localhost", timeout=timeout)
+
+
+# The Accept-Encoding of every request, see accept_encoding()
+ACCEPT_ENCODING = None
+
+
+def accept_encoding():
+    """Return the Accept-Encoding of requests.
+
+    zstd is only accepted if the zstandard module, which is optional, is
+    installed to decode it.
+    """
+    global ACCEPT_ENCODING
+
+    if ACCEPT_ENCODING is None:
+        try:
+            import zstandard  # noqa
+            ACCEPT_ENCODING = "zstd, gzip"
+        except ImportError:
+            ACCEPT_ENCODING = "gzip"
+
+    return ACCEPT_ENCODING
+
+
+def decode_body(data, coding):
+    """Return the response body data, decompressed as its coding says"""
+    if not coding or coding.lower() == "identity":
+        return data
+
+    coding = coding.lower()
+    if coding == "gzip":
+        import zlib
+
+        # wbits of 16 and more expects a gzip header and trailer
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if coding == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    raise ValueError("Unknown Content-Encoding %s" % (coding, ))
+
+
+# The media type of each wire format.  JSON is the default, MessagePack is
+# more compact and quicker to encode and decode but needs the msgpack module.
+MEDIA_TYPES = {'json': "application/json",
+               'msgpack': "application/msgpack"}
+
+
+def encode_request(request, wire_format="json"):
+    """Return the body of request, encoded in wire_format"""
+    if wire_format == "msgpack":
+        import msgpack
+
+        return msgpack.packb(request, use_bin_type=True)
+
+    return json.dumps(request)
+
+
+def decode_response(data, content_type):
+    """Return the response map of a response body of content_type"""
+    media = (content_type or "").partition(";")[0].strip().lower()
+    if media in ("application/msgpack", "application/x-msgpack"):
+        import msgpack
+
+        # Time stamps are decoded as datetime objects in UTC
+        return msgpack.unpackb(data, raw=False, timestamp=3)
+
+    return json.loads(data.decode("utf-8"))
+
+
+# Arguments which only matter to the command line client
+CLI_ONLY_ARGS = ('func', 'conf_dir', 'output', 'follow')
+
+# Methods which only read the database.  They are sent as GET requests, so
+# their responses can be cached and revalidated.
+CACHED_METHODS = ('get_field',
+                  'get_fields',
+                  'pool_summary',
+                  'status',
+                  'status_baremetal')
+
+
+def request_path(request):
+    """Return the GET path of a request of one of the CACHED_METHODS"""
+    if sys.version_info >= (3, 0):
+        from urllib.parse import urlencode
+    else:
+        from urllib import urlencode
+
+    # The request_id only matters to methods which change the database
+    args = [(key, value) for (key, value) in sorted(request.items())
+            if key not in ('method', 'request_id') and value is not None]
+
+    return "/%s?%s" % (request['method'], urlencode(args, doseq=True), )
+
+
+def request_timeout(request, timeout):
+    """Return how long to wait for the response to request.
+
+    A request which waits on the server, such as watch, carries its own
+    timeout, which is added to timeout.
+    """
+    if timeout is None or request.get('timeout') is None:
+        return timeout
+
+    return timeout + float(request['timeout'])
+
+
+# The longest request_id which the server accepts
+REQUEST_ID_LENGTH = 64
+
+
+def make_request(method, args):
+    """Return the request which calls method on the server with args.
+
+    args is not modified.  The request is tagged with a request_id so the
+    server can recognize a retry of it.
+    """
+    request = {key: value for (key, value) in args.items()
+               if key not in CLI_ONLY_ARGS}
+    request['method'] = method
+
+    if request.get('request_id') is None:
+        request['request_id'] = os.urandom(16).hex()
+
+    return request
+
+
+class MoltenIronMethods(object):
+    """The methods of a MoltenIron server.
+
+    Each method builds its request and hands it to self.call(), which
+    subclasses implement to send it.  Every method returns whatever call()
+    returns, the response map for a synchronous client or a coroutine for
+    an asynchronous one.
+    """
+
+    def call(self, request):
+        """Send the request and return the response map"""
+        raise NotImplementedError()
+
+    def add_baremetal(self, name, ipmi_ip, ipmi_user, ipmi_password,
+                      allocation_pool, port_hwaddr, cpu_arch, cpus, ram_mb,
+                      disk_gb, node_pool="default", request_id=None):
+        """Add a node to the MoltenIron database"""
+        return self.call(make_request('add_baremetal',
+                                      {'name': name,
+                                       'ipmi_ip': ipmi_ip,
+                                       'ipmi_user': ipmi_user,
+                                       'ipmi_password': ipmi_password,
+                                       'allocation_pool': allocation_pool,
+                                       'port_hwaddr': port_hwaddr,
+                                       'cpu_arch': cpu_arch,
+                                       'cpus': int(cpus),
+                                       'ram_mb': int(ram_mb),
+                                       'disk_gb': int(disk_gb),
+                                       'node_pool': node_pool,
+                                       'request_id': request_id}))
+
+    def add_keyvalue_pairs(self, name, ipmi_ip, allocation_pool, args,
+                           node_pool="default", request_id=None):
+        """Add a node to the MoltenIron database
+
+           args is a list of key=value strings.
+        """
+        return self.call(make_request('add_keyvalue_pairs',
+                                      {'name': name,
+                                       'ipmi_ip': ipmi_ip,
+                                       'allocation_pool': allocation_pool,
+                                       'args': list(args),
+                                       'node_pool': node_pool,
+                                       'request_id': request_id}))
+
+    def add_json_blob(self, name, ipmi_ip, allocation_pool, blob,
+                      node_pool="default", request_id=None):
+        """Add a node to the MoltenIron database
+
+           blob is either a JSON encoded string or a map.
+        """
+        if isinstance(blob, dict):
+            blob = json.dumps(blob)
+
+        return self.call(make_request('add_json_blob',
+                                      {'name': name,
+                                       'ipmi_ip': ipmi_ip,
+                                       'allocation_pool': allocation_pool,
+                                       'blob': blob,
+                                       'node_pool': node_pool,
+                                       'request_id': request_id}))
+
+    def allocate(self, owner_name, number_of_nodes, node_pool="default",
+                 locality=None, max_nodes=None, priority=0, image=None,
+                 request_id=None):
+        """Checkout nodes from the MoltenIron database
+
+           If max_nodes is given, as many nodes as are ready, from
+           number_of_nodes up to max_nodes, are checked out and the
+           response's count says how many were.
+
+           If too few nodes are ready, allocations of a lower priority
+           are preempted to make up the difference.
+
+           If image is given, nodes which last had it deployed are
+           preferred, and the response's warm lists them.
+
+           If locality is given, all of the nodes share the same value of
+           that node column or blob field, or none are checked out.
+        """
+        return self.call(make_request('allocate',
+                                      {'owner_name': owner_name,
+                                       'number_of_nodes': int(number_of_nodes),
+                                       'node_pool': node_pool,
+                                       'locality': locality,
+                                       'max_nodes': max_nodes,
+                                       'priority': int(priority),
+                                       'image': image,
+                                       'request_id': request_id}))
+
+    def allocate_manifest(self, owner_name, number_of_nodes,
+                          node_pool="default", render=False,
+                          locality=None, max_nodes=None, priority=0,
+                          image=None, request_id=None):
+        """Checkout nodes and return everything needed to deploy them"""
+        return self.call(make_request('allocate_manifest',
+                                      {'owner_name': owner_name,
+                                       'number_of_nodes': int(number_of_nodes),
+                                       'node_pool': node_pool,
+                                       'render': bool(render),
+                                       'locality': locality,
+                                       'max_nodes': max_nodes,
+                                       'priority': int(priority),
+                                       'image': image,
+                                       'request_id': request_id}))
+
+    def release(self, owner_name, request_id=None):
+        """Release the nodes allocated to owner_name"""
+        return self.call(make_request('release',
+                                      {'owner_name': owner_name,
+                                       'request_id': request_id}))
+
+    def get_field(self, owner_name, field_name):
+        """Return a field of data from the nodes owned by owner_name"""
+        return self.call(make_request('get_field',
+                                      {'owner_name': owner_name,
+                                       'field_name': field_name}))
+
+    def get_fields(self, owner_names, field_names):
+        """Return several fields from the nodes of one or more owners"""
+        if not isinstance(owner_names, str):
+            owner_names = ",".join(owner_names)
+
+        return self.call(make_request('get_fields',
+                                      {'owner_names': owner_names,
+                                       'field_names': list(field_names)}))
+
+    def set_field(self, id, key, value, type="string", request_id=None):
+        """Set a field of data of the node with the given id"""
+        return self.call(make_request('set_field',
+                                      {'id': id,
+                                       'key': key,
+                                       'value': value,
+                                       'type': type,
+                                       'request_id': request_id}))
+
+    def status(self, type="human", columns=None, since=None):
+        """Return the nodes as a status, of every column or of columns
+
+        Given the version of an earlier status, only the nodes changed
+        since are returned.
+        """
+        return self.call(make_request('status',
+                                      {'type': type,
+                                       'columns': columns,
+                                       'since': since}))
+
+    def status_baremetal(self, type="human", columns=None, since=None):
+        """Return the nodes as a status, of every column or of columns
+
+        Given the version of an earlier status, only the nodes changed
+        since are returned.
+        """
+        return self.call(make_request('status_baremetal',
+                                      {'type': type,
+                                       'columns': columns,
+                                       'since': since}))
+
+    def pool_summary(self, node_pool=None):
+        """Return the number of nodes in each status of every pool"""
+        return self.call(make_request('pool_summary',
+                                      {'node_pool': node_pool}))
+
+    def watch(self, since=0, timeout=30):
+        """Wait up to timeout seconds for the node changes after seq since"""
+        return self.call(make_request('watch',
+                                      {'since': since,
+                                       'timeout': timeout}))
+
+    def delete_db(self):
+        """Delete all database entries"""
+        return self.call(make_request('delete_db', {}))
+
+
+class Client(MoltenIronMethods):
+    """This is the reusable MoltenIron client object.
+
+    One client may be shared by many threads.  Requests are sent over a
+    pool of at most max_connections keep-alive connections.  They go over
+    the Unix socket socket_path, when it is configured and exists, instead
+    of TCP.  The responses of the last cache_size read-only requests are
+    kept, and the server is only asked whether they are still current.
+    Requests and responses are JSON, or MessagePack if wire_format is
+    msgpack.  For example:
+
+        client = Client(conf)
+        response = client.allocate("hamzy", 1)
+    """
+
+    def __init__(self, conf, max_connections=10, cache_size=32,
+                 wire_format="json"):
+        if wire_format not in MEDIA_TYPES:
+            raise ValueError("Unknown wire format %s, expecting one of %s"
+                             % (wire_format, ",".join(sorted(MEDIA_TYPES)), ))
+
+        self.conf = conf
+        self.host = str(conf['serverIP'])
+        self.port = int(conf['mi_port'])
+        self.timeout = conf.get('timeout')
+        self.retry = int(conf.get('retry', 0))
+        self.socket_path = conf.get('socket_path')
+        self.idle = []
+        self.idle_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        # Maps a (wire format, GET path) to its (etag, content type,
+        # response), least recently used first
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        # Older servers only answer POST
+        self.use_get = True
+        self.wire_format = wire_format
+
+    # The server turns requests away with these when it is busy, before
+    # running them, so they are retried after a while
+    BUSY_STATUSES = (429, 503)
+    # The delay before the first retry of a request which was turned away,
+    # in seconds, which doubles for every retry up to MAX_RETRY_DELAY
+    RETRY_DELAY = 0.5
+    MAX_RETRY_DELAY = 30.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, request):
+        """Send the request and return the response map"""
+        (content_type, data) = self.fetch(request, self.wire_format)
+
+        return decode_response(data, content_type)
+
+    def send(self, request):
+        """Send the request and return the JSON response string"""
+        (_, data) = self.fetch(request, "json")
+
+        if sys.version_info > (3, 0):
+            # We actually receive bytes instead of a string!
+            data = data.decode("utf-8")
+
+        return data
+
+    def fetch(self, request, wire_format):
+        """Send the request in wire_format and return the (content type,
+        body bytes) of the response
+
+        The request is retried up to retry times if the connection fails.
+        This is safe as the request_id lets the server answer a retried
+        request with its original response.
+        """
+        timeout = request_timeout(request, self.timeout)
+
+        if self.use_get and request.get('method') in CACHED_METHODS:
+            result = self.send_cached(request, wire_format, timeout)
+            if result is not None:
+                return result
+
+        media = MEDIA_TYPES[wire_format]
+        (response, data) = self.exchange('POST',
+                                         '/',
+                                         encode_request(request, wire_format),
+                                         {'Content-Type': media,
+                                          'Accept': media},
+                                         timeout)
+
+        if response.status == 415 and wire_format != "json":
+            # The server cannot decode the wire format, which it rejects
+            # before running the request
+            self.wire_format = "json"
+            return self.fetch(request, "json")
+
+        return (response.getheader('Content-Type'), data)
+
+    def send_cached(self, request, wire_format, timeout):
+        """GET the response of a read-only request, using the cached
+        response if the server says it is still current.
+
+        Returns the (content type, body bytes) of the response, or None if
+        the server does not support GET.
+        """
+        key = (wire_format, request_path(request))
+
+        headers = {'Accept': MEDIA_TYPES[wire_format]}
+        with self.cache_lock:
+            cached = self.cache.pop(key, None)
+            if cached is not None:
+                # It is now the most recently used
+                self.cache[key] = cached
+                headers['If-None-Match'] = cached[0]
+
+        (response, data) = self.exchange('GET',
+                                         key[1],
+                                         None,
+                                         headers,
+                                         timeout)
+
+        if response.status == 501:
+            self.use_get = False
+            return None
+
+        if response.status == 304 and cached is not None:
+            return cached[1:]
+
+        content_type = response.getheader('Content-Type')
+        etag = response.getheader('ETag')
+        with self.cache_lock:
+            self.cache.pop(key, None)
+            if etag is not None and self.cache_size > 0:
+                self.cache[key] = (etag, content_type, data)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return (content_type, data)
+
+    def exchange(self, method, path, body, headers, timeout):
+        """Send one HTTP request and return the (response, body bytes)
+
+        The request is retried up to retry times if the connection fails,
+        or if the server is too busy to run it, see backoff().  An idle
+        connection which the server has closed is always replaced.  The
+        body is decompressed if the server compressed it.
+        """
+        client = http_client()
+        headers = dict(headers)
+        headers['Accept-Encoding'] = accept_encoding()
+
+        fresh = False
+        attempt = 0
+        while True:
+            with self.slots:
+                connection = self.acquire(fresh=fresh)
+                # The server may have closed a connection while it was idle
+                reused = connection.sock is not None
+                # An idle connection may have last waited for another time
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                response = None
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (OSError, client.HTTPException) as e:
+                    connection.close()
+                    fresh = True
+                    if (reused and response is None
+                            and isinstance(e, ConnectionError)):
+                        # The server closed it before answering, so the
+                        # request is sent again over a new connection,
+                        # which does not count as a retry
+                        continue
+                    if attempt == self.retry:
+                        raise
+                    attempt += 1
+                    continue
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    with self.idle_lock:
+                        self.idle.append(connection)
+
+            if (response.status in self.BUSY_STATUSES
+                    and attempt < self.retry):
+                time.sleep(self.backoff(attempt,
+                                        response.getheader('Retry-After')))
+                attempt += 1
+                continue
+
+            return (response,
+                    decode_body(data, response.getheader('Content-Encoding')))
+
+    def backoff(self, attempt, retry_after=None):
+        """Return how long to wait before retrying a request which the
+        server turned away attempt + 1 times.
+
+        The wait is at least the server's Retry-After, plus an exponential
+        backoff with full jitter, so the clients which were turned away
+        together do not all come back together.
+        """
+        import random
+
+        limit = min(self.MAX_RETRY_DELAY, self.RETRY_DELAY * 2 ** attempt)
+        delay = random.uniform(0, limit)
+        try:
+            delay += float(retry_after)
+        except (TypeError, ValueError):
+            # Missing, or an HTTP date which this server never sends
+            pass
+
+        return delay
+
+    def acquire(self, fresh=False):
+        """Return an idle connection, opening a new one if need be"""
+        if not fresh:
+            with self.idle_lock:
+                if self.idle:
+                    return self.idle.pop()
+
+        # A server on this host may also listen on a Unix socket, which
+        # is quicker than TCP
+        if self.socket_path and os.path.exists(self.socket_path):
+            return unix_http_connection(self.socket_path, self.timeout)
+
+        return http_client().HTTPConnection(self.host,
+                                            self.port,
+                                            timeout=self.timeout)
+
+    def close(self):
+        """Close every idle connection"""
+        with self.idle_lock:
+            while self.idle:
+                self.idle.pop().close()
+
+
 class MoltenIron(object):
-    """This is the MoltenIron client object."""
+    """This is the MoltenIron command line client object.
+
+    Its methods register the argparse sub-commands and turn the parsed
+    arguments into requests, which are sent by a Client.
+    """
 
     def __init__(self):
         self.conf = None
+        self.client = None
         self.parser = None
         self.request = None
         self.response_str = None
@@ -63,6 +648,7 @@ class MoltenIron(object):
     def setup_conf(self, _conf):
         """Sets the class variable to what is passed in."""
         self.conf = _conf
+        self.client = Client(_conf)
 
     def setup_parser(self, _parser):
         """Sets the class variable to what is passed in."""
@@ -70,17 +656,8 @@ class MoltenIron(object):
 
     def call_function(self, args):
         """Calls the function supplied on the server."""
-        if self.request is not None:
-            return False
-
-        # Save the previously defined function pointer
-        func = args['func']
-
-        # But delete the class function pointer. json can't serialize it!
-        del args['func']
-
         # Call the function specified on the command line!
-        self.request = func(args=args)
+        self.request = args['func'](args=args)
 
         # Send the request and print the response
         self.response_str = self.send(self.request)
@@ -90,22 +667,32 @@ class MoltenIron(object):
 
     def send(self, request):
         """Send the generated request"""
-        ip = str(self.conf['serverIP'])
-        port = int(self.conf['mi_port'])
-        if sys.version_info > (3, 0):
-            connection = http.client.HTTPConnection(ip, port)  # noqa
-        else:
-            connection = httplib.HTTPConnection(ip, port)  # noqa
-        connection.request('POST', '/', json.dumps(request))
+        return self.client.send(request)
 
-        response = connection.getresponse()
-        data = response.read()
+    def follow(self, args):
+        """Watch for changes forever, printing each one as a JSON line.
 
-        if sys.version_info > (3, 0):
-            # We actually receive bytes instead of a string!
-            data = data.decode("utf-8")
+        If the database was deleted, a {"reset": true} line comes before
+        every change of the new database.  Returns the status of the first
+        response which is not a success.
+        """
+        args = dict(args)
 
-        return data
+        while True:
+            self.call_function(args)
+            response = self.get_response_map()
+
+            if response.get('status') != 200:
+                print(self.get_response(), file=sys.stderr)
+                return response.get('status', 444)
+
+            if response.get('reset'):
+                print(json.dumps({'reset': True}))
+            for change in response['changes']:
+                print(json.dumps(change))
+            sys.stdout.flush()
+
+            args['since'] = response['seq']
 
     def get_response(self):
         """Returns the response from the server"""
@@ -169,9 +756,7 @@ class MoltenIron(object):
             sp.set_defaults(func=self.add_baremetal)
             return
 
-        args['method'] = 'add_baremetal'
-
-        return args
+        return make_request('add_baremetal', args)
 
     @command
     def add_keyvalue_pairs(self, args=None, subparsers=None):
@@ -202,9 +787,7 @@ class MoltenIron(object):
             sp.set_defaults(func=self.add_keyvalue_pairs)
             return
 
-        args['method'] = 'add_keyvalue_pairs'
-
-        return args
+        return make_request('add_keyvalue_pairs', args)
 
     @command
     def add_json_blob(self, args=None, subparsers=None):
@@ -234,9 +817,7 @@ class MoltenIron(object):
             sp.set_defaults(func=self.add_json_blob)
             return
 
-        args['method'] = 'add_json_blob'
-
-        return args
+        return make_request('add_json_blob', args)
 
     @command
     def allocate(self, args=None, subparsers=None):
@@ -245,6 +826,36 @@ class MoltenIron(object):
             sp = subparsers.add_parser("allocate",
                                        help="Checkout a node in MoltenIron."
                                             " Returns the node's info.")
+            sp.add_argument("-l",
+                            "--locality",
+                            type=str,
+                            default=None,
+                            dest="locality",
+                            help="Only checkout nodes which share the same"
+                                 " value of this node field, such as a"
+                                 " rack, or none at all")
+            sp.add_argument("-m",
+                            "--max-nodes",
+                            type=int,
+                            default=None,
+                            dest="max_nodes",
+                            help="Checkout up to this many nodes if they"
+                                 " are ready, and at least number_of_nodes")
+            sp.add_argument("-p",
+                            "--priority",
+                            type=int,
+                            default=0,
+                            dest="priority",
+                            help="The priority of the allocation.  If too"
+                                 " few nodes are ready, allocations of a"
+                                 " lower priority are preempted")
+            sp.add_argument("-i",
+                            "--image",
+                            type=str,
+                            default=None,
+                            dest="image",
+                            help="Prefer nodes which last had this image"
+                                 " deployed, and record it as theirs")
             sp.add_argument("owner_name",
                             help="Name of the requester")
             sp.add_argument("number_of_nodes",
@@ -258,9 +869,67 @@ class MoltenIron(object):
             sp.set_defaults(func=self.allocate)
             return
 
-        args['method'] = 'allocate'
+        return make_request('allocate', args)
+
+    @command
+    def allocate_manifest(self, args=None, subparsers=None):
+        """Checkout nodes and return everything needed to deploy them"""
+        if subparsers is not None:
+            sp = subparsers.add_parser("allocate_manifest",
+                                       help="Checkout a node in MoltenIron."
+                                            " Returns the node's info with"
+                                            " its blob expanded.")
+            sp.add_argument("-r",
+                            "--render",
+                            action="store_true",
+                            default=False,
+                            dest="render",
+                            help="Also return the rendered hardware_info"
+                                 " and localrc contents")
+            sp.add_argument("-l",
+                            "--locality",
+                            type=str,
+                            default=None,
+                            dest="locality",
+                            help="Only checkout nodes which share the same"
+                                 " value of this node field, such as a"
+                                 " rack, or none at all")
+            sp.add_argument("-m",
+                            "--max-nodes",
+                            type=int,
+                            default=None,
+                            dest="max_nodes",
+                            help="Checkout up to this many nodes if they"
+                                 " are ready, and at least number_of_nodes")
+            sp.add_argument("-p",
+                            "--priority",
+                            type=int,
+                            default=0,
+                            dest="priority",
+                            help="The priority of the allocation.  If too"
+                                 " few nodes are ready, allocations of a"
+                                 " lower priority are preempted")
+            sp.add_argument("-i",
+                            "--image",
+                            type=str,
+                            default=None,
+                            dest="image",
+                            help="Prefer nodes which last had this image"
+                                 " deployed, and record it as theirs")
+            sp.add_argument("owner_name",
+                            help="Name of the requester")
+            sp.add_argument("number_of_nodes",
+                            type=int,
+                            help="How many nodes to reserve")
+            sp.add_argument("node_pool",
+                            type=str,
+                            default="default",
+                            nargs='?',
+                            help="Node pool name")
+            sp.set_defaults(func=self.allocate_manifest)
+            return
 
-        return args
+        return make_request('allocate_manifest', args)
 
     @command
     def release(self, args=None, subparsers=None):
@@ -276,9 +945,7 @@ class MoltenIron(object):
             sp.set_defaults(func=self.release)
             return
 
-        args['method'] = 'release'
-
-        return args
+        return make_request('release', args)
 
     @command
     def get_field(self, args=None, subparsers=None):
@@ -297,9 +964,27 @@ class MoltenIron(object):
             sp.set_defaults(func=self.get_field)
             return
 
-        args['method'] = 'get_field'
+        return make_request('get_field', args)
+
+    @command
+    def get_fields(self, args=None, subparsers=None):
+        """Return several fields from the nodes of one or more owners."""
+        if subparsers is not None:
+            sp = subparsers.add_parser("get_fields",
+                                       help="Given owner names and the names"
+                                            " of fields, get a table of the"
+                                            " values of those fields.")
+            sp.add_argument("owner_names",
+                            help="Comma separated list of the owners who"
+                                 " currently own the nodes")
+            sp.add_argument("field_names",
+                            nargs='+',
+                            help="Names of the fields to retrieve"
+                                 " the values from")
+            sp.set_defaults(func=self.get_fields)
+            return
 
-        return args
+        return make_request('get_fields', args)
 
     @command
     def set_field(self, args=None, subparsers=None):
@@ -319,9 +1004,7 @@ class MoltenIron(object):
             sp.set_defaults(func=self.set_field)
             return
 
-        args['method'] = 'set_field'
-
-        return args
+        return make_request('set_field', args)
 
     @command
     def status(self, args=None, subparsers=None):
@@ -338,12 +1021,25 @@ class MoltenIron(object):
                             default="human",
                             dest="type",
                             help="Either human (the default) or csv")
+            sp.add_argument("--columns",
+                            action="store",
+                            type=str,
+                            default=None,
+                            dest="columns",
+                            help="Comma separated columns to show, instead"
+                                 " of every column")
+            sp.add_argument("-s",
+                            "--since",
+                            action="store",
+                            type=str,
+                            default=None,
+                            dest="since",
+                            help="Only show the nodes changed after this"
+                                 " version, from an earlier status")
             sp.set_defaults(func=self.status)
             return
 
-        args['method'] = 'status'
-
-        return args
+        return make_request('status', args)
 
     @command
     def status_baremetal(self, args=None, subparsers=None):
@@ -360,12 +1056,77 @@ class MoltenIron(object):
                             default="human",
                             dest="type",
                             help="Either human (the default) or csv")
+            sp.add_argument("--columns",
+                            action="store",
+                            type=str,
+                            default=None,
+                            dest="columns",
+                            help="Comma separated columns to show, instead"
+                                 " of every column")
+            sp.add_argument("-s",
+                            "--since",
+                            action="store",
+                            type=str,
+                            default=None,
+                            dest="since",
+                            help="Only show the nodes changed after this"
+                                 " version, from an earlier status")
             sp.set_defaults(func=self.status_baremetal)
             return
 
-        args['method'] = 'status_baremetal'
+        return make_request('status_baremetal', args)
+
+    @command
+    def pool_summary(self, args=None, subparsers=None):
+        """Return the number of nodes in each status of every pool"""
+        if subparsers is not None:
+            sp = subparsers.add_parser("pool_summary",
+                                       help="Return how many nodes each"
+                                            " node pool has in each status.")
+            sp.add_argument("node_pool",
+                            type=str,
+                            nargs='?',
+                            default=None,
+                            help="Only summarize this node pool")
+            sp.set_defaults(func=self.pool_summary)
+            return
+
+        return make_request('pool_summary', args)
 
-        return args
+    @command
+    def watch(self, args=None, subparsers=None):
+        """Wait for the node changes after a seq"""
+        if subparsers is not None:
+            sp = subparsers.add_parser("watch",
+                                       help="Wait for nodes to change and"
+                                            " return the changes.")
+            sp.add_argument("-s",
+                            "--since",
+                            action="store",
+                            type=str,
+                            default="0",
+                            dest="since",
+                            help="Return the changes after this seq, from"
+                                 " the previous response")
+            sp.add_argument("-t",
+                            "--timeout",
+                            action="store",
+                            type=float,
+                            default=30,
+                            dest="timeout",
+                            help="How long to wait, in seconds, for a"
+                                 " change")
+            sp.add_argument("-f",
+                            "--follow",
+                            action="store_true",
+                            default=False,
+                            dest="follow",
+                            help="Keep watching, printing each change as"
+                                 " a line of JSON")
+            sp.set_defaults(func=self.watch)
+            return
+
+        return make_request('watch', args)
 
     @command
     def delete_db(self, args=None, subparsers=None):
@@ -377,6 +1138,4 @@ class MoltenIron(object):
             sp.set_defaults(func=self.delete_db)
             return
 
-        args['method'] = 'delete_db'
-
-        return args
+        return make_request('delete_db', args)
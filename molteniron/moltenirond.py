@@ -29,38 +29,64 @@ This is the MoltenIron server.
 
 import argparse
 import calendar
-import collections
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timezone
+import importlib
 import json
+import multiprocessing
 import os
+import shlex
+import signal
+import socket
+import subprocess
 import sys
+import threading
 import time
 import traceback
+import zlib
 
-from pkg_resources import resource_filename
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.exc import InternalError, OperationalError
+from sqlalchemy import create_engine, func, inspect
+from sqlalchemy import Column, Index, Integer, String, ForeignKey
+from sqlalchemy.exc import IntegrityError, InternalError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import MetaData, Table
-from sqlalchemy.sql import insert, update, delete
-from sqlalchemy.sql import and_
-from sqlalchemy.types import TIMESTAMP
+from sqlalchemy.schema import CreateColumn, MetaData, Table
+from sqlalchemy.sql import insert, update, delete, select
+from sqlalchemy.sql import and_, literal
+from sqlalchemy.types import Text, TIMESTAMP
 import sqlalchemy_utils
-import yaml
+
+try:
+    import msgpack
+except ImportError:
+    # Requests and responses are only JSON then
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    # Responses are only compressed with gzip then
+    zstandard = None
+
+from molteniron import config
 
 if sys.version_info >= (3, 0):
     from http.server import HTTPServer, BaseHTTPRequestHandler  # noqa
+    from socketserver import TCPServer, ThreadingMixIn  # noqa
+    from urllib.parse import parse_qs, urlsplit  # noqa
 else:
     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # noqa
+    from SocketServer import TCPServer, ThreadingMixIn  # noqa
+    from urlparse import parse_qs, urlsplit  # noqa
 
 
 DEBUG = False
 
 metadata = MetaData()
 
+# Sessions are bound to their DataBase's engine when they are created
+Session = sessionmaker()
+
 
 class JSON_encoder_with_DateTime(json.JSONEncoder):
     """Special class to allow json to encode datetime objects"""
@@ -82,6 +108,78 @@ class OBaseHTTPRequestHandler(BaseHTTPRequestHandler, object):
     pass
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTPServer which handles each connection in its own thread"""
+    daemon_threads = True
+    # Connections are accepted quickly, and turned away by the handler when
+    # there are too many requests, so a burst of them should not be refused
+    # by the kernel
+    request_queue_size = 128
+    # Set to let several worker processes listen on the same port
+    allow_reuse_port = False
+
+    def server_bind(self):
+        """Bind the socket, sharing the port if allow_reuse_port is set"""
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer whose port is shared by every worker process.
+
+    The kernel spreads the incoming connections between the workers.
+    """
+    allow_reuse_port = True
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer which listens on a Unix domain socket
+
+    The socket file is created with the permissions socket_mode, so they
+    decide who may talk to the server.
+    """
+    address_family = socket.AF_UNIX
+
+    def __init__(self, socket_path, handler_class, socket_mode=0o660):
+        self.socket_mode = socket_mode
+        # TCP_NODELAY does not apply to Unix sockets
+        handler_class = type(handler_class.__name__,
+                             (handler_class, ),
+                             {'disable_nagle_algorithm': False})
+        super(UnixHTTPServer, self).__init__(socket_path, handler_class)
+
+    def server_bind(self):
+        """Bind the socket, replacing a stale socket file"""
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+        # Create the file without any permissions, then set the real ones,
+        # so no one can connect in between
+        umask = os.umask(0o777)
+        try:
+            TCPServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, self.socket_mode)
+
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        """Accept a connection, Unix sockets have no client address"""
+        (request, _) = self.socket.accept()
+        return (request, ("local", 0))
+
+    def server_close(self):
+        """Close the socket and remove its file"""
+        super(UnixHTTPServer, self).server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
 # We need to pass in conf into MoltenIronHandler, so make a class factory
 # to do that
 # NOTE: URL is over two lines :(
@@ -91,99 +189,700 @@ def MakeMoltenIronHandlerWithConf(conf):
     """Allows passing in conf to MoltenIronHandler,"""
     class MoltenIronHandler(OBaseHTTPRequestHandler):
         """HTTP handler class"""
+
+        # Keep connections open between requests, but not forever
+        protocol_version = "HTTP/1.1"
+        timeout = conf.get('keepAliveTimeout', 30)
+        # The headers and body are written separately, so do not let them
+        # wait on the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        # The requests being handled by this process, beyond which more are
+        # turned away
+        slots = threading.BoundedSemaphore(int(conf.get('maxRequests', 64)))
+        # How often each owner may make requests
+        owners = RateLimiter(float(conf.get('ownerRate', 0)),
+                             float(conf.get('ownerBurst', 10)))
+
         def __init__(self, *args, **kwargs):
             # Note this *needs* to be done before call to super's class!
             self.conf = conf
-            self.data_string = None
             super(OBaseHTTPRequestHandler, self).__init__(*args, **kwargs)
 
         def do_POST(self):
             """HTTP POST support"""
             CL = 'Content-Length'
             data = self.rfile.read(int(self.headers[CL]))
-            if sys.version_info >= (3, 0):
-                # We actually received bytes instead of a string!
-                data = data.decode("utf-8")
-            self.data_string = data
-            response = self.parse(self.data_string)
-            self.send_reply(response)
-
-        def send_reply(self, response):
+            content_type = media_type(self.headers.get('Content-Type'))
+            if content_type == MSGPACK and msgpack is None:
+                self.send_reply({'status': 415,
+                                 'message': "This server does not support"
+                                            " %s" % (MSGPACK, )})
+                return
+
+            try:
+                request = decode_request(data, content_type)
+            except Exception as e:
+                self.send_reply({'status': 400, 'message': str(e)})
+                return
+
+            self.serve_request(request)
+
+        def do_GET(self):
+            """HTTP GET support, for the read-only methods
+
+            GET /status?type=csv returns what the POSTed request
+            {"method": "status", "type": "csv"} does, tagged with the
+            version of the nodes.  If the request's If-None-Match already
+            has that tag, 304 Not Modified is sent without asking the
+            database.
+            """
+            url = urlsplit(self.path)
+            method = url.path.strip("/")
+            if method not in READ_ONLY_METHODS:
+                self.send_reply({'status': 404,
+                                 'message': "Unknown resource %s"
+                                            % (url.path, )})
+                return
+
+            # Read the tag first, so a change made while the request is
+            # handled makes the tag stale rather than the response
+            etag = VERSION.etag()
+            if etag in if_none_match(self.headers.get('If-None-Match')):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                return
+
+            request = query_request(url.query)
+            request['method'] = method
+            self.serve_request(request, etag)
+
+        def serve_request(self, request, etag=None):
+            """Handle the request and send its reply, unless the server is
+            too busy or the request's owner has made too many requests.
+
+            Requests which are turned away are answered with 503 or 429,
+            and Retry-After says how many seconds to wait before retrying.
+            The request has not run, so it is safe to retry.
+            """
+            owner = None
+            if isinstance(request, dict):
+                owner = (request.get('owner_name')
+                         or request.get('owner_names'))
+            if isinstance(owner, str):
+                wait = self.owners.admit(owner)
+                if wait > 0:
+                    self.send_reply({'status': 429,
+                                     'message': "%s made too many requests"
+                                                % (owner, )},
+                                    {'Retry-After': retry_after(wait)})
+                    return
+
+            # Watching mostly waits, so it does not count against the
+            # requests being handled
+            watching = (isinstance(request, dict)
+                        and request.get('method') == 'watch')
+            if not watching and not self.slots.acquire(False):
+                wait = float(self.conf.get('retryAfter', 1))
+                self.send_reply({'status': 503,
+                                 'message': "The server is busy"},
+                                {'Retry-After': retry_after(wait)})
+                return
+
+            try:
+                response_type = self.response_type()
+                (status_code, data) = self.respond(request,
+                                                   response_type,
+                                                   etag)
+                if status_code != 200:
+                    etag = None
+                self.send_data(status_code, data, response_type, etag)
+            finally:
+                if not watching:
+                    self.slots.release()
+
+        def response_type(self):
+            """Return the media type of the response, MessagePack if the
+            request's Accept asks for it and JSON otherwise"""
+            if msgpack is not None:
+                for item in (self.headers.get('Accept') or "").split(","):
+                    if media_type(item) == MSGPACK:
+                        return MSGPACK
+
+            return JSON
+
+        def respond(self, request, response_type=None, etag=None):
+            """Return the (status code, encoded response) of the request
+
+            Identical read-only requests which arrive together share one
+            call to the database, see SingleFlight.
+            """
+            if response_type is None:
+                response_type = JSON
+
+            if (not isinstance(request, dict)
+                    or request.get('method') not in READ_ONLY_METHODS):
+                return encode_response(self.handle_request(request),
+                                       response_type)
+
+            if etag is None:
+                etag = VERSION.etag()
+            # The request_id of a read-only request is ignored
+            args = dict(request)
+            args.pop('request_id', None)
+            key = (etag, response_type, json.dumps(args, sort_keys=True))
+
+            return READS.do(key,
+                            float(self.conf.get('coalesceTTL', 1)),
+                            lambda: encode_response(
+                                self.handle_request(request),
+                                response_type))
+
+        def send_reply(self, response, headers=None):
             """Sends the HTTP reply"""
             if DEBUG:
                 print("send_reply: response = %s" % (response,))
-            # get the status code off the response json and send it
-            status_code = response['status']
+            response_type = self.response_type()
+            (status_code, data) = encode_response(response, response_type)
+            self.send_data(status_code, data, response_type, None, headers)
+
+        def send_data(self, status_code, data, response_type=None,
+                      etag=None, headers=None):
+            """Sends the HTTP reply of an encoded response
+
+            Responses of at least compressMinSize bytes are compressed,
+            if the request's Accept-Encoding allows it.
+            """
+            if response_type is None:
+                response_type = JSON
+
+            coding = None
+            if len(data) >= int(self.conf.get('compressMinSize', 1024)):
+                codings = accepted_codings(
+                    self.headers.get('Accept-Encoding'))
+                (coding, data) = compress(data, codings)
+
             self.send_response(status_code)
-            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-type', response_type)
+            self.send_header('Content-Length', str(len(data)))
+            if coding is not None:
+                self.send_header('Content-Encoding', coding)
+            if etag is not None:
+                if coding is not None:
+                    # The same version has other bytes when not compressed
+                    etag = "W/" + etag
+                # Caches may keep the response, but must check it is
+                # still current before using it
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Vary', 'Accept, Accept-Encoding')
+            for (name, value) in sorted((headers or {}).items()):
+                self.send_header(name, value)
             self.end_headers()
-            data = json.dumps(response, cls=JSON_encoder_with_DateTime)
-            if sys.version_info >= (3, 0):
-                # We actually need to send bytes instead of a string!
-                data = data.encode()
             self.wfile.write(data)
 
-        def parse(self, request_string):
-            """Handle the request. Returns the response of the request """
+        def handle_request(self, request):
+            """Handle the request map. Returns the response of the request"""
             try:
                 database = DataBase(self.conf)
-                # Try to json-ify the request_string
-                request = json.loads(request_string)
-                method = request.pop('method')
-                if method == 'add_baremetal':
-                    node = {}
-                    node['ipmi_user'] = request.pop('ipmi_user')
-                    node['ipmi_password'] = request.pop('ipmi_password')
-                    node['port_hwaddr'] = request.pop('port_hwaddr')
-                    node['disk_gb'] = request.pop('disk_gb')
-                    node['cpu_arch'] = request.pop('cpu_arch')
-                    node['ram_mb'] = request.pop('ram_mb')
-                    node['cpus'] = request.pop('cpus')
-                    response = database.addBMNode(request, node)
-                elif method == 'add_keyvalue_pairs':
-                    node = {}
-
-                    for elm in request["args"]:
-                        idx = elm.find("=")
-                        if idx > -1:
-                            node[elm[:idx]] = elm[idx + 1:]
-                    response = database.addBMNode(request, node)
-                elif method == 'add_json_blob':
-                    node = json.loads(request.pop("blob"))
-                    response = database.addBMNode(request, node)
-                elif method == 'allocate':
-                    response = database.allocateBM(request['owner_name'],
-                                                   request['number_of_nodes'],
-                                                   request['node_pool'])
-                elif method == 'release':
-                    response = database.deallocateOwner(request['owner_name'])
-                elif method == 'get_field':
-                    response = database.get_field(request['owner_name'],
-                                                  request['field_name'])
-                elif method == 'set_field':
-                    response = database.set_field(request['id'],
-                                                  request['key'],
-                                                  request['value'],
-                                                  request['type'])
-                elif method == 'status':
-                    response = database.status(request["type"])
-                elif method == 'status_baremetal':
-                    response = database.status_baremetal(request["type"])
-                elif method == 'delete_db':
-                    response = database.delete_db()
+                response = dispatch(database, request)
                 database.close()
                 del database
             except Exception as e:
                 response = {'status': 400, 'message': str(e)}
 
             if DEBUG:
-                print("parse: response = %s" % (response,))
+                print("handle_request: response = %s" % (response,))
 
             return response
 
     return MoltenIronHandler
 
 
+# The media types of requests and responses.  MessagePack is only
+# understood if the msgpack module is installed.
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def media_type(header):
+    """Return the media type of a Content-Type or Accept header item"""
+    media = (header or "").partition(";")[0].strip().lower()
+    if media == "application/x-msgpack":
+        return MSGPACK
+
+    return media
+
+
+def decode_request(data, content_type):
+    """Return the request map of a request body of content_type"""
+    if content_type == MSGPACK:
+        return msgpack.unpackb(data, raw=False, timestamp=3)
+
+    if sys.version_info >= (3, 0):
+        # We actually received bytes instead of a string!
+        data = data.decode("utf-8")
+
+    return json.loads(data)
+
+
+def msgpack_default(obj):
+    """Pack the objects which MessagePack does not know how to"""
+    if isinstance(obj, datetime):
+        # Time stamps are stored in UTC
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        return msgpack.Timestamp.from_datetime(obj)
+
+    raise TypeError("Cannot pack %r" % (obj, ))
+
+
+def encode_response(response, response_type=JSON):
+    """Return the (HTTP status code, bytes) of a response map, encoded as
+    response_type"""
+    # get the status code off the response json and send it
+    status_code = response['status']
+    if response_type == MSGPACK:
+        return (status_code,
+                msgpack.packb(response,
+                              use_bin_type=True,
+                              default=msgpack_default))
+
+    data = json.dumps(response, cls=JSON_encoder_with_DateTime)
+    if sys.version_info >= (3, 0):
+        # We actually need to send bytes instead of a string!
+        data = data.encode()
+
+    return (status_code, data)
+
+
+def retry_after(wait):
+    """Return the Retry-After header of waiting wait seconds"""
+    # Retry-After is a whole number of seconds
+    return str(max(1, int(wait + 0.999)))
+
+
+class RateLimiter(object):
+    """Limits how often each key may be admitted, with a token bucket each.
+
+    A key may be admitted burst times at once, and rate times a second on
+    average after that.  A rate of 0 admits every request.
+    """
+
+    # Full buckets are forgotten once there are this many
+    MAX_BUCKETS = 1000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.lock = threading.Lock()
+        # Maps a key to its (tokens, time they were counted)
+        self.buckets = {}
+
+    def admit(self, key, now=None):
+        """Take a token of key's bucket.
+
+        Returns 0 if there was one, or how many seconds until there is.
+        """
+        if self.rate <= 0:
+            return 0
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            (tokens, then) = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - then) * self.rate)
+
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+
+            self.buckets[key] = (tokens - 1, now)
+
+            if len(self.buckets) > self.MAX_BUCKETS:
+                for (old_key, (old_tokens, old_then)) in list(
+                        self.buckets.items()):
+                    full = old_tokens + (now - old_then) * self.rate
+                    if full >= self.burst:
+                        del self.buckets[old_key]
+
+        return 0
+
+
+def accepted_codings(header):
+    """Return the content codings which an Accept-Encoding header allows"""
+    codings = set()
+    for item in (header or "").split(","):
+        (coding, _, params) = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        for param in params.split(";"):
+            (name, _, value) = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality <= 0:
+            continue
+
+        if coding == "*":
+            codings.update(["zstd", "gzip"])
+        else:
+            codings.add(coding)
+
+    return codings
+
+
+def compress(data, codings):
+    """Return the (content coding, data) of data compressed with the best
+    of codings, or (None, data) if none of them are supported."""
+    if zstandard is not None and "zstd" in codings:
+        compressor = zstandard.ZstdCompressor()
+        return ("zstd", compressor.compress(data))
+
+    if "gzip" in codings:
+        # wbits of 16 and more writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return ("gzip", compressor.compress(data) + compressor.flush())
+
+    return (None, data)
+
+
+class SingleFlight(object):
+    """Shares one call among the identical requests which arrive together.
+
+    The first caller of do() with a key runs the function, and callers
+    with the same key which arrive while it runs wait for and share its
+    result.  The result is also shared for ttl seconds after it finishes.
+    Keys of reads include the version of the nodes, so a shared result is
+    never older than the last change.
+    """
+
+    class Call(object):
+        """A call of the function, finished once event is set"""
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+            self.finished = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, ttl, function):
+        """Return function(), or the result of a call for the same key"""
+        now = time.time()
+        with self.lock:
+            # Forget the results which are too old to share
+            for (old_key, old_call) in list(self.calls.items()):
+                if (old_call.finished is not None
+                        and now - old_call.finished >= ttl):
+                    del self.calls[old_key]
+
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = SingleFlight.Call()
+                self.calls[key] = call
+
+        if leader:
+            try:
+                call.result = function()
+            except Exception as e:
+                call.error = e
+            finally:
+                call.finished = time.time()
+                if call.error is not None or ttl <= 0:
+                    with self.lock:
+                        if self.calls.get(key) is call:
+                            del self.calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+
+# The reads being handled, or recently handled, by this process
+READS = SingleFlight()
+
+
+def if_none_match(header):
+    """Return the entity tags listed by an If-None-Match header"""
+    if not header:
+        return []
+
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        # A weak tag matches the same as a strong tag here
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tags.append(tag)
+
+    return tags
+
+
+# Arguments of the read-only methods which are lists, even of one item
+LIST_ARGS = ('field_names', )
+
+
+def query_request(query):
+    """Return the request map of the arguments in a GET query string"""
+    request = {}
+    for (key, values) in parse_qs(query, keep_blank_values=True).items():
+        if key in LIST_ARGS or len(values) > 1:
+            request[key] = values
+        else:
+            request[key] = values[0]
+
+    return request
+
+
+class Version(object):
+    """The version of the nodes, which tags the read-only responses.
+
+    It counts the changes committed to the nodes.  The count is kept in
+    shared memory, which the worker processes inherit from the supervisor,
+    so every worker sees the changes of the others without asking the
+    database.  Tags also carry a nonce made when the server starts, so a
+    tag from before a restart never matches.
+    """
+
+    def __init__(self):
+        self.nonce = os.urandom(4).hex()
+        self.count = multiprocessing.Value('Q', 0)
+
+    def bump(self):
+        """Count a change to the nodes"""
+        with self.count.get_lock():
+            self.count.value += 1
+
+    def etag(self):
+        """Return the HTTP entity tag of the current version"""
+        return '"%s-%d"' % (self.nonce, self.count.value, )
+
+
+VERSION = Version()
+
+# Methods which only read the database, which may also be called with GET
+READ_ONLY_METHODS = ('get_field',
+                     'get_fields',
+                     'pool_summary',
+                     'status',
+                     'status_baremetal')
+
+# Methods which change the database and therefore honor a request_id.  A
+# replayed request_id returns the original response instead of running the
+# method again.
+IDEMPOTENT_METHODS = ('add_baremetal',
+                      'add_keyvalue_pairs',
+                      'add_json_blob',
+                      'allocate',
+                      'allocate_manifest',
+                      'release',
+                      'set_field')
+
+
+class PoolLocks(object):
+    """A lock for every node pool, made when the pool is first locked.
+
+    Allocations from one pool hold its lock, so they do not race each
+    other for the same nodes, while allocations from other pools go ahead.
+    """
+
+    def __init__(self):
+        self.guard = threading.Lock()
+        self.locks = {}
+
+    def lock(self, node_pool):
+        """Return the lock of node_pool"""
+        with self.guard:
+            lock = self.locks.get(node_pool)
+            if lock is None:
+                lock = self.locks[node_pool] = threading.Lock()
+
+        return lock
+
+    @contextmanager
+    def all(self):
+        """Hold the lock of every pool, and keep new ones from being made"""
+        with self.guard:
+            locks = [self.locks[key] for key in sorted(self.locks)]
+            for lock in locks:
+                lock.acquire()
+            try:
+                yield
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+
+
+# Requests are handled concurrently.  Allocations hold the lock of their
+# node pool while they run, and the other changes to the database hold
+# MUTATION_LOCK.
+POOL_LOCKS = PoolLocks()
+POOL_METHODS = ('allocate', 'allocate_manifest')
+MUTATION_LOCK = threading.Lock()
+# Nor may the tables be created while they are being dropped.
+METADATA_LOCK = threading.Lock()
+# Notified whenever this process commits a change to a node, waking the
+# requests which are watching for changes.
+CHANGES = threading.Condition()
+
+# The most changes returned by one watch request
+WATCH_LIMIT = 1000
+# Other server processes do not notify CHANGES, so watchers look for their
+# changes at least this often, in seconds.
+WATCH_POLL_INTERVAL = 1.0
+
+
+def dispatch(database, request):
+    """Call the DataBase method named by the request.
+
+    Returns the response of the request.
+    """
+    method = request.pop('method')
+
+    if method in POOL_METHODS:
+        # Allocations which name no pool may take nodes of any pool
+        request['node_pool'] = request.get('node_pool') or "Default"
+        with POOL_LOCKS.lock(request['node_pool']):
+            return dispatch_mutation(database, method, request)
+
+    if method == 'delete_db':
+        # Nothing else may change the database while it is deleted
+        with POOL_LOCKS.all(), MUTATION_LOCK:
+            return dispatch_mutation(database, method, request)
+
+    if method in IDEMPOTENT_METHODS:
+        with MUTATION_LOCK:
+            return dispatch_mutation(database, method, request)
+
+    return call_method(database, method, request)
+
+
+def dispatch_mutation(database, method, request):
+    """Call a DataBase method which changes the database.
+
+    If the request carries a request_id, it is claimed, the method called
+    and its response saved in the method's transaction.  Server processes
+    do not share their locks, so it is the claim which keeps a request_id
+    from being run by two of them at once.
+
+    Returns the response of the request.
+    """
+    request_id = request.pop('request_id', None)
+
+    if method not in IDEMPOTENT_METHODS or request_id is None:
+        return call_method(database, method, request)
+
+    if len(str(request_id)) > REQUEST_ID_LENGTH:
+        return {'status': 400,
+                'message': "request_id is longer than %d characters"
+                           % (REQUEST_ID_LENGTH, )}
+
+    with database.session_scope() as session:
+        response = database.claim_request(session, request_id, method)
+        if response is not None:
+            log(database.conf,
+                "replaying %s request %s" % (method, request_id, ))
+            return response
+
+        response = call_method(database, method, request)
+
+        database.save_replay(session, request_id, response)
+
+    return response
+
+
+def call_method(database, method, request):
+    """Call the DataBase method named by method with the request args."""
+    if method == 'add_baremetal':
+        node = {}
+        node['ipmi_user'] = request.pop('ipmi_user')
+        node['ipmi_password'] = request.pop('ipmi_password')
+        node['port_hwaddr'] = request.pop('port_hwaddr')
+        node['disk_gb'] = request.pop('disk_gb')
+        node['cpu_arch'] = request.pop('cpu_arch')
+        node['ram_mb'] = request.pop('ram_mb')
+        node['cpus'] = request.pop('cpus')
+        response = database.addBMNode(request, node)
+    elif method == 'add_keyvalue_pairs':
+        node = {}
+
+        for elm in request["args"]:
+            idx = elm.find("=")
+            if idx > -1:
+                node[elm[:idx]] = elm[idx + 1:]
+        response = database.addBMNode(request, node)
+    elif method == 'add_json_blob':
+        node = json.loads(request.pop("blob"))
+        response = database.addBMNode(request, node)
+    elif method == 'allocate':
+        response = database.allocateBM(request['owner_name'],
+                                       request['number_of_nodes'],
+                                       request['node_pool'],
+                                       request.get('locality'),
+                                       request.get('max_nodes'),
+                                       request.get('priority', 0),
+                                       request.get('image'))
+    elif method == 'allocate_manifest':
+        response = database.allocate_manifest(request['owner_name'],
+                                              request['number_of_nodes'],
+                                              request['node_pool'],
+                                              request.get('render', False),
+                                              request.get('locality'),
+                                              request.get('max_nodes'),
+                                              request.get('priority', 0),
+                                              request.get('image'))
+    elif method == 'release':
+        response = database.deallocateOwner(request['owner_name'])
+    elif method == 'get_field':
+        response = database.get_field(request['owner_name'],
+                                      request['field_name'])
+    elif method == 'get_fields':
+        response = database.get_fields(request['owner_names'],
+                                       request['field_names'])
+    elif method == 'set_field':
+        response = database.set_field(request['id'],
+                                      request['key'],
+                                      request['value'],
+                                      request['type'])
+    elif method == 'watch':
+        response = database.watch(request.get('since', 0),
+                                  request.get('timeout', 30))
+    elif method == 'pool_summary':
+        response = database.pool_summary(request.get('node_pool'))
+    elif method == 'status':
+        response = database.status(request["type"],
+                                   request.get("columns"),
+                                   request.get("since"))
+    elif method == 'status_baremetal':
+        response = database.status_baremetal(request["type"],
+                                             request.get("columns"),
+                                             request.get("since"))
+    elif method == 'delete_db':
+        response = database.delete_db()
+    else:
+        response = {'status': 400,
+                    'message': "Unknown method %s" % (method, )}
+
+    return response
+
+
 class Nodes(declarative_base()):
     """Nodes database class"""
 
@@ -199,6 +898,9 @@ class Nodes(declarative_base()):
     #        status VARCHAR(20),
     #        provisioned VARCHAR(50),
     #        timestamp TIMESTAMP NULL,
+    #        node_pool VARCHAR(20),
+    #        priority INTEGER NOT NULL DEFAULT '0',
+    #        image VARCHAR(100),
     #        PRIMARY KEY (id)
     # )
 
@@ -210,6 +912,11 @@ class Nodes(declarative_base()):
     provisioned = Column('provisioned', String(50))
     timestamp = Column('timestamp', TIMESTAMP)
     node_pool = Column('node_pool', String(20))
+    # The priority of the allocation holding the node
+    priority = Column('priority', Integer, nullable=False,
+                      server_default='0')
+    # The image last deployed to the node, if its allocation named one
+    image = Column('image', String(100))
 
     __table__ = Table(__tablename__,
                       metadata,
@@ -220,14 +927,28 @@ class Nodes(declarative_base()):
                       status,
                       provisioned,
                       timestamp,
-                      node_pool)
-
-    def map(self):
-        """Returns a map of the database row contents"""
-        return {key: value for key, value
-                in list(self.__dict__.items())
-                if not key.startswith('_')
-                and not isinstance(key, collections.Callable)}
+                      node_pool,
+                      priority,
+                      image,
+                      # Allocations lock the ready nodes of their pool, so
+                      # only the nodes of that pool may be scanned
+                      Index('ix_Nodes_node_pool_status', 'node_pool',
+                            'status'),
+                      # Preemption looks up the newest allocation of the
+                      # lowest priority, of one pool or of any pool
+                      Index('ix_Nodes_node_pool_status_priority',
+                            'node_pool', 'status', 'priority', 'timestamp'),
+                      Index('ix_Nodes_status_priority',
+                            'status', 'priority', 'timestamp'),
+                      # and then the nodes its owner holds below the
+                      # priority of the allocation
+                      Index('ix_Nodes_provisioned_status_priority',
+                            'provisioned', 'status', 'priority'),
+                      # Allocations look up the ready nodes which already
+                      # have their image, of one pool or of any pool
+                      Index('ix_Nodes_node_pool_status_image',
+                            'node_pool', 'status', 'image'),
+                      Index('ix_Nodes_status_image', 'status', 'image'))
 
     def __repr__(self):
         fmt = """<Node(name='%s',
@@ -236,7 +957,9 @@ blob='%s',
 status='%s',
 provisioned='%s',
 timestamp='%s',
-node_pool='%s'/>"""
+node_pool='%s',
+priority='%s',
+image='%s'/>"""
         fmt = fmt.replace('\n', ' ')
 
         return fmt % (self.name,
@@ -245,7 +968,9 @@ node_pool='%s'/>"""
                       self.status,
                       self.provisioned,
                       self.timestamp,
-                      self.node_pool)
+                      self.node_pool,
+                      self.priority,
+                      self.image)
 
 
 class IPs(declarative_base()):
@@ -289,12 +1014,221 @@ ip='%s' />"""
                       self.ip)
 
 
+# The longest request_id which the Requests table can hold
+REQUEST_ID_LENGTH = 64
+
+
+class Requests(declarative_base()):
+    """Requests database class
+
+    Remembers the response of each mutating request which carried a
+    request_id, so that a retried request can be answered without running
+    it again.  The row is inserted, without a response, before
+    the request runs, claiming its request_id.  The response is saved by
+    replay_record, without the credentials of its nodes.
+    """
+
+    __tablename__ = 'Requests'
+
+    # CREATE TABLE `Requests` (
+    #         request_id VARCHAR(64) NOT NULL,
+    #         method VARCHAR(20),
+    #         response TEXT,
+    #         timestamp TIMESTAMP NULL,
+    #         PRIMARY KEY (request_id)
+    # )
+
+    request_id = Column('request_id',
+                        String(REQUEST_ID_LENGTH),
+                        primary_key=True)
+    method = Column('method',
+                    String(20))
+    response = Column('response',
+                      Text)
+    # Expired responses are purged on every save
+    timestamp = Column('timestamp',
+                       TIMESTAMP,
+                       index=True)
+
+    __table__ = Table(__tablename__,
+                      metadata,
+                      request_id,
+                      method,
+                      response,
+                      timestamp)
+
+    def __repr__(self):
+
+        fmt = """<Request(request_id='%s',
+method='%s',
+timestamp='%s' />"""
+        fmt = fmt.replace('\n', ' ')
+
+        return fmt % (self.request_id,
+                      self.method,
+                      self.timestamp)
+
+
+# Read only calls select these columns with Core, which returns plain rows
+# instead of ORM objects that are tracked by the session.
+NODE_COLUMNS = list(Nodes.__table__.c)
+NODE_COLUMN_NAMES = [column.name for column in NODE_COLUMNS]
+
+
+def node_map(row):
+    """Returns a map of a row of NODE_COLUMNS"""
+    return dict(zip(NODE_COLUMN_NAMES, row))
+
+
+def cleaning_message(cleaning):
+    """Returns what to add to a 404 about the preempted nodes being cleaned"""
+    if not cleaning:
+        return ""
+    return ". %d preempted nodes are being cleaned" % (cleaning, )
+
+
+def warm_keys(node_ids):
+    """Returns the keys, in a nodes map, of node_ids in order"""
+    return ['node_%d' % (node_id, ) for node_id in sorted(node_ids)]
+
+
+class Changes(declarative_base()):
+    """Changes database class
+
+    Every change to a node adds a row with the node's new state.  The seq
+    column orders the changes, so a watcher asks for the changes after the
+    last seq it has seen.
+    """
+
+    __tablename__ = 'Changes'
+
+    # CREATE TABLE `Changes` (
+    #         seq INTEGER NOT NULL AUTO_INCREMENT,
+    #         node_id INTEGER,
+    #         kind VARCHAR(20),
+    #         status VARCHAR(20),
+    #         provisioned VARCHAR(50),
+    #         node_pool VARCHAR(20),
+    #         timestamp TIMESTAMP NULL,
+    #         preempted_by VARCHAR(50),
+    #         PRIMARY KEY (seq)
+    # )
+
+    seq = Column('seq',
+                 Integer,
+                 primary_key=True)
+    node_id = Column('node_id',
+                     Integer)
+    kind = Column('kind',
+                  String(20))
+    status = Column('status',
+                    String(20))
+    provisioned = Column('provisioned',
+                         String(50))
+    node_pool = Column('node_pool',
+                       String(20))
+    timestamp = Column('timestamp',
+                       TIMESTAMP,
+                       index=True)
+    # The owner which a preempted change took the nodes for
+    preempted_by = Column('preempted_by',
+                          String(50),
+                          index=True)
+
+    # status asks for the changes after a seq it returned, so a seq must
+    # never be reused, even once every change has been purged
+    __table__ = Table(__tablename__,
+                      metadata,
+                      seq,
+                      node_id,
+                      kind,
+                      status,
+                      provisioned,
+                      node_pool,
+                      timestamp,
+                      preempted_by,
+                      sqlite_autoincrement=True)
+
+    def __repr__(self):
+
+        fmt = """<Change(seq='%d',
+node_id='%d',
+kind='%s',
+status='%s' />"""
+        fmt = fmt.replace('\n', ' ')
+
+        return fmt % (self.seq,
+                      self.node_id,
+                      self.kind,
+                      self.status)
+
+
+CHANGE_COLUMNS = list(Changes.__table__.c)
+CHANGE_COLUMN_NAMES = [column.name for column in CHANGE_COLUMNS]
+
+
+class Epochs(declarative_base()):
+    """Epochs database class
+
+    Holds one row naming this incarnation of the database.  delete_db makes
+    a new one, as the seqs of the changes start again from 1, so that a
+    version from before the delete is not mistaken for one after it.
+    """
+
+    __tablename__ = 'Epochs'
+
+    # CREATE TABLE `Epochs` (
+    #         id INTEGER NOT NULL,
+    #         epoch VARCHAR(16),
+    #         PRIMARY KEY (id)
+    # )
+
+    id = Column('id',
+                Integer,
+                primary_key=True,
+                autoincrement=False)
+    epoch = Column('epoch',
+                   String(16))
+
+    __table__ = Table(__tablename__,
+                      metadata,
+                      id,
+                      epoch)
+
+    def __repr__(self):
+
+        fmt = """<Epoch(id='%d',
+epoch='%s' />"""
+        fmt = fmt.replace('\n', ' ')
+
+        return fmt % (self.id,
+                      self.epoch)
+
+
+def make_version(epoch, seq):
+    """Returns the version of the database at seq, in its epoch"""
+    return "%s-%d" % (epoch, seq, )
+
+
+def parse_version(version):
+    """Returns the epoch and seq of a version.
+
+    The epoch is None for a plain seq, as older clients send.
+    """
+    (epoch, _, seq) = str(version).rpartition("-")
+    return (epoch or None, int(seq))
+
+
 TYPE_MYSQL = 1
 # Is there a mysql memory path?
 TYPE_SQLITE = 3
 TYPE_SQLITE_MEMORY = 4
 
 
+# The databases, by URL, whose tables this process has created and upgraded
+UPGRADED_DATABASES = set()
+
+
 class DataBase(object):
     """This class may be used access the molten iron database.  """
 
@@ -308,6 +1242,8 @@ class DataBase(object):
         self.host = "127.0.0.1"
         self.database = "MoltenIron"
         self.db_type = db_type
+        # The session of the outermost session_scope of each thread
+        self.scope = threading.local()
 
         engine = None
         try:
@@ -329,6 +1265,8 @@ class DataBase(object):
             # It does not! Create it.
             # CREATE DATABASE MoltenIron;
             sqlalchemy_utils.create_database(engine.url)
+            # Along with its tables
+            UPGRADED_DATABASES.discard(str(engine.url))
             engine = self.create_engine()
             c = engine.connect()
             c.close()
@@ -336,49 +1274,6 @@ class DataBase(object):
 
         self.create_metadata()
 
-        self.blob_status = {
-            "element_info": [
-                # The following are returned from the query call
-
-                # field_name length special_fmt skip
-                ("id", 4, int, False),
-                ("name", 6, str, False),
-                ("ipmi_ip", 16, str, False),
-                ("blob", 40, str, False),
-                ("status", 8, str, False),
-                ("provisioned", 40, str, False),
-                # We add timeString
-                ("time", 14, float, False),
-                ("node_pool", 19, str, False),
-            ]
-        }
-        self.baremetal_status = {
-            "element_info": [
-                # The following are returned from the query call
-
-                # field_name length special_fmt skip
-                ("id", 4, int, False),
-                ("name", 6, str, False),
-                ("ipmi_ip", 9, str, False),
-                ("ipmi_user", 11, str, False),
-                ("ipmi_password", 15, str, False),
-                ("port_hwaddr", 19, str, False),
-                ("cpu_arch", 10, str, False),
-                ("cpus", 6, int, False),
-                ("ram_mb", 8, int, False),
-                ("disk_gb", 9, int, False),
-                ("status", 8, str, False),
-                ("provisioned", 40, str, False),
-                # We add timeString
-                ("time", 14, float, False),
-                ("node_pool", 19, str, False),
-            ]
-        }
-
-        # Pass map by reference but update our copy with the new information
-        self.baremetal_status = self.setup_status(**self.baremetal_status)
-        self.blob_status = self.setup_status(**self.blob_status)
-
     def create_engine(self):
         """Create the sqlalchemy database engine"""
         engine = None
@@ -413,24 +1308,37 @@ class DataBase(object):
 
     def get_session(self):
         """Get a SQL academy session from the pool """
-        Session = sessionmaker(bind=self.engine)
-        session = Session()
-
-        return session
-
-    def get_connection(self):
-        """Get a SQL academy connection from the pool """
-        conn = self.engine.connect()
-
-        return conn
+        return Session(bind=self.engine)
 
     @contextmanager
     def session_scope(self):
-        """Provide a transactional scope around a series of operations. """
+        """Provide a transactional scope around a series of operations.
+
+        Every API call reads and writes through one session, and therefore
+        one pooled connection and one transaction.  A scope opened within
+        another one joins its transaction, which is committed when the
+        outer scope ends.
+        """
+        session = getattr(self.scope, 'session', None)
+        if session is not None:
+            try:
+                yield session
+            except Exception:
+                # Throw the changes away, as a scope of its own would have
+                session.rollback()
+                session.info.pop('changed', None)
+                raise
+            return
+
         session = self.get_session()
+        self.scope.session = session
         try:
             yield session
             session.commit()
+            if session.info.pop('changed', False):
+                VERSION.bump()
+                with CHANGES:
+                    CHANGES.notify_all()
         except Exception as e:
             if DEBUG:
                 print("Exception caught in session_scope: %s %s"
@@ -438,27 +1346,21 @@ class DataBase(object):
             session.rollback()
             raise
         finally:
+            self.scope.session = None
             session.close()
 
-    @contextmanager
-    def connection_scope(self):
-        """Provide a transactional scope around a series of operations. """
-        conn = self.get_connection()
-        try:
-            yield conn
-        except Exception as e:
-            if DEBUG:
-                print("Exception caught in connection_scope: %s" % (e,))
-            raise
-        finally:
-            conn.close()
-
     def delete_db(self):
         """Delete the sqlalchemy database"""
         # Instead of:
         #   IPs.__table__.drop(self.engine, checkfirst=True)
         #   Nodes.__table__.drop(self.engine, checkfirst=True)
-        metadata.drop_all(self.engine, checkfirst=True)
+        with METADATA_LOCK:
+            metadata.drop_all(self.engine, checkfirst=True)
+            # Recreate the empty tables before any other request can race
+            # to do so
+            metadata.create_all(self.engine, checkfirst=True)
+            self.create_epoch()
+        VERSION.bump()
 
         return {'status': 200}
 
@@ -467,12 +1369,70 @@ class DataBase(object):
         # Instead of:
         #   Nodes.__table__.create(self.engine, checkfirst=True)
         #   IPs.__table__.create(self.engine, checkfirst=True)
+        # Every request makes a DataBase, so only the first one of each
+        # database creates the tables.  Each in memory database is new.
+        url = str(self.engine.url)
+        if self.db_type == TYPE_SQLITE_MEMORY:
+            url = None
+        if url in UPGRADED_DATABASES:
+            return
+
         if DEBUG:
             print("create_metadata: Calling metadata.create_all")
-        metadata.create_all(self.engine, checkfirst=True)
+        with METADATA_LOCK:
+            if url not in UPGRADED_DATABASES:
+                metadata.create_all(self.engine, checkfirst=True)
+                self.upgrade_schema()
+                self.create_epoch()
+                if url is not None:
+                    UPGRADED_DATABASES.add(url)
         if DEBUG:
             print("create_metadata: Finished")
 
+    def create_epoch(self):
+        """Give the database an epoch, unless it already has one"""
+        with self.engine.begin() as connection:
+            stmt = select([Epochs.epoch]).where(Epochs.id == 1)
+            if connection.execute(stmt).first() is not None:
+                return
+
+            stmt = insert(Epochs).values(id=1, epoch=os.urandom(4).hex())
+            try:
+                connection.execute(stmt)
+            except IntegrityError:
+                # Another server process gave it one first
+                pass
+
+    def epoch(self, session):
+        """Return the epoch of the database"""
+        stmt = select([Epochs.epoch]).where(Epochs.id == 1)
+        return session.execute(stmt).scalar() or ""
+
+    def upgrade_schema(self):
+        """Add what the tables made by older releases lack"""
+        inspector = inspect(self.engine)
+
+        for table in metadata.sorted_tables:
+            names = set([column['name']
+                         for column in inspector.get_columns(table.name)])
+            for column in table.columns:
+                if column.name not in names:
+                    log(self.conf,
+                        "adding column %s.%s" % (table.name, column.name, ))
+                    ddl = CreateColumn(column).compile(
+                        dialect=self.engine.dialect)
+                    with self.engine.begin() as connection:
+                        connection.execute("ALTER TABLE %s ADD COLUMN %s"
+                                           % (table.name, ddl, ))
+
+            names = set([index['name']
+                         for index in inspector.get_indexes(table.name)])
+            for index in table.indexes:
+                if index.name not in names:
+                    log(self.conf,
+                        "creating index %s" % (index.name, ))
+                    index.create(self.engine)
+
     def to_timestamp(self, ts):
         """Convert from a database time stamp to a Python time stamp"""
         timestamp = None
@@ -492,92 +1452,671 @@ class DataBase(object):
             ts = timestamp.timetuple()
         return ts
 
-    def allocateBM(self, owner_name, how_many, node_pool="Default"):
-        """Checkout machines from the database and return necessary info """
+    def record_change(self, session, kind, node_ids, preempted_by=None):
+        """Record the current state of the nodes node_ids as changes.
+
+        preempted_by names the owner which preempted the nodes.  Changes
+        older than changeTTL seconds are purged.
+        """
+        if not node_ids:
+            return
+
+        now = self.to_timestamp(time.gmtime())
+        ttl = int(self.conf.get("changeTTL", 86400))
+        expired = self.to_timestamp(time.gmtime(time.time() - ttl))
+
+        stmt = delete(Changes)
+        stmt = stmt.where(Changes.timestamp < expired)
+        session.execute(stmt)
+
+        nodes = select([Nodes.id,
+                        literal(kind, String(20)),
+                        Nodes.status,
+                        Nodes.provisioned,
+                        Nodes.node_pool,
+                        literal(now, TIMESTAMP),
+                        literal(preempted_by, String(50))])
+        nodes = nodes.where(Nodes.id.in_(node_ids))
+        nodes = nodes.order_by(Nodes.id)
+
+        stmt = insert(Changes)
+        stmt = stmt.from_select(['node_id',
+                                 'kind',
+                                 'status',
+                                 'provisioned',
+                                 'node_pool',
+                                 'timestamp',
+                                 'preempted_by'],
+                                nodes)
+        session.execute(stmt)
+
+        session.info['changed'] = True
+
+    def watch(self, since=0, timeout=30):
+        """Wait up to timeout seconds for changes after seq since.
+
+        Returns the changes, oldest first, as soon as there are any, and
+        the seq to pass as since next time, in the epoch of the database.
+        If since is of another epoch, or past the newest change, as the
+        database was deleted, every change is returned and reset is True.
+        """
+
+        (since_epoch, since) = parse_version(since)
+        deadline = time.time() + min(float(timeout),
+                                     float(self.conf.get('maxWatch', 300)))
+
+        try:
+            while True:
+                with self.session_scope() as session:
+
+                    epoch = self.epoch(session)
+                    newest = session.execute(
+                        select([func.max(Changes.seq)])).scalar() or 0
+                    reset = (since > newest
+                             or since_epoch not in (None, epoch))
+                    if reset:
+                        since = 0
+
+                    stmt = select(CHANGE_COLUMNS)
+                    stmt = stmt.where(Changes.seq > since)
+                    stmt = stmt.order_by(Changes.seq)
+                    stmt = stmt.limit(WATCH_LIMIT)
+                    changes = [dict(zip(CHANGE_COLUMN_NAMES, row))
+                               for row in session.execute(stmt)]
+
+                remaining = deadline - time.time()
+                if changes or reset or remaining <= 0:
+                    break
+
+                with CHANGES:
+                    CHANGES.wait(min(remaining, WATCH_POLL_INTERVAL))
+
+        except Exception as e:
+
+            if DEBUG:
+                print("Exception caught in watch: %s" % (e,))
+
+            # Don't send the exception object as it is not json serializable!
+            return {'status': 400, 'message': str(e)}
+
+        if changes:
+            since = changes[-1]['seq']
+
+        return {'status': 200,
+                'seq': make_version(epoch, since),
+                'reset': reset,
+                'changes': changes}
+
+    def get_replay(self, session, request_id):
+        """Return the saved response of a request_id, or None if unknown.
+
+        If the nodes it allocated are no longer held by their owner, a 410
+        is returned instead.
+        """
+        stmt = select([Requests.method, Requests.response])
+        stmt = stmt.where(Requests.request_id == request_id)
+        row = session.execute(stmt).first()
+
+        if row is None or row.response is None:
+            return None
+
+        response = json.loads(row.response)
+
+        # Read back the nodes which replay_record saved as their ids
+        node_ids = response.pop('node_ids', None)
+        if node_ids is None:
+            return response
+        render = response.pop('render', False)
+        owner = response.pop('owner', None)
+        response['nodes'] = self.nodes_with_ips(session, node_ids)
+
+        # Unless they were released, and perhaps allocated to another
+        # owner, since
+        held = [node for node in response['nodes'].values()
+                if node['provisioned'] == owner]
+        if owner is not None and len(held) != len(node_ids):
+            return {'status': 410,
+                    'message': 'The nodes allocated by request %s are no'
+                               ' longer held by %s' % (request_id, owner, )}
+
+        if row.method == 'allocate_manifest':
+            return manifest_response(response, render)
+
+        return response
+
+    def claim_request(self, session, request_id, method):
+        """Claim a request_id for the caller's transaction.
+
+        Its row is inserted before the request runs, so the same request_id
+        sent to another server process waits on the primary key until this
+        transaction ends.  Returns None once claimed, or the saved response
+        if the request_id has already run.
+        """
+        while True:
+            response = self.get_replay(session, request_id)
+            if response is not None:
+                return response
+
+            stmt = insert(Requests)
+            stmt = stmt.values(request_id=request_id,
+                               method=method,
+                               timestamp=self.to_timestamp(time.gmtime()))
+            try:
+                session.execute(stmt)
+                return None
+            except IntegrityError:
+                # Another request with the request_id has committed, so
+                # read what it saved
+                session.rollback()
+
+    def save_replay(self, session, request_id, response):
+        """Save the response of a claimed request_id so it may be replayed.
+
+        A failed response is not saved, and the claim is given up, so that
+        the request may be retried.  Saved responses older than requestTTL
+        seconds are purged.
+        """
+        if response['status'] != 200:
+            stmt = delete(Requests)
+            stmt = stmt.where(and_(Requests.request_id == request_id,
+                                   Requests.response.is_(None)))
+            session.execute(stmt)
+            return
+
+        ttl = int(self.conf.get("requestTTL", 86400))
+        expired = self.to_timestamp(time.gmtime(time.time() - ttl))
+
+        stmt = delete(Requests)
+        stmt = stmt.where(and_(Requests.timestamp < expired,
+                               Requests.request_id != request_id))
+        session.execute(stmt)
+
+        stmt = update(Requests)
+        stmt = stmt.where(Requests.request_id == request_id)
+        stmt = stmt.values(response=json.dumps(
+            replay_record(response),
+            cls=JSON_encoder_with_DateTime))
+        session.execute(stmt)
+
+    def allocateBM(self, owner_name, how_many, node_pool="Default",
+                   locality=None, max_nodes=None, priority=0, image=None):
+        """Checkout machines from the database and return necessary info
+
+        If max_nodes is given, as many nodes as are ready, from how_many up
+        to max_nodes, are allocated and count says how many were.
+
+        If too few nodes are ready, allocations of a lower priority than
+        priority are preempted to make up the difference.
+
+        If image is given, ready nodes which last had image deployed are
+        preferred, and warm lists the nodes which did.  The nodes then
+        record image as theirs.
+
+        If locality is given, every node shares the same value of it, a
+        Nodes column or a field of the blob such as a rack.  Either all of
+        the nodes are allocated or none of them are.
+        """
+
+        if max_nodes is None:
+            max_nodes = how_many
+        if max_nodes < how_many:
+            return {'status': 400,
+                    'message': "max_nodes %d is less than number_of_nodes %d"
+                               % (max_nodes, how_many, )}
+
+        try:
+            with self.session_scope() as session:
+
+                # Count the free nodes of every pool with one query
+                stmt = select([Nodes.node_pool, func.count()])
+                stmt = stmt.where(Nodes.status == "ready")
+                stmt = stmt.group_by(Nodes.node_pool)
+                ready = dict(session.execute(stmt).fetchall())
+
+                shortfall = how_many - sum(ready.values())
+                pool = None
+                if node_pool != "Default":
+                    shortfall = how_many - ready.get(node_pool, 0)
+                    pool = node_pool
+                cleaning = 0
+                if shortfall > 0 and priority > 0 and locality is None:
+                    # The nodes preempted for an earlier try of this
+                    # request are soon ready
+                    cleaning = self.cleaning_for(session, owner_name, pool)
+                    shortfall -= cleaning
+                    if shortfall > 0:
+                        freed = self.preempt(session, owner_name, shortfall,
+                                             pool, priority)
+                        if freed:
+                            ready = dict(session.execute(stmt).fetchall())
+                            if self.conf.get("cleanAction"):
+                                cleaning += freed
+
+                count_with_pool = 0
+                count = sum(ready.values())
+                # Get the number of nodes that are free and with specific
+                # node_pool
+                if node_pool != "Default":
+                    count_with_pool = ready.get(node_pool, 0)
+                    if count_with_pool < how_many:
+                        fmt = "Not enough available nodes found."
+                        fmt += " Found %d, requested %d"
+                        return {'status': 404,
+                                'message': (fmt % (count_with_pool, how_many, )
+                                            + cleaning_message(cleaning))}
+                # If we don't have enough nodes return an error
+                if count < how_many:
+                    fmt = "Not enough available nodes found."
+                    fmt += " Found %d, requested %d"
+                    return {'status': 404,
+                            'message': (fmt % (count, how_many, )
+                                        + cleaning_message(cleaning))}
+
+                if locality is not None:
+                    return self.allocate_gang(session,
+                                              owner_name,
+                                              how_many,
+                                              max_nodes,
+                                              pool,
+                                              locality,
+                                              priority,
+                                              image)
+
+                if count_with_pool > 0:
+                    max_nodes = min(max_nodes, count_with_pool)
+                else:
+                    max_nodes = min(max_nodes, count)
+
+                node_ids = []
+                warm_ids = []
+                # Our reads may not see that another server process has
+                # taken a node, so never try the same node twice
+                tried_ids = []
+                # Whether any ready node may still have the image
+                look_warm = image is not None
+
+                while len(node_ids) < max_nodes:
+                    ready_nodes = session.query(Nodes.id)
+                    ready_nodes = ready_nodes.filter(~Nodes.id.in_(tried_ids))
+                    if count_with_pool > 0:
+                        ready_nodes = ready_nodes.filter_by(
+                            status="ready", node_pool=node_pool)
+                    else:
+                        ready_nodes = ready_nodes.filter_by(status="ready")
+                    # Lock the row, so that other server processes wait
+                    # for this transaction rather than lose the race for it
+                    ready_nodes = ready_nodes.with_for_update()
+
+                    first_ready = None
+                    if look_warm:
+                        first_ready = ready_nodes.filter_by(image=image)
+                        first_ready = first_ready.first()
+                        look_warm = first_ready is not None
+                    warm = first_ready is not None
+                    if first_ready is None:
+                        first_ready = ready_nodes.first()
+
+                    if first_ready is None and len(node_ids) >= how_many:
+                        break
+
+                    if first_ready is None:
+                        # Other server processes took the nodes we counted,
+                        # so give back the ones we have
+                        session.rollback()
+                        fmt = "Not enough available nodes found."
+                        fmt += " Found %d, requested %d"
+                        return {'status': 404,
+                                'message': fmt % (len(node_ids), how_many, )}
+
+                    node_id = first_ready.id
+                    tried_ids.append(node_id)
+
+                    timestamp = self.to_timestamp(time.gmtime())
+
+                    # Update the node to the in use state, unless another
+                    # server process has just done so
+                    stmt = update(Nodes)
+                    stmt = stmt.where(and_(Nodes.id == node_id,
+                                           Nodes.status == "ready"))
+                    stmt = stmt.values(status="dirty",
+                                       provisioned=owner_name,
+                                       timestamp=timestamp,
+                                       priority=priority,
+                                       image=image)
+                    if session.execute(stmt).rowcount == 1:
+                        log(self.conf,
+                            "allocating node id: %d for %s"
+                            % (node_id, owner_name, ))
+
+                        node_ids.append(node_id)
+                        if warm:
+                            warm_ids.append(node_id)
+                        if count_with_pool > 0:
+                            count_with_pool = count_with_pool - 1
+
+                self.record_change(session, "allocated", node_ids)
+
+                nodes_allocated = self.nodes_with_ips(session, node_ids)
+
+        except Exception as e:
+
+            if DEBUG:
+                print("Exception caught in deallocateBM: %s" % (e,))
+
+            # Don't send the exception object as it is not json serializable!
+            return {'status': 400, 'message': str(e)}
+
+        response = {'status': 200,
+                    'nodes': nodes_allocated,
+                    'count': len(nodes_allocated)}
+        if image is not None:
+            response['warm'] = warm_keys(warm_ids)
+
+        return response
+
+    def allocate_gang(self, session, owner_name, how_many, max_nodes,
+                      node_pool, locality, priority=0, image=None):
+        """Checkout how_many to max_nodes nodes which share a locality.
+
+        The ready nodes of node_pool, or of every pool if it is None, are
+        read and locked with one query through the (node_pool, status)
+        index, and grouped by their value of locality.  The smallest group
+        with max_nodes nodes is chosen, leaving bigger groups for bigger
+        requests, or else the biggest group with at least how_many.  Within
+        it, the nodes which last had image are taken first.  Its nodes are
+        updated with one statement.
+        """
+
+        columns = Nodes.__table__.c
+
+        if locality in columns:
+            stmt = select([Nodes.id, columns[locality], Nodes.image])
+        else:
+            stmt = select([Nodes.id, Nodes.blob, Nodes.image])
+        stmt = stmt.where(Nodes.status == "ready")
+        if node_pool is not None:
+            stmt = stmt.where(Nodes.node_pool == node_pool)
+        stmt = stmt.order_by(Nodes.id)
+        stmt = stmt.with_for_update()
+
+        groups = {}
+        warm_ids = set()
+        for (node_id, value, node_image) in session.execute(stmt):
+            if image is not None and node_image == image:
+                warm_ids.add(node_id)
+            if locality not in columns:
+                value = json.loads(value).get(locality)
+                if value is not None:
+                    # Blob values may be lists or maps
+                    value = json.dumps(value, sort_keys=True)
+            if value is not None:
+                groups.setdefault(value, []).append(node_id)
+
+        gangs = [ids for ids in groups.values() if len(ids) >= how_many]
+        if not gangs:
+            largest = max([len(ids) for ids in groups.values()] + [0])
+            fmt = "Not enough available nodes found with the same %s."
+            fmt += " Found %d, requested %d"
+            return {'status': 404,
+                    'message': fmt % (locality, largest, how_many, )}
+
+        fits = [ids for ids in gangs if len(ids) >= max_nodes]
+        if fits:
+            node_ids = min(fits, key=len)
+        else:
+            node_ids = max(gangs, key=len)
+        node_ids = sorted(node_ids,
+                          key=lambda node_id: node_id not in warm_ids)
+        node_ids = node_ids[:max_nodes]
+
+        timestamp = self.to_timestamp(time.gmtime())
+
+        stmt = update(Nodes)
+        stmt = stmt.where(and_(Nodes.id.in_(node_ids),
+                               Nodes.status == "ready"))
+        stmt = stmt.values(status="dirty",
+                           provisioned=owner_name,
+                           timestamp=timestamp,
+                           priority=priority,
+                           image=image)
+        if session.execute(stmt).rowcount != len(node_ids):
+            # Another server process took one of the nodes, so take none
+            session.rollback()
+            return {'status': 404,
+                    'message': "The nodes found with the same %s were"
+                               " allocated by another request"
+                               % (locality, )}
+
+        log(self.conf,
+            "allocating node ids: %s for %s"
+            % (",".join([str(node_id) for node_id in node_ids]),
+               owner_name, ))
+
+        self.record_change(session, "allocated", node_ids)
+
+        response = {'status': 200,
+                    'nodes': self.nodes_with_ips(session, node_ids),
+                    'count': len(node_ids)}
+        if image is not None:
+            response['warm'] = warm_keys([node_id for node_id in node_ids
+                                          if node_id in warm_ids])
+
+        return response
+
+    def cleaning_for(self, session, owner_name, node_pool):
+        """Return how many nodes preempted for owner_name are being cleaned.
+
+        Nodes released by others, or preempted for another owner, are not
+        counted, nor are nodes which changed again since being preempted.
+        """
+
+        stmt = select([Changes.node_id, Changes.seq])
+        stmt = stmt.select_from(Changes.__table__.join(
+            Nodes.__table__, Changes.node_id == Nodes.id))
+        stmt = stmt.where(and_(Changes.preempted_by == owner_name,
+                               Changes.kind == "preempted",
+                               Nodes.status == "cleaning"))
+        if node_pool is not None:
+            stmt = stmt.where(Nodes.node_pool == node_pool)
+        stmt = stmt.order_by(Changes.seq)
+        # Later preemptions of a node overwrite earlier ones
+        preempted = dict(session.execute(stmt).fetchall())
+        if not preempted:
+            return 0
+
+        stmt = select([Changes.node_id, func.max(Changes.seq)])
+        stmt = stmt.where(Changes.node_id.in_(list(preempted)))
+        stmt = stmt.group_by(Changes.node_id)
+        latest = dict(session.execute(stmt).fetchall())
+
+        return len([node_id for (node_id, seq) in preempted.items()
+                    if latest.get(node_id) == seq])
+
+    def preempt(self, session, owner_name, how_many, node_pool, priority):
+        """Revoke allocations below priority to free how_many nodes.
+
+        The newest allocation of the lowest priority is revoked first.
+        Both the lowest priority, and then its newest allocation, are found
+        through the (node_pool, status, priority, timestamp) index, or the
+        (status, priority, timestamp) one if node_pool is None and any pool
+        will do.  Every node its owner holds below priority, found through
+        the (provisioned, status, priority) index, is revoked, as
+        the owner cannot use part of its allocation, and is recorded as a
+        "preempted" change still naming the owner, and owner_name as the
+        one it was preempted by.  As when they are released, the nodes must
+        be cleaned before they are ready again if cleanAction is set.
+
+        The allocations are only revoked if, together, they free how_many
+        nodes, so that no owner loses its nodes to a request which would
+        still fail.  Returns how many nodes of node_pool were freed.
+        """
+
+        victims = []
+        freed = 0
+
+        while freed < how_many:
+            allocated = [Nodes.status == "dirty", Nodes.priority < priority]
+            if node_pool is not None:
+                allocated.append(Nodes.node_pool == node_pool)
+            if victims:
+                allocated.append(~Nodes.provisioned.in_(
+                    [victim for (victim, _) in victims]))
+
+            stmt = select([func.min(Nodes.priority)])
+            stmt = stmt.where(and_(*allocated))
+            lowest = session.execute(stmt).scalar()
+            if lowest is None:
+                break
+
+            stmt = select([Nodes.provisioned])
+            stmt = stmt.where(and_(Nodes.priority == lowest, *allocated))
+            stmt = stmt.order_by(Nodes.timestamp.desc())
+            stmt = stmt.limit(1)
+            victim = session.execute(stmt).scalar()
+
+            stmt = select([Nodes.id, Nodes.node_pool])
+            stmt = stmt.where(and_(Nodes.provisioned == victim,
+                                   Nodes.status == "dirty",
+                                   Nodes.priority < priority))
+            stmt = stmt.with_for_update()
+            nodes = session.execute(stmt).fetchall()
+
+            victims.append((victim, [node.id for node in nodes]))
+            freed += len([node for node in nodes
+                          if node_pool is None or node.node_pool == node_pool])
+
+        if freed < how_many:
+            log(self.conf,
+                "not preempting, only %d of %d nodes could be freed"
+                % (freed, how_many, ))
+            return 0
+
+        status = "ready"
+        if self.conf.get("cleanAction"):
+            status = "cleaning"
+
+        for (victim, node_ids) in victims:
+            log(self.conf,
+                "preempting node ids: %s of %s"
+                % (",".join([str(node_id) for node_id in node_ids]),
+                   victim, ))
+
+            self.record_change(session, "preempted", node_ids,
+                               preempted_by=owner_name)
+
+            stmt = update(Nodes)
+            stmt = stmt.where(Nodes.id.in_(node_ids))
+            stmt = stmt.values(status=status,
+                               provisioned="",
+                               timestamp=None,
+                               priority=0)
+            session.execute(stmt)
+
+        return freed
+
+    def nodes_with_ips(self, session, node_ids):
+        """Return the nodes dict for node_ids, including allocation_pool.
+
+        The nodes and their IPs are read with one joined query.
+        """
+
+        stmt = select(NODE_COLUMNS + [IPs.ip])
+        stmt = stmt.select_from(Nodes.__table__.outerjoin(
+            IPs.__table__, IPs.node_id == Nodes.id))
+        stmt = stmt.where(Nodes.id.in_(node_ids))
+        stmt = stmt.order_by(Nodes.id, IPs.id)
 
-        try:
-            with self.session_scope() as session, \
-                    self.connection_scope() as conn:
+        nodes = {}
+        allocation_pools = {}
 
-                count_with_pool = 0
-                # Get a list of IDs for nodes that are free
-                count = session.query(Nodes).filter_by(status="ready").count()
-                # Get a list of IDs for nodes that are free and with specific
-                # node_pool
-                if node_pool != "Default":
-                    count_with_pool = session.query(Nodes).filter_by(
-                        status="ready", node_pool=node_pool).count()
-                    if count_with_pool < how_many:
-                        fmt = "Not enough available nodes found."
-                        fmt += " Found %d, requested %d"
-                        return {'status': 404,
-                                'message': fmt % (count_with_pool, how_many, )}
-                # If we don't have enough nodes return an error
-                if count < how_many:
-                    fmt = "Not enough available nodes found."
-                    fmt += " Found %d, requested %d"
-                    return {'status': 404,
-                            'message': fmt % (count, how_many, )}
+        for row in session.execute(stmt):
+            key = 'node_%d' % (row.id, )
+            if key not in nodes:
+                nodes[key] = node_map(row[:-1])
+                allocation_pools[key] = []
+            if row.ip is not None:
+                allocation_pools[key].append(row.ip)
 
-                nodes_allocated = {}
+        for key in nodes:
+            nodes[key]['allocation_pool'] = ','.join(allocation_pools[key])
 
-                for _ in range(how_many):
-                    first_ready = session.query(Nodes)
-                    if count_with_pool > 0:
-                        first_ready = first_ready.filter_by(
-                            status="ready", node_pool=node_pool)
-                        count_with_pool = count_with_pool - 1
-                    else:
-                        first_ready = first_ready.filter_by(status="ready")
-                    first_ready = first_ready.first()
+        return nodes
 
-                    node_id = first_ready.id
-                    # We have everything we need from node
+    def allocate_manifest(self, owner_name, how_many, node_pool="Default",
+                          render=False, locality=None, max_nodes=None,
+                          priority=0, image=None):
+        """Checkout machines and return everything a devstack hook needs.
 
-                    log(self.conf,
-                        "allocating node id: %d for %s" % (node_id,
-                                                           owner_name, ))
+        Each node has its blob expanded into the node itself.  If render is
+        True, the hardware_info lines and localrc settings are also
+        returned, ready to be appended to their files.
+        """
 
-                    timestamp = self.to_timestamp(time.gmtime())
+        response = self.allocateBM(owner_name,
+                                   how_many,
+                                   node_pool,
+                                   locality,
+                                   max_nodes,
+                                   priority,
+                                   image)
 
-                    # Update the node to the in use state
-                    stmt = update(Nodes)
-                    stmt = stmt.where(Nodes.id == node_id)
-                    stmt = stmt.values(status="dirty",
-                                       provisioned=owner_name,
-                                       timestamp=timestamp)
-                    conn.execute(stmt)
+        if response['status'] != 200:
+            return response
 
-                    # Refresh the data
-                    session.close()
-                    session = self.get_session()
+        return manifest_response(response, render)
 
-                    first_ready = session.query(Nodes).filter_by(id=node_id)
-                    first_ready = first_ready.one()
+    def pool_summary(self, node_pool=None):
+        """Return how many nodes each pool has in each status.
 
-                    first_ready_node = first_ready.map()
+        The counts come from one GROUP BY query.  Each pool also has the
+        age, in seconds, of its oldest allocation, or None if none of its
+        nodes are allocated.
+        """
 
-                    # Query the associated IP table
-                    ips = session.query(IPs).filter_by(node_id=first_ready.id)
+        pools = {}
 
-                    allocation_pool = []
-                    for ip in ips:
-                        allocation_pool.append(ip.ip)
-                    first_ready_node['allocation_pool'] \
-                        = ','.join(allocation_pool)
+        try:
+            with self.session_scope() as session:
 
-                    # Add the node to the nodes dict
-                    nodes_allocated['node_%d' % (node_id, )] = first_ready_node
+                stmt = select([Nodes.node_pool,
+                               Nodes.status,
+                               func.count(),
+                               func.min(Nodes.timestamp)])
+                if node_pool is not None:
+                    stmt = stmt.where(Nodes.node_pool == node_pool)
+                stmt = stmt.group_by(Nodes.node_pool, Nodes.status)
+
+                now = datetime.utcnow()
+
+                for (pool, status, count, oldest) in session.execute(stmt):
+                    summary = pools.setdefault(pool, {
+                        'statuses': {},
+                        'total': 0,
+                        'oldest_allocation': None,
+                    })
+                    summary['statuses'][status] = count
+                    summary['total'] += count
+
+                    if oldest is None or status == "ready":
+                        continue
+                    age = (now - oldest).total_seconds()
+                    if summary['oldest_allocation'] is None \
+                            or age > summary['oldest_allocation']:
+                        summary['oldest_allocation'] = age
 
         except Exception as e:
 
             if DEBUG:
-                print("Exception caught in deallocateBM: %s" % (e,))
+                print("Exception caught in pool_summary: %s" % (e,))
 
             # Don't send the exception object as it is not json serializable!
             return {'status': 400, 'message': str(e)}
 
-        return {'status': 200, 'nodes': nodes_allocated}
+        if node_pool is not None and node_pool not in pools:
+            return {'status': 404,
+                    'message': 'node_pool %s has no nodes' % (node_pool, )}
+
+        return {'status': 200, 'pools': pools}
 
     def deallocateBM(self, node_id):
         """Given the ID of a node (or the IPMI IP), de-allocate that node.
@@ -586,67 +2125,84 @@ class DataBase(object):
         """
 
         try:
-            with self.session_scope() as session, \
-                    self.connection_scope() as conn:
+            with self.session_scope() as session:
 
-                query = session.query(Nodes.id, Nodes.ipmi_ip, Nodes.name)
+                self.deallocate(session, node_id)
 
-# WAS:
-#               if (isinstance(node_id, str) or
-#                       isinstance(node_id, unicode)) \
-#                  and ("." in node_id):
+        except Exception as e:
 
-                check = isinstance(node_id, str)
-                if sys.version_info < (3, 0):
-                    check = check or isinstance(node_id, unicode)  # noqa
+            if DEBUG:
+                print("Exception caught in deallocateBM: %s" % (e,))
 
-                if check and ("." in node_id):
-                    # If an ipmi_ip was passed
-                    query = query.filter_by(ipmi_ip=node_id)
-                else:
-                    query = query.filter_by(id=node_id)
+            # Don't send the exception object as it is not json serializable!
+            return {'status': 400, 'message': str(e)}
 
-                node = query.one()
+        return {'status': 200}
 
-                log(self.conf,
-                    "de-allocating node (%d, %s)" % (node.id, node.ipmi_ip,))
+    def deallocate(self, session, node_id):
+        """De-allocate a node within the caller's session"""
 
-                stmt = update(Nodes)
-                stmt = stmt.where(Nodes.id == node.id)
-                stmt = stmt.values(status="ready",
-                                   provisioned="",
-                                   timestamp=None)
+        query = session.query(Nodes.id, Nodes.ipmi_ip, Nodes.name)
 
-                conn.execute(stmt)
+# WAS:
+#       if (isinstance(node_id, str) or
+#               isinstance(node_id, unicode)) \
+#          and ("." in node_id):
 
-        except Exception as e:
+        check = isinstance(node_id, str)
+        if sys.version_info < (3, 0):
+            check = check or isinstance(node_id, unicode)  # noqa
 
-            if DEBUG:
-                print("Exception caught in deallocateBM: %s" % (e,))
+        if check and ("." in node_id):
+            # If an ipmi_ip was passed
+            query = query.filter_by(ipmi_ip=node_id)
+        else:
+            query = query.filter_by(id=node_id)
 
-            # Don't send the exception object as it is not json serializable!
-            return {'status': 400, 'message': str(e)}
+        node = query.one()
 
-        return {'status': 200}
+        log(self.conf,
+            "de-allocating node (%d, %s)" % (node.id, node.ipmi_ip,))
+
+        # The Cleaner makes the node ready once it has been cleaned
+        status = "ready"
+        if self.conf.get("cleanAction"):
+            status = "cleaning"
+
+        stmt = update(Nodes)
+        stmt = stmt.where(Nodes.id == node.id)
+        stmt = stmt.values(status=status,
+                           provisioned="",
+                           timestamp=None,
+                           priority=0)
+
+        session.execute(stmt)
+
+        self.record_change(session, "released", [node.id])
 
     def deallocateOwner(self, owner_name):
         """Deallocate all nodes in use by a given BM owner.  """
 
+        node = None
+
         try:
             with self.session_scope() as session:
                 nodes = session.query(Nodes.id)
                 nodes = nodes.filter_by(provisioned=owner_name)
+                nodes = nodes.all()
 
-                if nodes.count() == 0:
+                if len(nodes) == 0:
                     message = "No nodes are owned by %s" % (owner_name,)
 
                     return {'status': 400, 'message': message}
 
                 for node in nodes:
-                    self.deallocateBM(node.id)
+                    self.deallocate(session, node.id)
         except Exception as e:
             if DEBUG:
                 print("Exception caught in deallocateOwner: %s" % (e,))
+            if node is None:
+                return {'status': 400, 'message': str(e)}
             message = "Failed to deallocate node with ID %d" % (node.id,)
             return {'status': 400, 'message': message}
 
@@ -676,8 +2232,7 @@ class DataBase(object):
                 print("addBMNode: request = %s data_map = %s"
                       % (request, data_map, ))
 
-            with self.session_scope() as session, \
-                    self.connection_scope() as conn:
+            with self.session_scope() as session:
 
                 # Check if it already exists
                 query = session.query(Nodes)
@@ -718,28 +2273,20 @@ class DataBase(object):
                 if DEBUG:
                     print(stmt.compile().params)
 
-                conn.execute(stmt)
-
-                # Refresh the data
-                session.close()
-                session = self.get_session()
-
-                query = session.query(Nodes).filter_by(name=request['name'])
-                new_node = query.one()
-
-                # new_node is now a proper Node with an id
+                result = session.execute(stmt)
+                node_id = result.inserted_primary_key[0]
 
                 # Add IPs to database
                 # Note: id is always 0 as it is an auto-incrementing field
-                ips = request['allocation_pool'].split(',')
-                for ip in ips:
-                    stmt = insert(IPs)
-                    stmt = stmt.values(node_id=new_node.id, ip=ip)
+                ips = [{'node_id': node_id, 'ip': ip}
+                       for ip in request['allocation_pool'].split(',')]
 
-                    if DEBUG:
-                        print(stmt.compile().params)
+                if DEBUG:
+                    print(ips)
 
-                    conn.execute(stmt)
+                session.execute(insert(IPs), ips)
+
+                self.record_change(session, "added", [node_id])
 
         except Exception as e:
 
@@ -759,8 +2306,7 @@ class DataBase(object):
         """
 
         try:
-            with self.session_scope() as session, \
-                    self.connection_scope() as conn:
+            with self.session_scope() as session:
 
                 query = session.query(Nodes.id, Nodes.ipmi_ip, Nodes.name)
                 query = query.filter_by(id=int(ID))
@@ -770,11 +2316,12 @@ class DataBase(object):
                     ("deleting node (id=%d, ipmi_ip=%s, name=%s"
                      % (query.id, query.ipmi_ip, query.name,)))
 
-                ips = session.query(IPs).filter_by(node_id=int(ID))
-                for ip in ips:
-                    stmt = delete(IPs)
-                    stmt = stmt.where(IPs.id == ip.id)
-                    conn.execute(stmt)
+                # Record the node as it was before it goes
+                self.record_change(session, "removed", [query.id])
+
+                stmt = delete(IPs)
+                stmt = stmt.where(IPs.node_id == query.id)
+                session.execute(stmt)
 
                 stmt = delete(Nodes)
 
@@ -784,7 +2331,7 @@ class DataBase(object):
                 else:
                     stmt = stmt.where(Nodes.id == query.id)
 
-                conn.execute(stmt)
+                session.execute(stmt)
 
         except Exception as e:
 
@@ -801,7 +2348,7 @@ class DataBase(object):
 
         If any node has been in use for longer than maxSeconds, deallocate
         that node.  Nodes that are deallocated in this way get their state set
-        to "dirty".  They are also scheduled for cleaning.
+        to "cleaning" if cleanAction is set, so that the Cleaner cleans them.
         """
 
         if DEBUG:
@@ -812,45 +2359,31 @@ class DataBase(object):
         try:
             with self.session_scope() as session:
 
-                nodes = session.query(Nodes)
+                # Only nodes allocated before cutoff are selected
+                cutoff = time.gmtime(time.time() - int(maxSeconds))
+                cutoff = self.to_timestamp(cutoff)
 
                 if DEBUG:
-                    print("There are %d nodes" % (nodes.count(), ))
-
-                for node in nodes:
-
-                    if DEBUG:
-                        print(node)
+                    print("cutoff = %s" % (cutoff, ))
 
-                    if node.timestamp in ('', '-1', None):
-                        continue
+                stmt = select(NODE_COLUMNS)
+                stmt = stmt.where(and_(Nodes.timestamp.isnot(None),
+                                       Nodes.timestamp <= cutoff))
+                rows = session.execute(stmt).fetchall()
 
-                    currentTime = self.to_timestamp(time.gmtime())
-                    elapsedTime = currentTime - node.timestamp
-                    if DEBUG:
-                        print("currentTime         = %s"
-                              % (currentTime, ))
-                        print("node.timestamp      = %s"
-                              % (node.timestamp, ))
-                        print("elapsedTime         = %s"
-                              % (elapsedTime, ))
-                        print("elapsedTime.seconds = %s"
-                              % (elapsedTime.seconds, ))
-
-                    if elapsedTime.seconds < int(maxSeconds):
-                        continue
+                for row in rows:
 
                     logstring = ("node %d has been allocated for too long."
-                                 % (node.id,))
+                                 % (row.id,))
                     log(self.conf, logstring)
 
                     if DEBUG:
                         print(logstring)
 
-                    self.deallocateBM(node.id)
+                    # Add the node to the nodes dict, as it was
+                    nodes_culled['node_%d' % (row.id, )] = node_map(row)
 
-                    # Add the node to the nodes dict
-                    nodes_culled['node_%d' % (node.id, )] = node.map()
+                    self.deallocate(session, row.id)
 
         except Exception as e:
 
@@ -862,12 +2395,15 @@ class DataBase(object):
 
         return {'status': 200, 'nodes': nodes_culled}
 
-    def doClean(self, node_id):
-        """This function is used to clean a node. """
+    def doClean(self, node_id, reimaged=True):
+        """This function is used to clean a node.
+
+        reimaged says whether cleaning wiped the image deployed on the node,
+        as an operator cleaning it by hand is assumed to have.
+        """
 
         try:
-            with self.session_scope() as session, \
-                    self.connection_scope() as conn:
+            with self.session_scope() as session:
 
                 query = session.query(Nodes)
                 query = query.filter_by(id=node_id)
@@ -884,9 +2420,14 @@ class DataBase(object):
 
                 stmt = update(Nodes)
                 stmt = stmt.where(Nodes.id == node_id)
-                stmt = stmt.values(status="ready")
+                if reimaged:
+                    stmt = stmt.values(status="ready", image=None)
+                else:
+                    stmt = stmt.values(status="ready")
 
-                conn.execute(stmt)
+                session.execute(stmt)
+
+                self.record_change(session, "cleaned", [node_id])
 
         except Exception as e:
 
@@ -898,6 +2439,49 @@ class DataBase(object):
 
         return {'status': 200}
 
+    def unclean_nodes(self):
+        """Return the node maps of the nodes waiting to be cleaned"""
+
+        with self.session_scope() as session:
+            stmt = select(NODE_COLUMNS)
+            stmt = stmt.where(Nodes.status == "cleaning")
+            stmt = stmt.order_by(Nodes.id)
+
+            return [node_map(row) for row in session.execute(stmt)]
+
+    def fail_clean(self, node_id):
+        """Mark a node which could not be cleaned as failed.
+
+        It is not allocated again until doClean is called for it.
+        """
+
+        try:
+            with self.session_scope() as session:
+
+                stmt = update(Nodes)
+                stmt = stmt.where(and_(Nodes.id == node_id,
+                                       Nodes.status == "cleaning"))
+                stmt = stmt.values(status="failed")
+
+                if session.execute(stmt).rowcount == 0:
+                    return {'status': 404,
+                            'message': 'Node with id of %s is not being'
+                                       ' cleaned' % (node_id, )}
+
+                log(self.conf, "cleaning node %d failed" % (node_id, ))
+
+                self.record_change(session, "failed", [node_id])
+
+        except Exception as e:
+
+            if DEBUG:
+                print("Exception caught in fail_clean: %s" % (e,))
+
+            # Don't send the exception object as it is not json serializable!
+            return {'status': 400, 'message': str(e)}
+
+        return {'status': 200}
+
     # @TODO(hamzy) shouldn't it return allocation_pool rather than ipmi_ip?
     def get_ips(self, owner_name):
         """Return all IPs allocated to a given node owner
@@ -910,11 +2494,10 @@ class DataBase(object):
         try:
             with self.session_scope() as session:
 
-                query = session.query(Nodes)
-                nodes = query.filter_by(provisioned=owner_name)
+                stmt = select([Nodes.ipmi_ip])
+                stmt = stmt.where(Nodes.provisioned == owner_name)
 
-                for node in nodes:
-                    ips.append(node.ipmi_ip)
+                ips = [row.ipmi_ip for row in session.execute(stmt)]
 
         except Exception as e:
 
@@ -929,54 +2512,110 @@ class DataBase(object):
     def get_field(self, owner_name, field):
         """Return entries list with id, field for a given owner, field.  """
 
-        results = []
+        response = self.get_fields(owner_name, [field])
 
-        try:
-            with self.session_scope() as session:
+        if response['status'] != 200:
+            return response
 
-                query = session.query(Nodes)
-                nodes = query.filter_by(provisioned=owner_name)
+        results = [{'id': row[0], 'field': row[2]}
+                   for row in response['result']]
 
-                if DEBUG:
-                    print("There are %d entries provisioned by %s"
-                          % (nodes.count(), owner_name,))
+        return {'status': 200, 'result': results}
 
-                if nodes.count() == 0:
-                    return {'status': 404,
-                            'message': '%s does not own any nodes'
-                                       % owner_name}
+    def get_fields(self, owner_names, fields):
+        """Return a table of fields for the nodes of one or more owners.
 
-                for node in nodes:
-                    result = {'id': node.id}
+        owner_names is either a list or a comma separated string of owners.
+        Only the columns needed are selected and a node's blob is only
+        decoded when a requested field lives inside of it.
+
+        The result is a list of rows, each row being the node's id, the
+        owner and then the value of each requested field in order.
+        """
+
+        if not isinstance(owner_names, list):
+            owner_names = owner_names.split(",")
+        if not isinstance(fields, list):
+            fields = [fields]
+
+        columns = Nodes.__table__.c
+        column_fields = [field for field in fields if field in columns]
+        need_blob = len(column_fields) != len(fields)
+
+        selected = [Nodes.id, Nodes.provisioned]
+        selected += [columns[field] for field in column_fields]
+        if need_blob:
+            selected.append(Nodes.blob)
+
+        results = []
+
+        try:
+            with self.session_scope() as session:
+
+                stmt = select(selected)
+                stmt = stmt.where(Nodes.provisioned.in_(owner_names))
+                stmt = stmt.order_by(Nodes.id)
 
-                    try:
-                        result["field"] = getattr(node, field)
-                    except AttributeError:
+                for node in session.execute(stmt):
+                    blob = None
+                    if need_blob:
                         blob = json.loads(node.blob)
-                        if field in blob:
-                            result["field"] = blob[field]
+
+                    row = [node.id, node.provisioned]
+                    for field in fields:
+                        if field in columns:
+                            row.append(getattr(node, field))
+                        elif field in blob:
+                            row.append(blob[field])
                         else:
                             msg = "field %s does not exist" % (field, )
                             return {'status': 400, 'message': msg}
 
-                    results.append(result)
+                    results.append(row)
+
+                if DEBUG:
+                    print("There are %d entries provisioned by %s"
+                          % (len(results), owner_names,))
+
+                if len(results) == 0:
+                    if self.preempted(session, owner_names):
+                        return {'status': 410,
+                                'message': '%s had its nodes preempted'
+                                           % ",".join(owner_names)}
+                    return {'status': 404,
+                            'message': '%s does not own any nodes'
+                                       % ",".join(owner_names)}
 
         except Exception as e:
 
             if DEBUG:
-                print("Exception caught in get_field: %s" % (e,))
+                print("Exception caught in get_fields: %s" % (e,))
 
             # Don't send the exception object as it is not json serializable!
             return {'status': 400, 'message': str(e)}
 
-        return {'status': 200, 'result': results}
+        return {'status': 200,
+                'fields': ['id', 'provisioned'] + fields,
+                'result': results}
+
+    def preempted(self, session, owner_names):
+        """Return whether the nodes of every owner were last preempted"""
+
+        stmt = select([Changes.provisioned, Changes.kind])
+        stmt = stmt.where(Changes.provisioned.in_(owner_names))
+        stmt = stmt.order_by(Changes.seq)
+
+        # Later changes overwrite earlier ones
+        kinds = dict(session.execute(stmt).fetchall())
+
+        return all([kinds.get(owner) == "preempted"
+                    for owner in owner_names])
 
     def set_field(self, node_id, key, value, python_type):
         """Given an identifying id, set specified key to the passed value. """
 
         try:
-            with self.session_scope() as session, \
-                    self.connection_scope() as conn:
+            with self.session_scope() as session:
 
                 if python_type.upper().lower() == "string":
                     pass
@@ -1012,7 +2651,9 @@ class DataBase(object):
                 stmt = stmt.where(Nodes.id == node_id)
                 stmt = stmt.values(**kv)
 
-                conn.execute(stmt)
+                session.execute(stmt)
+
+                self.record_change(session, "updated", [node_id])
 
         except Exception as e:
 
@@ -1024,274 +2665,665 @@ class DataBase(object):
 
         return {'status': 200}
 
-    def setup_status(self, **status_map):
-        """Setup the status formatting strings.
-
-        Which depends on the skipped elements, lengths, and types.
-        """
-
-        ei = status_map["element_info"]
-
-        rs = "+"
-        for (_, length, _, skip) in ei:
-            if skip:
-                continue
-            rs += '-' * (1 + length + 1) + "+"
+    def status(self, output_type, columns=None, since=None):
+        """Return a table that details the state of each bare metal node."""
 
-        dl = "+"
-        for (field, length, _, skip) in ei:
-            if skip:
-                continue
-            dl += (" " + field + ' ' * (length - len(field)) + " +")
+        return self.render_status(BLOB_STATUS, output_type, columns, since)
 
-        index = 0
-        fl = "|"
-        for (_, length, special_fmt, skip) in ei:
-            if skip:
-                continue
-            if special_fmt is int:
-                fl += " {%d:<%d} |" % (index, length)
-            elif special_fmt is str:
-                fl += " {%d:%d} |" % (index, length)
-            elif special_fmt is float:
-                fl += " {%d:<%d.%d} |" \
-                      % (index, length, length - 2)
-            index += 1
-
-        index = 0
-        flc = ""
-        for (_, length, special_fmt, skip) in ei:
-            if skip:
-                continue
-            if special_fmt is int:
-                flc += "{%d}," % (index, )
-            elif special_fmt is str:
-                flc += "{%d}," % (index, )
-            elif special_fmt is float:
-                flc += "{%d}," % (index, )
-            index += 1
-
-        status_map["result_separator"] = rs
-        status_map["description_line"] = dl
-        status_map["format_line"] = fl
-        status_map["format_line_csv"] = flc
-
-        return status_map
-
-    def status(self, output_type):
+    def status_baremetal(self, output_type, columns=None, since=None):
         """Return a table that details the state of each bare metal node.
 
-        Currently this table is being created manually, there is probably a
-        better way to be doing this.
+        The blob is expanded into the IPMI and hardware fields.
+        """
+
+        return self.render_status(BAREMETAL_STATUS,
+                                  output_type,
+                                  columns,
+                                  since)
+
+    def render_status(self, table, output_type, columns, since=None):
+        """Render table, of the columns given or of every column.
+
+        output_type is either human, for an ASCII table, or csv.  The
+        response's version is the seq of the newest change, in the epoch of
+        the database.  Given the version of an earlier response as since,
+        only the nodes changed after it are rendered and the ids of those
+        removed are listed.  If those changes are no longer known, or the
+        database was deleted since, every node is rendered and reset is
+        True.
         """
 
         output_type = output_type.upper().lower()
 
-        if output_type == "csv":
-            return self.status_csv(self.blob_status_elements,
-                                   **self.blob_status)
-        elif output_type == "human":
-            return self.status_full(self.blob_status_elements,
-                                    **self.blob_status)
-        else:
+        if output_type not in ("csv", "human"):
             return {'status': 400,
                     'message': "Unknown --type=%s" % (output_type, )}
 
-    def status_baremetal(self, output_type):
-        """Return a table that details the state of each bare metal node.
+        try:
+            selected = table.select(columns)
 
-        Currently this table is being created manually, there is probably a
-        better way to be doing this.
-        """
+            with self.session_scope() as session:
 
-        output_type = output_type.upper().lower()
+                epoch = self.epoch(session)
+                stmt = select([func.min(Changes.seq), func.max(Changes.seq)])
+                (oldest, version) = session.execute(stmt).first()
+                version = version or 0
+
+                # Whether every change after since is still known
+                reset = False
+                if since is not None:
+                    (since_epoch, since) = parse_version(since)
+                    reset = not (since_epoch in (None, epoch)
+                                 and (since == version
+                                      or (oldest is not None
+                                          and oldest - 1 <= since < version)))
+
+                stmt = select(table.db_columns(selected))
+                removed = []
+                if since is not None and not reset:
+                    changed = select([Changes.node_id])
+                    changed = changed.where(Changes.seq > since)
+                    stmt = stmt.where(Nodes.id.in_(changed))
+
+                    gone = select([Changes.node_id]).distinct()
+                    gone = gone.where(Changes.seq > since)
+                    gone = gone.where(~Changes.node_id.in_(
+                        select([Nodes.id])))
+                    gone = gone.order_by(Changes.node_id)
+                    removed = [row[0] for row in session.execute(gone)]
+
+                rows = session.execute(stmt)
+
+                if output_type == "csv":
+                    result = table.render_csv(rows, selected)
+                else:
+                    result = table.render_human(rows, selected)
 
-        if output_type == "csv":
-            return self.status_csv(self.baremetal_status_elements,
-                                   **self.baremetal_status)
-        elif output_type == "human":
-            return self.status_full(self.baremetal_status_elements,
-                                    **self.baremetal_status)
-        else:
+        except Exception as e:
+
+            if DEBUG:
+                print("Exception caught in status: %s" % (e,))
+
+            # Don't send the exception object as it is not json serializable!
+            return {'status': 400, 'message': str(e)}
+
+        response = {'status': 200,
+                    'result': result,
+                    'version': make_version(epoch, version)}
+        if since is not None:
+            response['reset'] = reset
+            response['removed'] = removed
+
+        return response
+
+
+def manifest_response(response, render=False):
+    """Return the allocate_manifest response of an allocate response"""
+    nodes = {}
+    for (key, node) in response['nodes'].items():
+        manifest = json.loads(node.pop('blob'))
+        manifest.update(node)
+        nodes[key] = manifest
+
+    warm = response.get('warm')
+    response = {'status': 200, 'nodes': nodes, 'count': len(nodes)}
+    if warm is not None:
+        response['warm'] = warm
+
+    if render:
+        try:
+            ordered = [nodes[key] for key
+                       in sorted(nodes, key=lambda k: nodes[k]['id'])]
+            response['hardware_info'] = render_hardware_info(ordered)
+            response['localrc'] = render_localrc(ordered)
+        except KeyError as e:
             return {'status': 400,
-                    'message': "Unknown --type=%s" % (output_type, )}
+                    'message': 'node is missing field %s' % (e, )}
+
+    return response
 
-    def blob_status_elements(self, node, timeString):
 
-        blob = json.loads(node.blob)
+def replay_record(response):
+    """Return what is saved to replay a response.
 
-        return (node.id,
-                node.name,
-                node.ipmi_ip,
-                blob,
-                node.status,
-                node.provisioned,
-                timeString,
-                node.node_pool)
+    The nodes are saved as their ids and read back from the Nodes table
+    when replayed, so their credentials are not copied into Requests.  Nor
+    are the rendered hardware_info and localrc, which are rendered again.
+    The owner of the nodes is saved too, to check that it still holds them.
+    """
+    record = dict(response)
 
-    def baremetal_status_elements(self, node, timeString):
+    nodes = record.pop('nodes', None)
+    if nodes is not None:
+        record['node_ids'] = sorted([node['id'] for node in nodes.values()])
+        for node in nodes.values():
+            record['owner'] = node['provisioned']
 
-        blob = json.loads(node.blob)
+    if record.pop('hardware_info', None) is not None:
+        record.pop('localrc', None)
+        record['render'] = True
 
-        return (node.id,
-                node.name,
-                node.ipmi_ip,
-                blob["ipmi_user"],
-                blob["ipmi_password"],
-                blob["port_hwaddr"],
-                blob["cpu_arch"],
-                blob["cpus"],
-                blob["ram_mb"],
-                blob["disk_gb"],
-                node.status,
-                node.provisioned,
-                timeString,
-                node.node_pool)
+    return record
 
-    def status_csv(self, get_status_elements, **status_map):
-        """Return a comma separated list of values"""
 
-        result = ""
+def render_hardware_info(nodes):
+    """Return the devstack hardware_info lines for a list of node manifests"""
+    fmt = "%(ipmi_ip)s %(port_hwaddr)s %(ipmi_user)s %(ipmi_password)s\n"
 
-        ei = status_map["element_info"]
-        flc = status_map["format_line_csv"]
+    return "".join([fmt % node for node in nodes])
 
-        try:
-            with self.session_scope() as session:
 
-                query = session.query(Nodes)
+def render_localrc(nodes):
+    """Return the devstack localrc settings for a list of node manifests
 
-                for node in query:
+    The hardware properties are taken from the first node while the
+    allocation pool covers the IPs of every node.
+    """
+    fmt = ("IRONIC_HW_ARCH=%(cpu_arch)s\n"
+           + "IRONIC_HW_NODE_CPU=%(cpus)s\n"
+           + "IRONIC_HW_NODE_RAM=%(ram_mb)s\n"
+           + "IRONIC_HW_NODE_DISK=%(disk_gb)s\n")
 
-                    try:
+    pairs = []
+    for node in nodes:
+        for ip in node["allocation_pool"].split(","):
+            if ip:
+                pairs.append("start=%s,end=%s" % (ip, ip))
+    allocation_pool = " --allocation-pool ".join(pairs)
 
-                        timeString = ""
-                        try:
-                            if node.timestamp is not None:
-                                et = datetime.utcnow() - node.timestamp
-                                timeString = str(et)
-                        except Exception:
-                            pass
+    return (fmt % nodes[0]
+            + "ALLOCATION_POOL=\"%s\"\n" % (allocation_pool, ))
 
-                        elements = get_status_elements(node, timeString)
 
-                        new_elements = []
-                        index = 0
-                        for (_, _, _, skip) in ei:
-                            if not skip:
-                                new_elements.append(elements[index])
-                            index += 1
+class StatusTable(object):
+    """A status table, compiled once when this module is imported.
 
-                        result += flc.format(*new_elements) + "\n"
+    columns is a list of (name, getter, fields) tuples.  getter(node, blob,
+    now) returns the value of the column for a row, given the node's
+    decoded blob and the current time.  fields are the Nodes columns the
+    getter reads, so that only those are selected.
+    """
 
-                    except KeyError:
+    # Shown in place of a row whose blob lacks a field of the table
+    MISSING = "blob missing baremetal fields"
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = [name for (name, _, _) in columns]
+
+    def select(self, names=None):
+        """Return the columns called names, in order, or every column"""
+        if not names:
+            return self.columns
+
+        if not isinstance(names, list):
+            names = names.split(",")
+
+        by_name = dict(zip(self.names, self.columns))
+        selected = []
+        for name in names:
+            if name not in by_name:
+                raise ValueError("Unknown column %s, expecting one of %s"
+                                 % (name, ",".join(self.names), ))
+            selected.append(by_name[name])
+
+        return selected
+
+    def db_columns(self, selected):
+        """Return the Nodes columns which the selected columns read"""
+        fields = set()
+        for (_, _, column_fields) in selected:
+            fields.update(column_fields)
+
+        return [column for column in NODE_COLUMNS if column.name in fields]
+
+    def cells(self, rows, selected):
+        """Yield the strings of each row, or None if it is missing one of
+        its blob's fields"""
+        now = datetime.utcnow()
+        getters = [getter for (_, getter, _) in selected]
+        need_blob = any('blob' in fields for (_, _, fields) in selected)
+
+        for node in rows:
+            blob = None
+            if need_blob:
+                blob = json.loads(node.blob)
+            try:
+                yield [str(getter(node, blob, now)) for getter in getters]
+            except KeyError:
+                yield None
+
+    def render_csv(self, rows, selected):
+        """Return a line of comma separated values for every row"""
+        lines = [self.MISSING if row is None else ",".join(row) + ","
+                 for row in self.cells(rows, selected)]
+        lines.append("")
+
+        return "\n".join(lines)
+
+    def render_human(self, rows, selected):
+        """Return an ASCII table of the rows, as wide as its widest cells"""
+        cells = list(self.cells(rows, selected))
+
+        widths = [len(name) for (name, _, _) in selected]
+        for row in cells:
+            if row is not None:
+                widths = [max(width, len(cell))
+                          for (width, cell) in zip(widths, row)]
+
+        separator = "+" + "+".join(["-" * (width + 2)
+                                    for width in widths]) + "+"
+        description = "+" + "+".join([" %s " % (name.ljust(width), )
+                                      for ((name, _, _), width)
+                                      in zip(selected, widths)]) + "+"
+        template = "|" + "|".join([" {%d:<%d} " % (index, width, )
+                                   for (index, width)
+                                   in enumerate(widths)]) + "|"
+
+        lines = [separator, description, separator]
+        lines.extend([self.MISSING if row is None else template.format(*row)
+                      for row in cells])
+        lines.extend([separator, ""])
+
+        return "\n".join(lines)
+
+
+def node_field(name):
+    """Return a status getter of a Nodes column"""
+    return (lambda node, blob, now: getattr(node, name))
+
+
+def blob_field(name):
+    """Return a status getter of a field of the blob"""
+    return (lambda node, blob, now: blob[name])
+
+
+def elapsed_time(node, blob, now):
+    """Status getter of how long a node has been allocated"""
+    if node.timestamp is None:
+        return ""
+    try:
+        return now - node.timestamp
+    except TypeError:
+        return ""
+
+
+BLOB_STATUS = StatusTable([
+    ("id", node_field("id"), ["id"]),
+    ("name", node_field("name"), ["name"]),
+    ("ipmi_ip", node_field("ipmi_ip"), ["ipmi_ip"]),
+    ("blob", lambda node, blob, now: blob, ["blob"]),
+    ("status", node_field("status"), ["status"]),
+    ("provisioned", node_field("provisioned"), ["provisioned"]),
+    ("time", elapsed_time, ["timestamp"]),
+    ("node_pool", node_field("node_pool"), ["node_pool"]),
+])
+
+BAREMETAL_STATUS = StatusTable([
+    ("id", node_field("id"), ["id"]),
+    ("name", node_field("name"), ["name"]),
+    ("ipmi_ip", node_field("ipmi_ip"), ["ipmi_ip"]),
+    ("ipmi_user", blob_field("ipmi_user"), ["blob"]),
+    ("ipmi_password", blob_field("ipmi_password"), ["blob"]),
+    ("port_hwaddr", blob_field("port_hwaddr"), ["blob"]),
+    ("cpu_arch", blob_field("cpu_arch"), ["blob"]),
+    ("cpus", blob_field("cpus"), ["blob"]),
+    ("ram_mb", blob_field("ram_mb"), ["blob"]),
+    ("disk_gb", blob_field("disk_gb"), ["blob"]),
+    ("status", node_field("status"), ["status"]),
+    ("provisioned", node_field("provisioned"), ["provisioned"]),
+    ("time", elapsed_time, ["timestamp"]),
+    ("node_pool", node_field("node_pool"), ["node_pool"]),
+])
+
+
+def unix_listener(conf, handler_class):
+    """Return a UnixHTTPServer on socket_path, or None if it is not set"""
+    socket_path = conf.get('socket_path')
+    if not socket_path:
+        return None
+
+    print('Listening... to %s' % (socket_path,))
+    return UnixHTTPServer(socket_path,
+                          handler_class,
+                          conf.get('socket_mode', 0o660))
+
+
+def serve(conf, handler_class, local, server_class=ThreadingHTTPServer):
+    """Serve the MoltenIron port, and local if it is set, forever"""
+    mi_addr = str(conf['serverIP'])
+    mi_port = int(conf['mi_port'])
 
-                        result += "blob missing baremetal fields\n"
+    if local is not None:
+        thread = threading.Thread(target=local.serve_forever)
+        thread.daemon = True
+        thread.start()
 
-        except Exception as e:
+    print('Listening... to %s:%d' % (mi_addr, mi_port,))
+    moltenirond = server_class((mi_addr, mi_port), handler_class)
+    moltenirond.serve_forever()
 
-            if DEBUG:
-                print("Exception caught in status: %s" % (e,))
 
-            # Don't send the exception object as it is not json serializable!
-            return {'status': 400, 'message': str(e)}
+def listener(conf):
+    """HTTP listener"""
+    handler_class = MakeMoltenIronHandlerWithConf(conf)
+    local = unix_listener(conf, handler_class)
+    cleaner = start_cleaner(conf)
+    try:
+        serve(conf, handler_class, local)
+    finally:
+        if cleaner is not None:
+            cleaner.stop()
+        if local is not None:
+            local.server_close()
+
+
+def describe_exit(status):
+    """Returns how a process ended, given its status from os.wait"""
+    if os.WIFSIGNALED(status):
+        return "was killed by signal %d" % (os.WTERMSIG(status), )
+    return "exited with status %d" % (os.WEXITSTATUS(status), )
+
+
+class Supervisor(object):
+    """Runs worker processes which all serve the MoltenIron port.
+
+    Every worker binds the port with SO_REUSEPORT, so requests are handled
+    by several processes at once.  A worker which dies is started again.
+    The Unix socket, if there is one, is bound once before the workers are
+    started and is shared by all of them.  The first worker also runs the
+    Cleaner.  Sending SIGTERM or SIGINT to the supervisor stops every
+    worker.
+    """
 
-        return {'status': 200, 'result': result}
+    # A worker which dies sooner than this after starting is probably
+    # failing to start, so wait this long before starting it again
+    RESTART_DELAY = 1.0
 
-    def status_full(self, get_status_elements, **status_map):
-        """Return an ASCII table of the database entries"""
+    def __init__(self, conf, workers):
+        self.conf = conf
+        self.workers = workers
+        self.handler_class = MakeMoltenIronHandlerWithConf(conf)
+        self.local = None
+        self.pids = {}
+        self.started = {}
+        self.stopping = False
 
-        result = ""
+    def run(self):
+        """Start the workers and keep them running until told to stop"""
+        # Create the tables now, so that the workers do not race to
+        database = DataBase(self.conf)
+        database.close()
+        del database
 
-        ei = status_map["element_info"]
-        rs = status_map["result_separator"]
-        dl = status_map["description_line"]
-        fl = status_map["format_line"]
+        self.local = unix_listener(self.conf, self.handler_class)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
 
         try:
-            with self.session_scope() as session:
+            for index in range(self.workers):
+                self.spawn(index)
 
-                query = session.query(Nodes)
+            while self.pids:
+                (pid, status) = os.wait()
+                index = self.pids.pop(pid, None)
+                if index is None or self.stopping:
+                    continue
 
-                result += rs + "\n"
-                result += dl + "\n"
-                result += rs + "\n"
+                log(self.conf,
+                    "worker %d (pid %d) %s"
+                    % (index, pid, describe_exit(status), ))
 
-                for node in query:
+                if time.time() - self.started[index] < self.RESTART_DELAY:
+                    time.sleep(self.RESTART_DELAY)
+                if not self.stopping:
+                    self.spawn(index)
+        finally:
+            if self.local is not None:
+                self.local.server_close()
+
+    def spawn(self, index):
+        """Start worker index in a new process"""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                if index == 0:
+                    start_cleaner(self.conf)
+                serve(self.conf,
+                      self.handler_class,
+                      self.local,
+                      ReusePortHTTPServer)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                # Never return into the supervisor's code
+                os._exit(status)
+
+        self.pids[pid] = index
+        self.started[index] = time.time()
+
+    def stop(self, signum, _frame):
+        """Stop every worker, the supervisor exits once they have"""
+        self.stopping = True
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
 
-                    try:
 
-                        timeString = ""
-                        try:
-                            if node.timestamp is not None:
-                                et = datetime.utcnow() - node.timestamp
-                                timeString = str(et)
-                        except Exception:
-                            pass
+def ipmi_power_cycle(conf, node, timeout):
+    """Clean action which power cycles the node through its BMC.
 
-                        elements = get_status_elements(node, timeString)
+    The ipmitool command may be configured with ipmitool, for example to
+    point it at a fake BMC.  The password is passed in the environment
+    rather than on the command line.
+    """
+    blob = json.loads(node['blob'])
 
-                        new_elements = []
-                        index = 0
-                        for (_, _, _, skip) in ei:
-                            if not skip:
-                                new_elements.append(elements[index])
-                            index += 1
+    command = shlex.split(conf.get('ipmitool', 'ipmitool'))
+    command += ['-I', 'lanplus',
+                '-H', node['ipmi_ip'],
+                '-U', blob['ipmi_user'],
+                '-E',
+                'chassis', 'power', 'cycle']
 
-                        result += fl.format(*new_elements) + "\n"
+    env = dict(os.environ)
+    env['IPMI_PASSWORD'] = blob['ipmi_password']
 
-                    except KeyError:
+    subprocess.run(command,
+                   env=env,
+                   stdout=subprocess.PIPE,
+                   stderr=subprocess.PIPE,
+                   timeout=timeout,
+                   check=True)
 
-                        result += "blob missing baremetal fields\n"
 
-                result += rs + "\n"
+# Power cycling leaves the image on the node's disk
+ipmi_power_cycle.reimages = False
 
-        except Exception as e:
 
-            if DEBUG:
-                print("Exception caught in status: %s" % (e,))
+def run_script(conf, node, timeout):
+    """Clean action which runs cleanScript.
 
-            # Don't send the exception object as it is not json serializable!
-            return {'status': 400, 'message': str(e)}
+    The node's columns are passed in the environment as MI_<COLUMN>, for
+    example MI_IPMI_IP and MI_BLOB.  The node is cleaned if the script
+    exits with 0.
+    """
+    env = dict(os.environ)
+    for (key, value) in node.items():
+        if value is not None:
+            env['MI_%s' % (key.upper(), )] = str(value)
 
-        return {'status': 200, 'result': result}
+    subprocess.run(shlex.split(conf['cleanScript']),
+                   env=env,
+                   stdout=subprocess.PIPE,
+                   stderr=subprocess.PIPE,
+                   timeout=timeout,
+                   check=True)
 
 
-def listener(conf):
-    """HTTP listener"""
-    mi_addr = str(conf['serverIP'])
-    mi_port = int(conf['mi_port'])
-    handler_class = MakeMoltenIronHandlerWithConf(conf)
-    print('Listening... to %s:%d' % (mi_addr, mi_port,))
-    moltenirond = HTTPServer((mi_addr, mi_port), handler_class)
-    moltenirond.serve_forever()
+# The clean actions which cleanAction may name.  It may also name any other
+# action as "module:function".
+CLEAN_ACTIONS = {'ipmi': ipmi_power_cycle,
+                 'script': run_script}
 
 
-def cleanup():
-    """This function kills any running instances of molten iron.
+def clean_action(name):
+    """Return the clean action called name.
 
-    This should be called when starting a new instance of molten iron.
+    A clean action is called with the conf, the node map and the timeout in
+    seconds, and raises an exception if it could not clean the node.  It
+    may set a reimages attribute to say whether it wipes the node's image.
     """
-    ps = os.popen("ps aux | grep python | grep moltenIronD.py").read()
-    processes = ps.split("\n")
-    pids = []
-    for process in processes:
-        if "grep" in process:
-            continue
-        words = process.split(" ")
-        actual = []
-        for word in words:
-            if word != "":
-                actual += [word]
-        words = actual
-        if len(words) > 1:
-            pids += [words[1]]
-    myPID = os.getpid()
-
-    for pid in pids:
-        if int(pid) == int(myPID):
-            continue
-        os.system("kill -9 " + pid)
+    if name in CLEAN_ACTIONS:
+        return CLEAN_ACTIONS[name]
+
+    (module, _, function) = name.partition(":")
+    if not function:
+        raise ValueError("Unknown cleanAction %s, expecting one of %s or"
+                         " module:function"
+                         % (name, ",".join(sorted(CLEAN_ACTIONS)), ))
+
+    return getattr(importlib.import_module(module), function)
+
+
+class Cleaner(object):
+    """Cleans the nodes which have been released, in the background.
+
+    Released nodes wait in the "cleaning" status until cleanAction has
+    cleaned them, when they become "ready", or has failed cleanRetries + 1
+    times, when they become "failed".  At most cleanWorkers nodes are
+    cleaned at once, and at most cleanConcurrency of any one pool, and each
+    attempt may take up to cleanTimeout seconds.
+
+    A cleaned node keeps its image, for image affinity, unless cleanReimages
+    or else the action's reimages attribute says that cleaning wipes it.
+
+    Only the thread calling poll uses the database, the worker threads only
+    run the clean action.
+    """
+
+    def __init__(self, conf, action=None):
+        self.conf = conf
+        if action is None:
+            action = clean_action(conf['cleanAction'])
+        self.action = action
+        self.reimages = bool(conf.get('cleanReimages',
+                                      getattr(action, 'reimages', False)))
+        self.workers = int(conf.get('cleanWorkers', 4))
+        self.per_pool = int(conf.get('cleanConcurrency', 2))
+        self.timeout = float(conf.get('cleanTimeout', 600))
+        self.retries = int(conf.get('cleanRetries', 2))
+        self.interval = float(conf.get('cleanInterval', 5))
+        self.executor = ThreadPoolExecutor(self.workers)
+        # The (node_pool, future) of each node being cleaned, by id
+        self.running = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Clean nodes in a new thread until stopped"""
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop cleaning, leaving the nodes being cleaned to be retried"""
+        self.stopping.set()
+        with CHANGES:
+            CHANGES.notify_all()
+        self.executor.shutdown(wait=False)
+
+    def run(self):
+        """Poll for nodes to clean, waking up when a node changes"""
+        database = DataBase(self.conf)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.poll(database)
+                except Exception as e:
+                    log(self.conf, "cleaner failed to poll: %s" % (e, ))
+                with CHANGES:
+                    CHANGES.wait(self.interval)
+        finally:
+            database.close()
+
+    def poll(self, database):
+        """Record the cleanings which have finished and start new ones.
+
+        Returns how many nodes are still being cleaned.
+        """
+        for (node_id, (_, future)) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[node_id]
+            if future.exception() is None:
+                database.doClean(node_id, self.reimages)
+            else:
+                database.fail_clean(node_id)
+
+        for node in database.unclean_nodes():
+            if len(self.running) >= self.workers:
+                break
+            if node['id'] in self.running:
+                continue
+            busy = [pool for (pool, _) in self.running.values()
+                    if pool == node['node_pool']]
+            if len(busy) >= self.per_pool:
+                continue
+
+            log(self.conf, "cleaning node %d" % (node['id'], ))
+            future = self.executor.submit(self.clean, node)
+            future.add_done_callback(self.wake)
+            self.running[node['id']] = (node['node_pool'], future)
+
+        return len(self.running)
+
+    def clean(self, node):
+        """Run the clean action on node, retrying it if it fails"""
+        for attempt in range(self.retries + 1):
+            try:
+                self.action(self.conf, node, self.timeout)
+                return
+            except Exception as e:
+                log(self.conf,
+                    "cleaning node %d failed, attempt %d: %s"
+                    % (node['id'], attempt + 1, e, ))
+                if attempt == self.retries:
+                    raise
+
+    def wake(self, _future):
+        """Wake the polling thread to record a finished cleaning"""
+        with CHANGES:
+            CHANGES.notify_all()
+
+
+def start_cleaner(conf):
+    """Start a Cleaner if cleanAction is set, returns it or None"""
+    if not conf.get('cleanAction'):
+        return None
+
+    cleaner = Cleaner(conf)
+    cleaner.start()
+
+    return cleaner
+
+
+def moltenirond_main(conf, workers=None):
+    """Serve requests with conf['workers'] processes, or workers if set"""
+    if workers is None:
+        workers = int(conf.get('workers', 1))
+
+    if workers > 1:
+        Supervisor(conf, workers).run()
+    else:
+        listener(conf)
 
 
 def log(conf, message):
@@ -1348,6 +3380,12 @@ if __name__ == "__main__":
                         type=str,
                         dest="conf_dir",
                         help="The directory where configuration is stored")
+    parser.add_argument("-w",
+                        "--workers",
+                        action="store",
+                        type=int,
+                        dest="workers",
+                        help="How many worker processes to run")
 
     args = parser.parse_args()
 
@@ -1357,11 +3395,8 @@ if __name__ == "__main__":
             print(msg, file=sys.stderr)
             sys.exit(1)
 
-        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
-    else:
-        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+    YAML_CONF = config.conf_path(args.conf_dir)
 
-    with open(YAML_CONF, "r") as fobj:
-        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+    conf = config.load_conf(YAML_CONF)
 
-        listener(conf)
+    moltenirond_main(conf, args.workers)
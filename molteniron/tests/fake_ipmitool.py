@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+A fake BMC, which stands in for ipmitool so that cleaning may be tested
+without hardware.
+
+Every command is appended, as a line of JSON, to the file named by
+FAKE_BMC_LOG along with when it started and ended.  A command takes
+FAKE_BMC_DELAY seconds.  Commands to the hosts listed in FAKE_BMC_FAIL fail
+and those to the hosts listed in FAKE_BMC_HANG never finish.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def hosts(name):
+    """Return the hosts listed in the environment variable name"""
+    return [host for host in os.environ.get(name, "").split(",") if host]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("-I", dest="interface")
+    parser.add_argument("-H", dest="host", required=True)
+    parser.add_argument("-U", dest="user")
+    parser.add_argument("-E", dest="env_password", action="store_true")
+    parser.add_argument("command", nargs="+")
+
+    args = parser.parse_args()
+
+    start = time.time()
+
+    if args.host in hosts("FAKE_BMC_HANG"):
+        time.sleep(3600)
+
+    time.sleep(float(os.environ.get("FAKE_BMC_DELAY", 0)))
+
+    password = None
+    if args.env_password:
+        password = os.environ.get("IPMI_PASSWORD")
+
+    with open(os.environ["FAKE_BMC_LOG"], "a") as fobj:
+        fobj.write(json.dumps({"host": args.host,
+                               "user": args.user,
+                               "password": password,
+                               "command": args.command,
+                               "start": start,
+                               "end": time.time()}) + "\n")
+
+    if args.host in hosts("FAKE_BMC_FAIL"):
+        print("Error: Unable to establish IPMI v2 / RMCP+ session",
+              file=sys.stderr)
+        sys.exit(1)
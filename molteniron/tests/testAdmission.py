@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Tests turning requests away when the server or an owner is too busy.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import asyncio
+import json
+import time
+
+from molteniron import aiomolteniron
+from molteniron import molteniron
+from molteniron import moltenirond
+
+
+async def busy_server(replies):
+    """Check that the asyncio client retries the requests which a server
+    turns away, and only those, after the server's Retry-After
+
+    replies is the list of (status, Retry-After) to answer requests with,
+    in turn, returns the request maps which were received.
+    """
+    received = []
+    handlers = []
+
+    async def handle(reader, writer):
+        handlers.append(asyncio.current_task())
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            length = 0
+            while line not in (b"\r\n", b""):
+                line = await reader.readline()
+                (name, _, value) = line.decode("latin-1").partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            request = json.loads(await reader.readexactly(length))
+            received.append(request)
+            (status, retry_after) = replies.pop(0)
+            body = json.dumps({'status': status,
+                               'owner': request.get('owner_name')})
+            head = "HTTP/1.1 %d Whatever\r\n" % (status, )
+            if retry_after is not None:
+                head += "Retry-After: %s\r\n" % (retry_after, )
+            head += "Content-Length: %d\r\n\r\n" % (len(body), )
+            writer.write((head + body).encode("latin-1"))
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    conf = {'serverIP': "127.0.0.1", 'mi_port': port, 'retry': 2}
+
+    async with aiomolteniron.AsyncMoltenIron(conf) as client:
+        # The request is sent again after at least Retry-After
+        replies.extend([(503, "1"), (200, None)])
+        start = time.time()
+        ret = await client.allocate("hamzy", 1)
+        print(ret)
+        assert ret == {'status': 200, 'owner': "hamzy"}
+        assert time.time() - start >= 1
+        assert len(received) == 2
+        assert received[0] == received[1]
+
+        # Only the pipelined request which was turned away is sent again
+        del received[:]
+        replies.extend([(200, None), (429, "0"), (200, None)])
+        pipe = client.pipeline()
+        pipe.allocate("hamzy", 1)
+        pipe.allocate("mjturek", 1)
+        ret = await pipe.execute()
+        print(ret)
+        assert ret == [{'status': 200, 'owner': "hamzy"},
+                       {'status': 200, 'owner': "mjturek"}]
+        assert [request['owner_name'] for request in received] == \
+            ["hamzy", "mjturek", "mjturek"]
+
+        # After retry retries, the server's answer is returned
+        del received[:]
+        replies.extend([(503, "0")] * 3)
+        ret = await client.allocate("hamzy", 1)
+        print(ret)
+        assert ret == {'status': 503, 'owner': "hamzy"}
+        assert len(received) == 3
+
+    # The handlers stop once the client has closed its connections
+    await asyncio.gather(*handlers)
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+
+    # Two requests at once, then one a second
+    owners = moltenirond.RateLimiter(1, 2)
+    assert owners.admit("hamzy", 100.0) == 0
+    assert owners.admit("hamzy", 100.0) == 0
+    ret = owners.admit("hamzy", 100.0)
+    print(ret)
+    assert ret == 1.0
+    # Every owner has its own bucket
+    assert owners.admit("mjturek", 100.0) == 0
+    ret = owners.admit("hamzy", 100.5)
+    assert 0 < ret < 1.0
+    assert owners.admit("hamzy", 101.0) == 0
+    assert owners.admit("hamzy", 101.0) > 0
+    # The bucket fills up to burst, no more
+    assert owners.admit("hamzy", 200.0) == 0
+    assert owners.admit("hamzy", 200.0) == 0
+    assert owners.admit("hamzy", 200.0) > 0
+
+    # Full buckets are forgotten
+    owners.MAX_BUCKETS = 2
+    assert owners.admit("owner1", 300.0) == 0
+    assert owners.admit("owner2", 300.0) == 0
+    assert sorted(owners.buckets) == ["owner1", "owner2"]
+
+    # A rate of 0 admits everything
+    owners = moltenirond.RateLimiter(0, 10)
+    for _ in range(100):
+        assert owners.admit("hamzy") == 0
+
+    assert moltenirond.retry_after(0.01) == "1"
+    assert moltenirond.retry_after(1.0) == "1"
+    assert moltenirond.retry_after(2.5) == "3"
+
+    client = molteniron.Client({'serverIP': "127.0.0.1", 'mi_port': 5656})
+    for attempt in range(10):
+        limit = min(client.MAX_RETRY_DELAY,
+                    client.RETRY_DELAY * 2 ** attempt)
+        for _ in range(20):
+            delay = client.backoff(attempt)
+            assert 0 <= delay <= limit
+            delay = client.backoff(attempt, "2")
+            assert 2 <= delay <= 2 + limit
+            # Retry-After may be an HTTP date, which is ignored
+            delay = client.backoff(attempt, "Fri, 31 Dec 1999 23:59:59 GMT")
+            assert 0 <= delay <= limit
+
+    # The asyncio client shares the synchronous client's backoff
+    assert aiomolteniron.AsyncMoltenIron.BUSY_STATUSES == (429, 503)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(busy_server([]))
+    loop.close()
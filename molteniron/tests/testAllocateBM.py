@@ -68,6 +68,8 @@ def compare_provisioned_nodes(lhs, rhs_r, rhs_n):
     del rhs_r['status']
     del rhs_r['timestamp']
     del lhs_r['id']
+    assert lhs_r.pop('priority') == 0
+    assert lhs_r.pop('image') is None
     assert lhs_r == rhs_r
     assert lhs_n == rhs_n
 
@@ -288,3 +290,51 @@ if __name__ == "__main__":
 
     database.close()
     del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    database.delete_db()
+    database.close()
+    del database
+
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request2, node2)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request3, node3)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request5, node5)
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Only one node of the test pool is ready, which is enough
+    ret = database.allocateBM("mjturek", 1, "test", max_nodes=8)
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['count'] == 1
+    assert ret["nodes"]["node_4"]["name"] == request5["name"]
+
+    ret = database.allocateBM("hamzy", 1, max_nodes=8)
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['count'] == 2
+    compare_provisioned_nodes(ret["nodes"]["node_1"], request1, node1)
+    compare_provisioned_nodes(ret["nodes"]["node_2"], request2, node2)
+
+    ret = database.allocateBM("mmedvede", 1, max_nodes=8)
+    print(ret)
+    assert ret == {'status': 404,
+                   'message': ('Not enough available nodes found. '
+                               'Found 0, requested 1')}
+
+    ret = database.allocateBM("mjturek", 2, "test", max_nodes=1)
+    print(ret)
+    assert ret == {'status': 400,
+                   'message': 'max_nodes 1 is less than number_of_nodes 2'}
+
+    database.close()
+    del database
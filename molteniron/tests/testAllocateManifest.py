@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Tests the MoltenIron allocate_manifest command.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    request1 = {
+        "name": "test1",
+        "ipmi_ip": "10.1.2.1",
+        "status": "ready",
+        "provisioned": "",
+        "timestamp": "",
+        "allocation_pool": "10.1.2.3,10.1.2.4"
+    }
+    node1 = {
+        "ipmi_user": "user",
+        "ipmi_password": "password",
+        "port_hwaddr": "de:ad:be:ef:00:01",
+        "cpu_arch": "ppc64el",
+        "cpus": 8,
+        "ram_mb": 2048,
+        "disk_gb": 32
+    }
+    request2 = {
+        "name": "test2",
+        "ipmi_ip": "10.1.2.2",
+        "status": "ready",
+        "provisioned": "",
+        "timestamp": "",
+        "allocation_pool": "10.1.2.5,10.1.2.6"
+    }
+    node2 = {
+        "ipmi_user": "user",
+        "ipmi_password": "password",
+        "port_hwaddr": "de:ad:be:ef:00:02",
+        "cpu_arch": "ppc64el",
+        "cpus": 8,
+        "ram_mb": 2048,
+        "disk_gb": 32
+    }
+
+    hardware_info_good = os.path.join(os.path.dirname(__file__),
+                                      "hardware_info.good")
+    with open(hardware_info_good, "r") as fobj:
+        hardware_info = fobj.read()
+
+    localrc_good = os.path.join(os.path.dirname(__file__),
+                                "localrc.good")
+    with open(localrc_good, "r") as fobj:
+        localrc = fobj.read()
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request2, node2)
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.allocate_manifest("hamzy", 1, render=True)
+    print(ret)
+    assert ret['status'] == 200
+    assert len(ret["nodes"]) == 1
+    node = ret["nodes"]["node_1"]
+    assert "blob" not in node
+    assert node["ipmi_ip"] == request1["ipmi_ip"]
+    assert node["provisioned"] == "hamzy"
+    assert node["allocation_pool"] == request1["allocation_pool"]
+    for key in node1:
+        assert node[key] == node1[key]
+    assert ret["hardware_info"] == hardware_info
+    assert ret["localrc"] == localrc
+
+    ret = database.allocate_manifest("mjturek", 1)
+    print(ret)
+    assert ret['status'] == 200
+    assert len(ret["nodes"]) == 1
+    assert ret["nodes"]["node_2"]["port_hwaddr"] == node2["port_hwaddr"]
+    assert "hardware_info" not in ret
+    assert "localrc" not in ret
+
+    ret = database.allocate_manifest("mmedvede", 1, render=True)
+    print(ret)
+    assert ret == {'status': 404,
+                   'message': ('Not enough available nodes found. '
+                               'Found 0, requested 1')}
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request2, node2)
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.allocate_manifest("hamzy", 2, render=True)
+    print(ret)
+    assert ret['status'] == 200
+    assert len(ret["nodes"]) == 2
+    assert ret["hardware_info"] == ("10.1.2.1 de:ad:be:ef:00:01"
+                                    " user password\n"
+                                    "10.1.2.2 de:ad:be:ef:00:02"
+                                    " user password\n")
+    assert ret["localrc"].endswith("ALLOCATION_POOL=\""
+                                   "start=10.1.2.3,end=10.1.2.3"
+                                   " --allocation-pool"
+                                   " start=10.1.2.4,end=10.1.2.4"
+                                   " --allocation-pool"
+                                   " start=10.1.2.5,end=10.1.2.5"
+                                   " --allocation-pool"
+                                   " start=10.1.2.6,end=10.1.2.6\"\n")
+
+    database.close()
+    del database
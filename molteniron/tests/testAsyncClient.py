@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Tests the MoltenIron asyncio client against a running MoltenIron server.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import asyncio
+import os
+import sys
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import aiomolteniron
+
+
+async def run(conf):
+    """Exercise every kind of request of the asyncio client"""
+
+    async with aiomolteniron.AsyncMoltenIron(conf, 4) as client:
+        ret = await client.delete_db()
+        print(ret)
+        assert ret == {'status': 200}
+
+        ret = await asyncio.gather(*[
+            client.add_baremetal("async%d" % (i, ),
+                                 "10.1.3.%d" % (i, ),
+                                 "user",
+                                 "password",
+                                 "10.1.4.%d" % (i, ),
+                                 "de:ad:be:ef:01:%02d" % (i, ),
+                                 "ppc64el",
+                                 8,
+                                 2048,
+                                 32)
+            for i in range(1, 11)])
+        print(ret)
+        assert ret == [{'status': 200}] * 10
+
+        # Only four connections were used for ten requests
+        assert len(client.idle) <= 4
+
+        ret = await asyncio.gather(*[client.allocate("owner%d" % (i, ), 1)
+                                     for i in range(1, 11)])
+        print(ret)
+        names = set()
+        for response in ret:
+            assert response['status'] == 200
+            assert len(response['nodes']) == 1
+            for node in response['nodes'].values():
+                names.add(node['name'])
+        # Every owner got a different node
+        assert len(names) == 10
+
+        ret = await client.allocate("owner11", 1)
+        print(ret)
+        assert ret['status'] == 404
+
+        pipe = client.pipeline()
+        pipe.get_field("owner1", "name")
+        pipe.get_fields(["owner2", "owner3"], ["name", "cpus"])
+        pipe.release("owner1")
+        pipe.get_field("owner1", "name")
+        ret = await pipe.execute()
+        print(ret)
+        assert len(ret) == 4
+        assert ret[0]['status'] == 200
+        assert ret[1]['status'] == 200
+        assert len(ret[1]['result']) == 2
+        assert ret[2] == {'status': 200}
+        assert ret[3]['status'] == 404
+
+        # The same request_id is only allocated once
+        ret = await asyncio.gather(client.allocate("owner1", 1,
+                                                   request_id="again"),
+                                   client.allocate("owner1", 1,
+                                                   request_id="again"))
+        print(ret)
+        assert ret[0] == ret[1]
+
+        ret = await client.status("csv")
+        print(ret)
+        assert ret['status'] == 200
+
+        ret = await client.delete_db()
+        print(ret)
+        assert ret == {'status': 200}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(conf))
+    loop.close()
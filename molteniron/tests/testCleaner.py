@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+Tests cleaning released nodes with the Cleaner and a fake BMC.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    def request(number, node_pool):
+        """Return the request of node number"""
+        return {
+            "name": "test%d" % (number, ),
+            "ipmi_ip": "10.1.2.%d" % (number, ),
+            "status": "ready",
+            "provisioned": "",
+            "timestamp": "",
+            "allocation_pool": "10.1.3.%d" % (number, ),
+            "node_pool": node_pool
+        }
+
+    node = {
+        "ipmi_user": "user",
+        "ipmi_password": "password",
+        "port_hwaddr": "de:ad:be:ef:00:01",
+        "cpu_arch": "ppc64el",
+        "cpus": 8,
+        "ram_mb": 2048,
+        "disk_gb": 32
+    }
+
+    def node_statuses(database):
+        """Return the status of every node, by id"""
+        ret = database.status_baremetal("csv", "id,status")
+        return dict([line.split(",")[:2]
+                     for line in ret["result"].splitlines() if line])
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    fake_ipmitool = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "fake_ipmitool.py")
+    (fd, bmc_log) = tempfile.mkstemp(prefix="fake-bmc-")
+    os.close(fd)
+
+    os.environ["FAKE_BMC_LOG"] = bmc_log
+    os.environ["FAKE_BMC_DELAY"] = "0.3"
+    os.environ["FAKE_BMC_FAIL"] = "10.1.2.3"
+    os.environ["FAKE_BMC_HANG"] = "10.1.2.5"
+
+    conf["cleanAction"] = "ipmi"
+    conf["ipmitool"] = "%s %s" % (sys.executable, fake_ipmitool, )
+    conf["cleanWorkers"] = 3
+    conf["cleanConcurrency"] = 1
+    conf["cleanTimeout"] = 1
+    conf["cleanRetries"] = 1
+
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for (number, node_pool) in [(1, "x86"), (2, "x86"), (3, "x86"),
+                                (4, "ppc64el"), (5, "ppc64el")]:
+        ret = database.addBMNode(request(number, node_pool), node)
+        print(ret)
+        assert ret == {'status': 200}
+
+    ret = database.allocateBM("hamzy", 3, "x86")
+    print(ret)
+    assert ret['status'] == 200
+    ret = database.allocateBM("mjturek", 2, "ppc64el")
+    print(ret)
+    assert ret['status'] == 200
+
+    # Released nodes wait to be cleaned
+    ret = database.deallocateOwner("hamzy")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.deallocateOwner("mjturek")
+    print(ret)
+    assert ret == {'status': 200}
+    assert node_statuses(database) == {"1": "cleaning",
+                                       "2": "cleaning",
+                                       "3": "cleaning",
+                                       "4": "cleaning",
+                                       "5": "cleaning"}
+
+    cleaner = moltenirond.Cleaner(conf)
+    deadline = time.time() + 60
+    while cleaner.poll(database) or database.unclean_nodes():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    # Node 3 failed twice and node 5 timed out twice
+    assert node_statuses(database) == {"1": "ready",
+                                       "2": "ready",
+                                       "3": "failed",
+                                       "4": "ready",
+                                       "5": "failed"}
+
+    with open(bmc_log, "r") as fobj:
+        calls = [json.loads(line) for line in fobj]
+    print(calls)
+    assert sorted([call["host"] for call in calls]) == ["10.1.2.1",
+                                                        "10.1.2.2",
+                                                        "10.1.2.3",
+                                                        "10.1.2.3",
+                                                        "10.1.2.4"]
+    for call in calls:
+        assert call["command"] == ["chassis", "power", "cycle"]
+        assert call["user"] == "user"
+        assert call["password"] == "password"
+
+    # Only one node of a pool is cleaned at once, but pools are cleaned
+    # side by side
+    def overlap(lhs, rhs):
+        """Return whether two calls ran at the same time"""
+        return lhs["start"] < rhs["end"] and rhs["start"] < lhs["end"]
+
+    x86 = [call for call in calls if call["host"] != "10.1.2.4"]
+    ppc64el = [call for call in calls if call["host"] == "10.1.2.4"]
+    for lhs in x86:
+        for rhs in x86:
+            assert lhs is rhs or not overlap(lhs, rhs)
+    assert any([overlap(lhs, ppc64el[0]) for lhs in x86])
+
+    # Failed nodes are only allocated once an operator cleans them
+    ret = database.allocateBM("hamzy", 4)
+    print(ret)
+    assert ret['status'] == 404
+    ret = database.doClean(3)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.allocateBM("hamzy", 4)
+    print(ret)
+    assert ret['status'] == 200
+
+    ret = database.fail_clean(1)
+    print(ret)
+    assert ret['status'] == 404
+
+    cleaner.stop()
+    database.close()
+    del database
+    os.remove(bmc_log)
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    # Preempted nodes are cleaned before they are allocated again
+    (fd, bmc_log) = tempfile.mkstemp(prefix="fake-bmc-")
+    os.close(fd)
+    os.environ["FAKE_BMC_LOG"] = bmc_log
+
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for number in (1, 2, 4, 6):
+        ret = database.addBMNode(request(number, "x86"), node)
+        print(ret)
+        assert ret == {'status': 200}
+
+    # A node released by someone else is being cleaned
+    ret = database.allocateBM("hamzy", 1, "x86")
+    print(ret)
+    assert ret['status'] == 200
+    ret = database.deallocateOwner("hamzy")
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.allocateBM("periodic", 2, "x86", image="fedora")
+    print(ret)
+    assert sorted(ret['nodes'].keys()) == ["node_2", "node_3"]
+    ret = database.allocateBM("nightly", 1, "x86", priority=5)
+    print(ret)
+    assert sorted(ret['nodes'].keys()) == ["node_4"]
+
+    # That node is not kept for gate, so gate preempts periodic
+    ret = database.allocateBM("gate", 1, "x86", priority=10, image="fedora")
+    print(ret)
+    assert ret == {'status': 404,
+                   'message': ('Not enough available nodes found. '
+                               'Found 0, requested 1. '
+                               '2 preempted nodes are being cleaned')}
+    ret = database.get_field("periodic", "id")
+    print(ret)
+    assert ret['status'] == 410
+    assert node_statuses(database) == {"1": "cleaning",
+                                       "2": "cleaning",
+                                       "3": "cleaning",
+                                       "4": "dirty"}
+
+    # Nor is another allocation preempted while gate's nodes are cleaned
+    ret = database.allocateBM("gate", 1, "x86", priority=10, image="fedora")
+    print(ret)
+    assert ret['status'] == 404
+    ret = database.get_field("nightly", "id")
+    print(ret)
+    assert ret['status'] == 200
+
+    # But they are not kept for anyone else
+    ret = database.allocateBM("experimental", 1, "x86", priority=10)
+    print(ret)
+    assert ret['status'] == 404
+    ret = database.get_field("nightly", "id")
+    print(ret)
+    assert ret['status'] == 410
+
+    cleaner = moltenirond.Cleaner(conf)
+    deadline = time.time() + 60
+    while cleaner.poll(database) or database.unclean_nodes():
+        assert time.time() < deadline
+        time.sleep(0.05)
+    cleaner.stop()
+
+    with open(bmc_log, "r") as fobj:
+        calls = [json.loads(line) for line in fobj]
+    print(calls)
+    assert sorted([call["host"] for call in calls]) == ["10.1.2.1",
+                                                        "10.1.2.2",
+                                                        "10.1.2.4",
+                                                        "10.1.2.6"]
+
+    # Power cycling them left their image in place
+    ret = database.allocateBM("gate", 1, "x86", priority=10, image="fedora")
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['warm'] == ["node_2"]
+
+    database.close()
+    del database
+    os.remove(bmc_log)
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    assert moltenirond.clean_action("ipmi") is moltenirond.ipmi_power_cycle
+    action = moltenirond.clean_action("molteniron.moltenirond:run_script")
+    assert action is moltenirond.run_script
+    try:
+        moltenirond.clean_action("wipe")
+        assert False
+    except ValueError as e:
+        print(e)
+
+    # Only actions which reimage the nodes wipe their image
+    assert not moltenirond.Cleaner(conf).reimages
+    assert moltenirond.Cleaner(dict(conf, cleanReimages=True)).reimages
+    assert not moltenirond.Cleaner(dict(conf, cleanAction="script")).reimages
+
+    # Scripts are given the node in their environment
+    conf["cleanScript"] = "sh -c 'test \"$MI_NAME\" = test1'"
+    moltenirond.run_script(conf, {"id": 1, "name": "test1"}, 10)
+    try:
+        moltenirond.run_script(conf, {"id": 2, "name": "test2"}, 10)
+        assert False
+    except subprocess.CalledProcessError as e:
+        print(e)
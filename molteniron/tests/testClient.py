@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Tests the reusable MoltenIron client against a running MoltenIron server.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import molteniron
+
+
+def stale_connection(conf):
+    """Reuse a connection which the server closed while it was idle"""
+
+    connections = []
+
+    class Handler(BaseHTTPRequestHandler):
+        """Answers every request with success, closing idle connections
+        after a short while"""
+
+        protocol_version = "HTTP/1.1"
+        timeout = 0.5
+
+        def setup(self):
+            connections.append(self.client_address)
+            BaseHTTPRequestHandler.setup(self)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            data = json.dumps({'status': 200}).encode("utf-8")
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    conf = dict(conf)
+    conf['serverIP'] = "127.0.0.1"
+    conf['mi_port'] = server.server_address[1]
+    conf['retry'] = 0
+    conf.pop('socket_path', None)
+
+    with molteniron.Client(conf) as client:
+        ret = client.release("owner1")
+        print(ret)
+        assert ret == {'status': 200}
+
+        # The server has closed the idle connection, which is replaced
+        # although no retries are allowed
+        time.sleep(1.5)
+        ret = client.release("owner1")
+        print(ret)
+        assert ret == {'status': 200}
+        assert len(connections) == 2
+
+    server.shutdown()
+    server.server_close()
+
+
+def run(conf):
+    """Exercise the client from many threads at once"""
+
+    with molteniron.Client(conf, 4) as client, \
+            ThreadPoolExecutor(max_workers=8) as executor:
+        ret = client.delete_db()
+        print(ret)
+        assert ret == {'status': 200}
+
+        ret = list(executor.map(
+            lambda i: client.add_baremetal("sync%d" % (i, ),
+                                           "10.1.5.%d" % (i, ),
+                                           "user",
+                                           "password",
+                                           "10.1.6.%d" % (i, ),
+                                           "de:ad:be:ef:02:%02d" % (i, ),
+                                           "ppc64el",
+                                           8,
+                                           2048,
+                                           32),
+            range(1, 11)))
+        print(ret)
+        assert ret == [{'status': 200}] * 10
+
+        # Only four connections were used for ten requests
+        assert len(client.idle) <= 4
+
+        ret = list(executor.map(
+            lambda i: client.allocate("owner%d" % (i, ), 1),
+            range(1, 11)))
+        print(ret)
+        names = set()
+        for response in ret:
+            assert response['status'] == 200
+            assert len(response['nodes']) == 1
+            for node in response['nodes'].values():
+                names.add(node['name'])
+        # Every owner got a different node
+        assert len(names) == 10
+
+        ret = client.allocate("owner11", 1)
+        print(ret)
+        assert ret['status'] == 404
+
+        ret = client.get_fields(["owner2", "owner3"], ["name", "cpus"])
+        print(ret)
+        assert ret['status'] == 200
+        assert len(ret['result']) == 2
+
+        ret = client.release("owner1")
+        print(ret)
+        assert ret == {'status': 200}
+
+        ret = client.get_field("owner1", "name")
+        print(ret)
+        assert ret['status'] == 404
+
+        # The same request_id is only allocated once
+        ret = list(executor.map(
+            lambda _: client.allocate("owner1", 1, request_id="again"),
+            range(2)))
+        print(ret)
+        assert ret[0] == ret[1]
+
+        ret = client.delete_db()
+        print(ret)
+        assert ret == {'status': 200}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    stale_connection(conf)
+    run(conf)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Tests compressing responses as the request's Accept-Encoding allows.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import json
+
+from molteniron import molteniron
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+
+    ret = moltenirond.accepted_codings(None)
+    assert ret == set()
+    ret = moltenirond.accepted_codings("gzip, deflate;q=0.5, br;q=0")
+    print(ret)
+    assert ret == set(["gzip", "deflate"])
+    ret = moltenirond.accepted_codings("*")
+    assert ret == set(["gzip", "zstd"])
+
+    (status_code, data) = moltenirond.encode_response(
+        {'status': 200, 'result': "1,pkvmci816,ready,,\n" * 1000})
+
+    # The client accepts whatever it can decode
+    codings = moltenirond.accepted_codings(molteniron.accept_encoding())
+    print(codings)
+    assert "gzip" in codings
+
+    (coding, compressed) = moltenirond.compress(data, codings)
+    print(coding, len(data), len(compressed))
+    if moltenirond.zstandard is None:
+        assert coding == "gzip"
+    assert len(compressed) < len(data) / 10
+    assert molteniron.decode_body(compressed, coding) == data
+    assert json.loads(data.decode("utf-8"))['status'] == 200
+
+    (coding, compressed) = moltenirond.compress(data, set(["gzip"]))
+    assert coding == "gzip"
+    assert molteniron.decode_body(compressed, "gzip") == data
+
+    # Nothing is compressed for a client which accepts no known coding
+    (coding, compressed) = moltenirond.compress(data, set(["br"]))
+    assert coding is None
+    assert compressed is data
+
+    assert molteniron.decode_body(data, None) is data
+    assert molteniron.decode_body(data, "identity") is data
+    try:
+        molteniron.decode_body(data, "br")
+        assert False
+    except ValueError as e:
+        print(e)
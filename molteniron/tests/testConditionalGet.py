@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Tests the conditional GET requests of the read-only MoltenIron commands.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import molteniron
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    request1 = {
+        "name": "pkvmci816",
+        "ipmi_ip": "10.228.219.134",
+        "status": "ready",
+        "provisioned": "",
+        "timestamp": "",
+        "allocation_pool": "10.228.112.10,10.228.112.11"
+    }
+    node1 = {
+        "ipmi_user": "user",
+        "ipmi_password": "e05cc5f061426e34",
+        "port_hwaddr": "f8:de:29:33:a4:ed",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    # Every read-only method is cached by the client and served by GET
+    assert (sorted(molteniron.CACHED_METHODS)
+            == sorted(moltenirond.READ_ONLY_METHODS))
+
+    request = molteniron.make_request('get_fields',
+                                      {'owner_names': "hamzy,mjturek",
+                                       'field_names': ["cpus"]})
+    path = molteniron.request_path(request)
+    print(path)
+    assert path == "/get_fields?field_names=cpus&owner_names=hamzy%2Cmjturek"
+    (method, _, query) = path.partition("?")
+    assert method == "/get_fields"
+    ret = moltenirond.query_request(query)
+    print(ret)
+    assert ret == {'owner_names': "hamzy,mjturek", 'field_names': ["cpus"]}
+
+    # Unset arguments are left out
+    request = molteniron.make_request('status',
+                                      {'type': "csv",
+                                       'columns': ["id", "name"],
+                                       'since': None})
+    path = molteniron.request_path(request)
+    print(path)
+    assert path == "/status?columns=id&columns=name&type=csv"
+    ret = moltenirond.query_request(path.partition("?")[2])
+    assert ret == {'type': "csv", 'columns': ["id", "name"]}
+
+    assert moltenirond.if_none_match(None) == []
+    assert moltenirond.if_none_match('"a-1", W/"b-2"') == ['"a-1"', '"b-2"']
+
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+
+    etag = moltenirond.VERSION.etag()
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Every change makes a new tag
+    assert moltenirond.VERSION.etag() != etag
+    etag = moltenirond.VERSION.etag()
+
+    # But reading does not
+    ret = database.status("csv")
+    print(ret)
+    assert ret['status'] == 200
+    assert moltenirond.VERSION.etag() == etag
+
+    # Nor does a change which fails
+    ret = database.allocateBM("hamzy", 2)
+    print(ret)
+    assert ret['status'] == 404
+    assert moltenirond.VERSION.etag() == etag
+
+    ret = database.allocateBM("hamzy", 1)
+    print(ret)
+    assert ret['status'] == 200
+    assert moltenirond.VERSION.etag() != etag
+    etag = moltenirond.VERSION.etag()
+
+    ret = database.delete_db()
+    print(ret)
+    assert ret == {'status': 200}
+    assert moltenirond.VERSION.etag() != etag
+
+    database.close()
+    del database
@@ -67,6 +67,8 @@ def compare_culled_nodes(lhs, rhs_r, rhs_n):
     del lhs_r['timestamp']
     del rhs_r['timestamp']
     del lhs_r['id']
+    assert lhs_r.pop('priority') == 0
+    assert lhs_r.pop('image') is None
     assert lhs_r == rhs_r
     assert lhs_n == rhs_n
 
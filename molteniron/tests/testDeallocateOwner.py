@@ -68,6 +68,8 @@ def compare_provisioned_nodes(lhs, rhs_r, rhs_n):
     del rhs_r['status']
     del rhs_r['timestamp']
     del lhs_r['id']
+    assert lhs_r.pop('priority') == 0
+    assert lhs_r.pop('image') is None
     assert lhs_r == rhs_r
     assert lhs_n == rhs_n
 
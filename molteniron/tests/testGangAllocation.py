@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+Tests allocating several nodes which share a locality, such as a rack.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import json
+import os
+import sys
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    def request(number):
+        """Return the request of node number"""
+        return {
+            "name": "test%d" % (number, ),
+            "ipmi_ip": "10.1.2.%d" % (number, ),
+            "status": "ready",
+            "provisioned": "",
+            "timestamp": "",
+            "allocation_pool": "10.1.3.%d" % (number, )
+        }
+
+    def node(number, rack):
+        """Return the blob of node number, which is in rack"""
+        blob = {
+            "ipmi_user": "user",
+            "ipmi_password": "password",
+            "port_hwaddr": "de:ad:be:ef:00:%02d" % (number, ),
+            "cpu_arch": "ppc64el",
+            "cpus": 8,
+            "ram_mb": 2048,
+            "disk_gb": 32
+        }
+        if rack is not None:
+            blob["rack"] = rack
+        return blob
+
+    def racks(response):
+        """Return the sorted racks of the allocated nodes"""
+        return sorted([json.loads(node["blob"]).get("rack")
+                       for node in response["nodes"].values()])
+
+    def ready(database):
+        """Return how many nodes are ready"""
+        ret = database.pool_summary()
+        return sum([pool["statuses"].get("ready", 0)
+                    for pool in ret["pools"].values()])
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for (number, rack) in [(1, "A"), (2, "A"), (3, "B"), (4, "A"),
+                           (5, "B"), (6, None)]:
+        ret = database.addBMNode(request(number), node(number, rack))
+        print(ret)
+        assert ret == {'status': 200}
+
+    # The smallest rack which is big enough is chosen
+    ret = database.allocateBM("hamzy", 2, locality="rack")
+    print(ret)
+    assert ret['status'] == 200
+    assert racks(ret) == ["B", "B"]
+
+    # No rack has four nodes, so none are allocated
+    ret = database.allocateBM("mjturek", 4, locality="rack")
+    print(ret)
+    assert ret['status'] == 404
+    assert "Found 3, requested 4" in ret['message']
+    assert ready(database) == 4
+
+    ret = database.allocateBM("mjturek", 3, locality="rack")
+    print(ret)
+    assert ret['status'] == 200
+    assert racks(ret) == ["A", "A", "A"]
+
+    # Nodes without the field are never part of a gang
+    ret = database.allocateBM("mmedvede", 1, locality="rack")
+    print(ret)
+    assert ret['status'] == 404
+    assert ready(database) == 1
+
+    # A column works as well as a field of the blob
+    ret = database.allocateBM("mmedvede", 1, locality="node_pool")
+    print(ret)
+    assert ret['status'] == 200
+    assert list(ret['nodes'].values())[0]['name'] == "test6"
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for (number, rack) in [(1, "A"), (2, "B"), (3, "A")]:
+        ret = database.addBMNode(request(number), node(number, rack))
+        print(ret)
+        assert ret == {'status': 200}
+
+    # Requests name the locality too
+    ret = moltenirond.dispatch(database, {'method': 'allocate_manifest',
+                                          'owner_name': "hamzy",
+                                          'number_of_nodes': 2,
+                                          'node_pool': "Default",
+                                          'locality': "rack"})
+    print(ret)
+    assert ret['status'] == 200
+    assert sorted([manifest['rack']
+                   for manifest in ret['nodes'].values()]) == ["A", "A"]
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for (number, rack) in [(1, "A"), (2, "B"), (3, "A"), (4, "B"),
+                           (5, "B")]:
+        ret = database.addBMNode(request(number), node(number, rack))
+        print(ret)
+        assert ret == {'status': 200}
+
+    # Without a rack of four, the biggest rack is taken
+    ret = database.allocateBM("hamzy", 1, locality="rack", max_nodes=4)
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['count'] == 3
+    assert racks(ret) == ["B", "B", "B"]
+
+    ret = database.allocateBM("mjturek", 1, locality="rack", max_nodes=1)
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['count'] == 1
+
+    database.close()
+    del database
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+"""
+Tests replaying MoltenIron requests which carry a request_id.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from pkg_resources import resource_filename
+from sqlalchemy import create_engine, event, inspect
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    request1 = {
+        "method": "add_json_blob",
+        "name": "pkvmci816",
+        "ipmi_ip": "10.228.219.134",
+        "allocation_pool": "10.228.112.10,10.228.112.11",
+        "blob": json.dumps({
+            "ipmi_user": "user",
+            "ipmi_password": "e05cc5f061426e34",
+            "port_hwaddr": "f8:de:29:33:a4:ed",
+            "cpu_arch": "ppc64el",
+            "cpus": 20,
+            "ram_mb": 51000,
+            "disk_gb": 500
+        }),
+        "node_pool": "Default",
+        "request_id": "8d4f1c3e-add1"
+    }
+    request2 = {
+        "method": "add_json_blob",
+        "name": "pkvmci818",
+        "ipmi_ip": "10.228.219.133",
+        "allocation_pool": "10.228.112.8,10.228.112.9",
+        "blob": json.dumps({
+            "ipmi_user": "user",
+            "ipmi_password": "0614d63b6635ea3d",
+            "port_hwaddr": "4c:c5:da:28:2c:2d",
+            "cpu_arch": "ppc64el",
+            "cpus": 20,
+            "ram_mb": 51000,
+            "disk_gb": 500
+        }),
+        "node_pool": "Default",
+        "request_id": "8d4f1c3e-add2"
+    }
+
+    def allocate(request_id):
+        """Returns an allocate request for hamzy"""
+        return {"method": "allocate",
+                "owner_name": "hamzy",
+                "number_of_nodes": 1,
+                "node_pool": "Default",
+                "request_id": request_id}
+
+    def release(request_id):
+        """Returns a release request for hamzy"""
+        return {"method": "release",
+                "owner_name": "hamzy",
+                "request_id": request_id}
+
+    def encoded(response):
+        """Returns the response as the client decodes it"""
+        return json.loads(json.dumps(
+            response,
+            cls=moltenirond.JSON_encoder_with_DateTime))
+
+    def saved_responses(database):
+        """Returns every response saved in the Requests table"""
+        with database.engine.connect() as connection:
+            return [row[0] for row in connection.execute(
+                "SELECT response FROM Requests")]
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = moltenirond.dispatch(database, dict(request1))
+    print(ret)
+    assert ret == {'status': 200}
+    ret = moltenirond.dispatch(database, dict(request2))
+    print(ret)
+    assert ret == {'status': 200}
+
+    # A replayed add does not complain that the node already exists
+    ret = moltenirond.dispatch(database, dict(request1))
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = moltenirond.dispatch(database, allocate("allocate-1"))
+    print(ret)
+    assert ret['status'] == 200
+    assert list(ret['nodes'].keys()) == ['node_1']
+    first = encoded(ret)
+
+    # A replayed allocate returns the same node rather than a second one
+    ret = moltenirond.dispatch(database, allocate("allocate-1"))
+    print(ret)
+    assert encoded(ret) == first
+
+    # Though the nodes' credentials are not saved with the response
+    saved = saved_responses(database)
+    print(saved)
+    assert len(saved) == 3
+    for response in saved:
+        assert "e05cc5f061426e34" not in response
+
+    ret = database.get_field("hamzy", "id")
+    print(ret)
+    assert ret == {'status': 200, 'result': [{'id': 1, 'field': 1}]}
+
+    # A new request_id allocates another node
+    ret = moltenirond.dispatch(database, allocate("allocate-2"))
+    print(ret)
+    assert ret['status'] == 200
+    assert list(ret['nodes'].keys()) == ['node_2']
+
+    ret = moltenirond.dispatch(database, release("release-1"))
+    print(ret)
+    assert ret == {'status': 200}
+
+    # A replayed release still succeeds although nothing is owned anymore
+    ret = moltenirond.dispatch(database, release("release-1"))
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Without a request_id the release fails as before
+    ret = moltenirond.dispatch(database, release(None))
+    print(ret)
+    assert ret == {'status': 400, 'message': 'No nodes are owned by hamzy'}
+
+    # Failed requests are not remembered
+    ret = moltenirond.dispatch(database, allocate("allocate-3"))
+    print(ret)
+    assert ret['status'] == 200
+    ret = moltenirond.dispatch(database, allocate("allocate-4"))
+    print(ret)
+    assert ret['status'] == 200
+    ret = moltenirond.dispatch(database, allocate("allocate-5"))
+    print(ret)
+    assert ret['status'] == 404
+    with database.session_scope() as session:
+        assert database.get_replay(session, "allocate-5") is None
+
+    # The replay is looked up and saved in the transaction of the request
+    begins = []
+
+    def begin(connection):
+        """Counts the transactions begun"""
+        begins.append(connection)
+
+    event.listen(database.engine, "begin", begin)
+    ret = moltenirond.dispatch(database, release("release-2"))
+    print(ret)
+    assert ret == {'status': 200}
+    assert len(begins) == 1
+    ret = moltenirond.dispatch(database, release("release-2"))
+    print(ret)
+    assert ret == {'status': 200}
+    assert len(begins) == 2
+    event.remove(database.engine, "begin", begin)
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = moltenirond.dispatch(database, dict(request1))
+    print(ret)
+    assert ret == {'status': 200}
+
+    manifest = {"method": "allocate_manifest",
+                "owner_name": "hamzy",
+                "number_of_nodes": 1,
+                "node_pool": "Default",
+                "render": True,
+                "request_id": "manifest-1"}
+    ret = moltenirond.dispatch(database, dict(manifest))
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['nodes']['node_1']['ipmi_password'] == "e05cc5f061426e34"
+    assert "e05cc5f061426e34" in ret['hardware_info']
+    first = encoded(ret)
+
+    # A replayed manifest is rendered again from the node
+    ret = moltenirond.dispatch(database, dict(manifest))
+    print(ret)
+    assert encoded(ret) == first
+    for response in saved_responses(database):
+        assert "e05cc5f061426e34" not in response
+
+    # Once its nodes are released and allocated to another owner, a
+    # replay does not pass them off as still being hamzy's
+    ret = moltenirond.dispatch(database, release("release-1"))
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.allocateBM("mjturek", 1)
+    print(ret)
+    assert list(ret['nodes'].keys()) == ['node_1']
+    ret = moltenirond.dispatch(database, dict(manifest))
+    print(ret)
+    assert ret == {'status': 410,
+                   'message': 'The nodes allocated by request manifest-1'
+                              ' are no longer held by hamzy'}
+
+    # request_ids which the Requests table cannot hold are refused
+    ret = moltenirond.dispatch(database, release("x" * 65))
+    print(ret)
+    assert ret == {'status': 400,
+                   'message': 'request_id is longer than 64 characters'}
+    ret = moltenirond.dispatch(database, release("x" * 64))
+    print(ret)
+    assert ret == {'status': 400, 'message': 'No nodes are owned by hamzy'}
+
+    # Tables made by older releases are given the index which purges
+    # expired responses
+    index = "ix_Requests_timestamp"
+    with database.engine.connect() as connection:
+        connection.execute("DROP INDEX %s" % (index, ))
+    database.upgrade_schema()
+    names = [row['name'] for row in inspect(database.engine).get_indexes(
+        "Requests")]
+    assert index in names
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    conf["requestTTL"] = -1
+
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    with database.session_scope() as session:
+        assert database.claim_request(session, "old", "release") is None
+        database.save_replay(session, "old", {'status': 200})
+    with database.session_scope() as session:
+        assert database.claim_request(session, "old", "release") == {
+            'status': 200}
+
+    # Saving another response purges the expired one
+    with database.session_scope() as session:
+        assert database.claim_request(session, "new", "release") is None
+        database.save_replay(session, "new", {'status': 200})
+        assert database.get_replay(session, "old") is None
+        assert database.get_replay(session, "new") == {'status': 200}
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    # Server processes do not share their locks, so retries of the same
+    # request sent to several of them at once must still allocate once
+    del conf["requestTTL"]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "molteniron.db")
+
+    class FileDataBase(moltenirond.DataBase):
+        """A database file, which stands in for a server's MySQL"""
+
+        def create_engine(self):
+            return create_engine("sqlite:///%s" % (path, ),
+                                 connect_args={"timeout": 30})
+
+    database = FileDataBase(conf, moltenirond.TYPE_SQLITE)
+    for request in (request1, request2):
+        request = dict(request)
+        request.pop("request_id")
+        ret = moltenirond.dispatch(database, request)
+        print(ret)
+        assert ret == {'status': 200}
+
+    # Only the first DataBase of a database creates its tables, so later
+    # ones do not wait on the lock
+    assert str(database.engine.url) in moltenirond.UPGRADED_DATABASES
+    created = []
+    with moltenirond.METADATA_LOCK:
+        thread = threading.Thread(
+            target=lambda: created.append(FileDataBase(
+                conf, moltenirond.TYPE_SQLITE)))
+        thread.start()
+        thread.join(10)
+        assert len(created) == 1
+    created[0].close()
+
+    barrier = threading.Barrier(8)
+    responses = []
+
+    def retry():
+        """Sends allocate-race as its own server process would"""
+        database = FileDataBase(conf, moltenirond.TYPE_SQLITE)
+        request = allocate("allocate-race")
+        request.pop("method")
+        barrier.wait()
+        responses.append(moltenirond.dispatch_mutation(database,
+                                                       "allocate",
+                                                       request))
+        database.close()
+
+    threads = [threading.Thread(target=retry) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(responses)
+    assert len(responses) == 8
+    for ret in responses:
+        assert ret['status'] == 200
+        assert list(ret['nodes'].keys()) == list(
+            responses[0]['nodes'].keys())
+
+    ret = database.get_field("hamzy", "id")
+    print(ret)
+    assert ret['status'] == 200
+    assert len(ret['result']) == 1
+
+    database.close()
+    del database
+    shutil.rmtree(directory)
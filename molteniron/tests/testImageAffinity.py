@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+Tests preferring nodes which already have the requested image.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    def request(number):
+        """Return the request of node number"""
+        return {
+            "name": "test%d" % (number, ),
+            "ipmi_ip": "10.1.2.%d" % (number, ),
+            "status": "ready",
+            "provisioned": "",
+            "timestamp": "",
+            "allocation_pool": "10.1.3.%d" % (number, ),
+            "node_pool": "x86"
+        }
+
+    node = {
+        "ipmi_user": "user",
+        "ipmi_password": "password",
+        "port_hwaddr": "de:ad:be:ef:00:01",
+        "cpu_arch": "ppc64el",
+        "cpus": 8,
+        "ram_mb": 2048,
+        "disk_gb": 32
+    }
+
+    def allocated(response):
+        """Return the sorted names of the allocated nodes"""
+        return sorted([node["name"] for node in response["nodes"].values()])
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for number in range(1, 5):
+        ret = database.addBMNode(request(number), node)
+        print(ret)
+        assert ret == {'status': 200}
+
+    # No node has an image yet
+    ret = database.allocateBM("hamzy", 1, "x86", image="centos")
+    print(ret)
+    assert allocated(ret) == ["test1"]
+    assert ret['warm'] == []
+    ret = database.allocateBM("mjturek", 1, "x86", image="ubuntu")
+    print(ret)
+    assert allocated(ret) == ["test2"]
+    assert ret['nodes']['node_2']['image'] == "ubuntu"
+
+    ret = database.deallocateOwner("hamzy")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.deallocateOwner("mjturek")
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Nodes keep their image once released
+    ret = database.allocateBM("mmedvede", 1, "x86", image="ubuntu")
+    print(ret)
+    assert allocated(ret) == ["test2"]
+    assert ret['warm'] == ["node_2"]
+
+    # Then other ready nodes are taken
+    ret = database.allocateBM("hamzy", 2, "x86", image="centos")
+    print(ret)
+    assert allocated(ret) == ["test1", "test3"]
+    assert ret['warm'] == ["node_1"]
+
+    ret = database.get_field("hamzy", "image")
+    print(ret)
+    assert ret == {'status': 200,
+                   'result': [{'id': 1, 'field': "centos"},
+                              {'id': 3, 'field': "centos"}]}
+
+    # Allocations without an image do not say which nodes are warm
+    ret = database.allocateBM("mjturek", 1, "x86")
+    print(ret)
+    assert allocated(ret) == ["test4"]
+    assert 'warm' not in ret
+    assert ret['nodes']['node_4']['image'] is None
+
+    # The image actually deployed may be recorded
+    ret = database.set_field(4, "image", "fedora", "string")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.deallocateOwner("mjturek")
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.allocate_manifest("mjturek", 1, "x86", image="fedora")
+    print(ret)
+    assert ret['warm'] == ["node_4"]
+
+    # Cleaning a node wipes its image
+    ret = database.doClean(4)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.allocateBM("mmedvede", 1, "x86", image="fedora")
+    print(ret)
+    assert allocated(ret) == ["test4"]
+    assert ret['warm'] == []
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for number in range(1, 4):
+        ret = database.addBMNode(request(number), node)
+        print(ret)
+        assert ret == {'status': 200}
+    ret = database.set_field(3, "image", "centos", "string")
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Nodes sharing a locality are taken warm first too
+    ret = moltenirond.dispatch(database, {'method': 'allocate',
+                                          'owner_name': "hamzy",
+                                          'number_of_nodes': 2,
+                                          'node_pool': "x86",
+                                          'locality': "node_pool",
+                                          'image': "centos"})
+    print(ret)
+    assert allocated(ret) == ["test1", "test3"]
+    assert ret['warm'] == ["node_3"]
+
+    database.close()
+    del database
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Tests that allocations from different node pools do not wait on each other.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+import threading
+
+from pkg_resources import resource_filename
+from sqlalchemy import inspect
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    request1 = {
+        "name": "pkvmci816",
+        "ipmi_ip": "10.228.219.134",
+        "status": "ready",
+        "provisioned": "",
+        "timestamp": "",
+        "allocation_pool": "10.228.112.10,10.228.112.11"
+    }
+    node1 = {
+        "ipmi_user": "user",
+        "ipmi_password": "e05cc5f061426e34",
+        "port_hwaddr": "f8:de:29:33:a4:ed",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    locks = moltenirond.PoolLocks()
+    x86 = locks.lock("x86")
+    ppc64el = locks.lock("ppc64el")
+    assert locks.lock("x86") is x86
+    assert x86 is not ppc64el
+
+    # A busy pool does not hold up another pool
+    with x86:
+        assert ppc64el.acquire(False)
+        ppc64el.release()
+
+    # Deleting the database waits for every pool
+    events = []
+
+    def delete_db():
+        """Stands in for delete_db"""
+        with locks.all():
+            events.append("deleted")
+
+    x86.acquire()
+    thread = threading.Thread(target=delete_db)
+    thread.start()
+    thread.join(0.2)
+    assert events == []
+    events.append("allocated")
+    x86.release()
+    thread.join()
+    assert events == ["allocated", "deleted"]
+
+    # And no pool may be locked until it is done
+    with locks.all():
+        assert not x86.acquire(False)
+        assert not locks.guard.acquire(False)
+
+    # Every mutation takes its lock
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+
+    with moltenirond.POOL_LOCKS.lock("ppc64el"):
+        # Allocating from another pool goes ahead
+        ret = moltenirond.dispatch(database, {'method': 'allocate',
+                                              'owner_name': "hamzy",
+                                              'number_of_nodes': 1,
+                                              'node_pool': "x86"})
+        print(ret)
+        assert ret['status'] == 404
+
+        ret = moltenirond.dispatch(database, {'method': 'allocate',
+                                              'owner_name': "hamzy",
+                                              'number_of_nodes': 1,
+                                              'node_pool': "Default"})
+        print(ret)
+        assert ret['status'] == 200
+
+    # Allocations which name no pool take the lock of the Default pool,
+    # which does not keep the database from being deleted
+    ret = database.deallocateOwner("hamzy")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = moltenirond.dispatch(database, {'method': 'allocate',
+                                          'owner_name': "hamzy",
+                                          'number_of_nodes': 1})
+    print(ret)
+    assert ret['status'] == 200
+    ret = moltenirond.dispatch(database, {'method': 'allocate',
+                                          'owner_name': "hamzy",
+                                          'number_of_nodes': 1,
+                                          'node_pool': None})
+    print(ret)
+    assert ret['status'] == 404
+    assert None not in moltenirond.POOL_LOCKS.locks
+
+    ret = moltenirond.dispatch(database, {'method': 'delete_db'})
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Tables made by older releases are given the newer indexes
+    index = "ix_Nodes_node_pool_status"
+    names = [row['name'] for row in inspect(database.engine).get_indexes(
+        "Nodes")]
+    assert index in names
+    with database.engine.connect() as connection:
+        connection.execute("DROP INDEX %s" % (index, ))
+    names = [row['name'] for row in inspect(database.engine).get_indexes(
+        "Nodes")]
+    assert index not in names
+
+    database.upgrade_schema()
+    names = [row['name'] for row in inspect(database.engine).get_indexes(
+        "Nodes")]
+    assert index in names
+
+    database.close()
+    del database
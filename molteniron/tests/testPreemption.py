@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+Tests allocating by priority, preempting lower priority allocations.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+import time
+
+from pkg_resources import resource_filename
+from sqlalchemy import inspect
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    def request(number):
+        """Return the request of node number"""
+        return {
+            "name": "test%d" % (number, ),
+            "ipmi_ip": "10.1.2.%d" % (number, ),
+            "status": "ready",
+            "provisioned": "",
+            "timestamp": "",
+            "allocation_pool": "10.1.3.%d" % (number, ),
+            "node_pool": "x86"
+        }
+
+    node = {
+        "ipmi_user": "user",
+        "ipmi_password": "password",
+        "port_hwaddr": "de:ad:be:ef:00:01",
+        "cpu_arch": "ppc64el",
+        "cpus": 8,
+        "ram_mb": 2048,
+        "disk_gb": 32
+    }
+
+    def allocated(response):
+        """Return the sorted names of the allocated nodes"""
+        return sorted([node["name"] for node in response["nodes"].values()])
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for number in range(1, 4):
+        ret = database.addBMNode(request(number), node)
+        print(ret)
+        assert ret == {'status': 200}
+
+    ret = database.allocateBM("periodic", 1, "x86")
+    print(ret)
+    assert allocated(ret) == ["test1"]
+    ret = database.allocateBM("experimental", 1, "x86", priority=1)
+    print(ret)
+    assert allocated(ret) == ["test2"]
+    # Allocations are timed to the second
+    time.sleep(1.1)
+    ret = database.allocateBM("nightly", 1, "x86")
+    print(ret)
+    assert allocated(ret) == ["test3"]
+
+    # An allocation of the same priority preempts nothing
+    ret = database.allocateBM("recheck", 1, "x86")
+    print(ret)
+    assert ret == {'status': 404,
+                   'message': ('Not enough available nodes found. '
+                               'Found 0, requested 1')}
+
+    # The newest of the lowest priority allocations is preempted
+    ret = database.allocateBM("gate", 1, "x86", priority=10)
+    print(ret)
+    assert ret['status'] == 200
+    assert allocated(ret) == ["test3"]
+    assert ret['nodes']['node_3']['priority'] == 10
+
+    ret = database.get_field("nightly", "id")
+    print(ret)
+    assert ret == {'status': 410,
+                   'message': 'nightly had its nodes preempted'}
+
+    ret = database.get_field("periodic", "id")
+    print(ret)
+    assert ret == {'status': 200, 'result': [{'id': 1, 'field': 1}]}
+
+    ret = database.watch(0, 0)
+    print(ret)
+    preempted = [(change['node_id'], change['provisioned'])
+                 for change in ret['changes']
+                 if change['kind'] == "preempted"]
+    assert preempted == [(3, "nightly")]
+
+    # Then the next lowest priority
+    ret = database.allocateBM("gate", 2, "x86", priority=10)
+    print(ret)
+    assert allocated(ret) == ["test1", "test2"]
+
+    ret = database.get_field("experimental", "priority")
+    print(ret)
+    assert ret['status'] == 410
+
+    # Nothing is below this priority, so nothing is preempted
+    ret = database.allocateBM("mjturek", 1, "x86", priority=5)
+    print(ret)
+    assert ret['status'] == 404
+
+    ret = database.get_field("gate", "priority")
+    print(ret)
+    assert [row['field'] for row in ret['result']] == [10, 10, 10]
+
+    # Released nodes lose their priority
+    ret = database.deallocateOwner("gate")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.allocateBM("periodic", 3, "x86")
+    print(ret)
+    assert [node['priority'] for node in ret['nodes'].values()] == [0, 0, 0]
+
+    # The nodes of the owner being preempted are found through an index
+    with database.engine.connect() as connection:
+        plan = connection.execute(
+            "EXPLAIN QUERY PLAN SELECT id, node_pool FROM Nodes"
+            " WHERE provisioned = 'gate' AND status = 'dirty'"
+            " AND priority < 10").fetchall()
+    print(plan)
+    assert "ix_Nodes_provisioned_status_priority" in str(plan)
+
+    # Tables made by older releases are given the priority and
+    # preempted_by columns
+    indexes = ("ix_Nodes_node_pool_status_priority",
+               "ix_Nodes_status_priority",
+               "ix_Nodes_provisioned_status_priority")
+    with database.engine.begin() as connection:
+        for index in indexes:
+            connection.execute("DROP INDEX %s" % (index, ))
+        connection.execute("ALTER TABLE Nodes DROP COLUMN priority")
+        connection.execute("DROP INDEX ix_Changes_preempted_by")
+        connection.execute("ALTER TABLE Changes DROP COLUMN preempted_by")
+    names = [column['name']
+             for column in inspect(database.engine).get_columns("Nodes")]
+    assert "priority" not in names
+
+    database.upgrade_schema()
+    names = [column['name']
+             for column in inspect(database.engine).get_columns("Nodes")]
+    assert "priority" in names
+    names = [index['name']
+             for index in inspect(database.engine).get_indexes("Nodes")]
+    for index in indexes:
+        assert index in names
+    names = [column['name']
+             for column in inspect(database.engine).get_columns("Changes")]
+    assert "preempted_by" in names
+
+    ret = database.get_field("periodic", "priority")
+    print(ret)
+    assert [row['field'] for row in ret['result']] == [0, 0, 0]
+
+    database.close()
+    del database
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    for number in range(1, 4):
+        ret = database.addBMNode(request(number), node)
+        print(ret)
+        assert ret == {'status': 200}
+
+    ret = database.allocateBM("periodic", 1, "x86")
+    print(ret)
+    assert allocated(ret) == ["test1"]
+    ret = database.allocateBM("nightly", 1, "x86")
+    print(ret)
+    assert allocated(ret) == ["test2"]
+    ret = database.allocateBM("release", 1, "x86", priority=20)
+    print(ret)
+    assert allocated(ret) == ["test3"]
+
+    # Preempting every lower priority allocation would still leave the
+    # request a node short, so none are preempted
+    ret = database.allocateBM("gate", 3, "x86", priority=10)
+    print(ret)
+    assert ret == {'status': 404,
+                   'message': ('Not enough available nodes found. '
+                               'Found 0, requested 3')}
+
+    for owner in ("periodic", "nightly"):
+        ret = database.get_field(owner, "priority")
+        print(ret)
+        assert ret['status'] == 200
+
+    ret = database.watch(0, 0)
+    print(ret)
+    assert "preempted" not in [change['kind'] for change in ret['changes']]
+
+    ret = database.allocateBM("gate", 2, "x86", priority=10)
+    print(ret)
+    assert allocated(ret) == ["test1", "test2"]
+
+    database.close()
+    del database
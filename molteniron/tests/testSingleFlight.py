@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Tests sharing one call among identical concurrent read requests.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import threading
+import time
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+
+    calls = []
+
+    def slow_read():
+        """Stands in for a query which takes a while"""
+        calls.append(1)
+        time.sleep(0.2)
+        return (200, b"{}")
+
+    reads = moltenirond.SingleFlight()
+    results = []
+
+    def read(key, ttl=0):
+        """Read key as one of many identical requests"""
+        results.append(reads.do(key, ttl, slow_read))
+
+    # Requests which arrive together share one call
+    threads = [threading.Thread(target=read, args=("status", ))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(calls, results)
+    assert len(calls) == 1
+    assert results == [(200, b"{}")] * 20
+
+    # But not with a different request
+    del calls[:]
+    threads = [threading.Thread(target=read, args=(key, ))
+               for key in ("status", "pool_summary")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 2
+
+    # Without a ttl, a finished call is not shared
+    del calls[:]
+    read("status")
+    read("status")
+    assert len(calls) == 2
+    assert not reads.calls
+
+    # With one it is, until the ttl has passed
+    del calls[:]
+    read("status", 0.5)
+    read("status", 0.5)
+    assert len(calls) == 1
+    time.sleep(0.5)
+    read("status", 0.5)
+    assert len(calls) == 2
+
+    # Every caller sees the error of a failed call, which is not shared
+    # with later callers
+    def broken_read():
+        """Stands in for a query which fails"""
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError("broken")
+
+    del calls[:]
+    errors = []
+
+    def read_broken():
+        """Read with broken_read"""
+        try:
+            reads.do("broken", 10, broken_read)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=read_broken) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(calls, errors)
+    assert len(calls) == 1
+    assert errors == ["broken"] * 5
+    assert "broken" not in reads.calls
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Tests the MoltenIron status and status_baremetal commands.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    request1 = {
+        "name": "pkvmci816",
+        "ipmi_ip": "10.228.219.134",
+        "status": "ready",
+        "provisioned": "hamzy",
+        "timestamp": "",
+        "allocation_pool": "10.228.112.10,10.228.112.11"
+    }
+    node1 = {
+        "ipmi_user": "user",
+        "ipmi_password": "e05cc5f061426e34",
+        "port_hwaddr": "f8:de:29:33:a4:ed",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+    request2 = {
+        "name": "pkvmci818",
+        "ipmi_ip": "10.228.219.133",
+        "status": "ready",
+        "provisioned": "mjturek",
+        "timestamp": "",
+        "allocation_pool": "10.228.112.8,10.228.112.9"
+    }
+    # This node lacks most of the baremetal fields
+    node2 = {
+        "ipmi_user": "user",
+        "ipmi_password": "0614d63b6635ea3d"
+    }
+    request3 = {
+        "name": "pkvmci851",
+        "ipmi_ip": "10.228.118.129",
+        "status": "used",
+        "provisioned": "7a72eccd-3153-4d08-9848-c6d3b1f18f9f",
+        "timestamp": "1460489832",
+        "allocation_pool": "10.228.112.12,10.228.112.13"
+    }
+    node3 = {
+        "ipmi_user": "user",
+        "ipmi_password": "928b056134e4d770",
+        "port_hwaddr": "53:76:c6:09:50:64",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+    request4 = {
+        "name": "pkvmci853",
+        "ipmi_ip": "10.228.118.133",
+        "status": "used",
+        "provisioned": "mjturek",
+        "timestamp": "1460491566",
+        "allocation_pool": "10.228.112.14,10.228.112.15"
+    }
+    node4 = {
+        "ipmi_user": "user",
+        "ipmi_password": "33f448a4fc176492",
+        "port_hwaddr": "85:e0:73:e9:fc:ca",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request2, node2)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request3, node3)
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.status("csv", ["id", "name", "status", "provisioned"])
+    print(ret)
+    # Versions carry the epoch of the database
+    epoch = ret['version'].split("-")[0]
+    assert len(epoch) == 8
+
+    def version(seq):
+        """Return the version of seq in this database"""
+        return "%s-%d" % (epoch, seq, )
+
+    assert ret == {'status': 200,
+                   'version': version(3),
+                   'result': "1,pkvmci816,ready,hamzy,\n"
+                             "2,pkvmci818,ready,mjturek,\n"
+                             "3,pkvmci851,used,"
+                             "7a72eccd-3153-4d08-9848-c6d3b1f18f9f,\n"}
+
+    ret = database.status("csv", "name,ipmi_ip")
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['result'].split("\n")[0] == "pkvmci816,10.228.219.134,"
+
+    ret = database.status("human", "id,name,status")
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['result'] == ("+----+-----------+--------+\n"
+                             "+ id + name      + status +\n"
+                             "+----+-----------+--------+\n"
+                             "| 1  | pkvmci816 | ready  |\n"
+                             "| 2  | pkvmci818 | ready  |\n"
+                             "| 3  | pkvmci851 | used   |\n"
+                             "+----+-----------+--------+\n")
+
+    # Every column is shown by default
+    ret = database.status("human")
+    print(ret['result'])
+    assert ret['status'] == 200
+    lines = ret['result'].split("\n")
+    assert len(lines) == 8
+    assert lines[1].split() == ["+", "id", "+", "name", "+", "ipmi_ip",
+                                "+", "blob", "+", "status", "+",
+                                "provisioned", "+", "time", "+",
+                                "node_pool", "+"]
+    # Every line is as wide as the widest cell
+    assert len(set([len(line) for line in lines[:-1]])) == 1
+
+    ret = database.status_baremetal("csv", ["name", "cpus", "ram_mb"])
+    print(ret)
+    assert ret == {'status': 200,
+                   'version': version(3),
+                   'result': "pkvmci816,20,51000,\n"
+                             "blob missing baremetal fields\n"
+                             "pkvmci851,20,51000,\n"}
+
+    # Fields of the blob which every node has
+    ret = database.status_baremetal("csv", ["name", "ipmi_user"])
+    print(ret)
+    assert ret == {'status': 200,
+                   'version': version(3),
+                   'result': "pkvmci816,user,\n"
+                             "pkvmci818,user,\n"
+                             "pkvmci851,user,\n"}
+
+    ret = database.status("csv", ["name", "candy"])
+    print(ret)
+    assert ret['status'] == 400
+    assert ret['message'].startswith("Unknown column candy")
+
+    ret = database.status("xml")
+    print(ret)
+    assert ret == {'status': 400, 'message': 'Unknown --type=xml'}
+
+    # Nothing changed since the last version
+    ret = database.status("csv", "id,name,status", version(3))
+    print(ret)
+    assert ret == {'status': 200,
+                   'version': version(3),
+                   'reset': False,
+                   'removed': [],
+                   'result': ""}
+
+    ret = database.allocateBM("hamzy", 1)
+    print(ret)
+    assert ret['status'] == 200
+    ret = database.removeBMNode(3, False)
+    print(ret)
+    assert ret == {'status': 200}
+
+    # Only the allocated node is sent, and the removed node's id
+    ret = database.status("csv", "id,name,status", version(3))
+    print(ret)
+    assert ret == {'status': 200,
+                   'version': version(5),
+                   'reset': False,
+                   'removed': [3],
+                   'result': "1,pkvmci816,dirty,\n"}
+
+    ret = database.status_baremetal("csv", "id,name,cpus", version(4))
+    print(ret)
+    assert ret == {'status': 200,
+                   'version': version(5),
+                   'reset': False,
+                   'removed': [3],
+                   'result': ""}
+
+    # A plain seq, from an older server, which is newer than any change, as
+    # the database was deleted, sends every node
+    ret = database.status("csv", "id,name,status", 100)
+    print(ret)
+    assert ret == {'status': 200,
+                   'version': version(5),
+                   'reset': True,
+                   'removed': [],
+                   'result': "1,pkvmci816,dirty,\n"
+                             "2,pkvmci818,ready,\n"}
+
+    # A version from before the database was deleted sends every node,
+    # although the seqs have started again and reached it
+    old_version = ret['version']
+    ret = database.delete_db()
+    print(ret)
+    assert ret == {'status': 200}
+    for request in (request1, request2, request3):
+        ret = database.addBMNode(request, node1)
+        print(ret)
+        assert ret == {'status': 200}
+    ret = database.allocateBM("hamzy", 2)
+    print(ret)
+    assert ret['status'] == 200
+
+    ret = database.status("csv", "id,name,status", old_version)
+    print(ret)
+    assert ret['version'] != old_version
+    assert ret['version'].endswith("-5")
+    assert ret == {'status': 200,
+                   'version': ret['version'],
+                   'reset': True,
+                   'removed': [],
+                   'result': "1,pkvmci816,dirty,\n"
+                             "2,pkvmci818,dirty,\n"
+                             "3,pkvmci851,used,\n"}
+
+    database.close()
+    del database
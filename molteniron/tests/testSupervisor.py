@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+Tests running several worker processes under the Supervisor.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from daemonize import Daemonize
+from pkg_resources import resource_filename
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+import yaml
+
+from molteniron import molteniron
+from molteniron import moltenirond
+
+
+def children(pid):
+    """Return the pids of the processes whose parent is pid"""
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % (name, ), "r") as fobj:
+                stat = fobj.read()
+        except IOError:
+            continue
+        # The command, in parentheses, may hold spaces
+        fields = stat[stat.rindex(")") + 2:].split()
+        # Zombies have already exited
+        if int(fields[1]) == pid and fields[0] != "Z":
+            pids.append(int(name))
+
+    return sorted(pids)
+
+
+def alive(pid):
+    """Return whether a process exists, even as a zombie"""
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def wait_for(condition, what, seconds=30):
+    """Wait until condition returns something true, and return it"""
+    deadline = time.time() + seconds
+    while True:
+        result = condition()
+        if result:
+            return result
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for %s" % (what, ))
+        time.sleep(0.1)
+
+
+def listeners(port):
+    """Return how many sockets listen on TCP port"""
+    count = 0
+    for name in ("/proc/net/tcp", "/proc/net/tcp6"):
+        if not os.path.exists(name):
+            continue
+        with open(name, "r") as fobj:
+            for line in fobj.readlines()[1:]:
+                fields = line.split()
+                # 0A is LISTEN
+                if (int(fields[1].split(":")[1], 16) == port
+                        and fields[3] == "0A"):
+                    count += 1
+
+    return count
+
+
+def free_port():
+    """Return a TCP port which nothing is listening on"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "molteniron.db")
+    pid_file = os.path.join(directory, "moltenirond.pid")
+
+    conf['serverIP'] = "127.0.0.1"
+    conf['mi_port'] = free_port()
+    conf['logdir'] = directory
+    conf['retry'] = 5
+    conf.pop('socket_path', None)
+    conf.pop('cleanAction', None)
+
+    class FileDataBase(moltenirond.DataBase):
+        """A database file, which stands in for a server's MySQL"""
+
+        def __init__(self, config, db_type=moltenirond.TYPE_SQLITE):
+            super(FileDataBase, self).__init__(config, db_type)
+
+        def create_engine(self):
+            return create_engine("sqlite:///%s" % (path, ),
+                                 connect_args={"timeout": 30},
+                                 poolclass=NullPool)
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    # Started as moltenirond-helper starts it, but without detaching, so
+    # that this process may wait for it
+    supervisor = os.fork()
+    if supervisor == 0:
+        status = 1
+        try:
+            moltenirond.DataBase = FileDataBase
+            daemon = Daemonize(app="moltenirond",
+                               pid=pid_file,
+                               action=lambda: moltenirond.moltenirond_main(
+                                   conf, 2),
+                               foreground=True,
+                               chdir=directory)
+            daemon.start()
+            status = 0
+        finally:
+            os._exit(status)
+
+    client = molteniron.Client(conf)
+
+    def answered():
+        """Return whether the server answered a request"""
+        try:
+            return client.pool_summary()['status'] == 200
+        except Exception:
+            return False
+
+    try:
+        wait_for(lambda: len(children(supervisor)) == 2, "2 workers")
+        wait_for(answered, "the workers to answer")
+
+        # The PID file names the supervisor, which moltenirond-helper stop
+        # sends SIGTERM to
+        with open(pid_file, "r") as fobj:
+            assert int(fobj.read().strip()) == supervisor
+
+        workers = children(supervisor)
+        print(workers)
+
+        # Each worker listens on the port itself, through SO_REUSEPORT
+        assert listeners(conf['mi_port']) == 2
+
+        # Both workers serve the port, so the requests keep being answered
+        # while they are replaced one by one
+        for (number, worker) in enumerate(workers):
+            os.kill(worker, signal.SIGKILL)
+
+            def replaced():
+                """Return the workers once the killed one is replaced"""
+                pids = children(supervisor)
+                if len(pids) == 2 and worker not in pids:
+                    return pids
+                return None
+
+            pids = wait_for(replaced, "worker %d to be replaced" % (worker, ))
+            print(pids)
+
+            blob = json.dumps({"ipmi_user": "user",
+                               "ipmi_password": "password",
+                               "port_hwaddr": "de:ad:be:ef:00:01",
+                               "cpu_arch": "ppc64el",
+                               "cpus": 8,
+                               "ram_mb": 2048,
+                               "disk_gb": 32})
+            ret = client.add_json_blob("test%d" % (number, ),
+                                       "10.1.2.%d" % (number, ),
+                                       "10.1.3.%d" % (number, ),
+                                       blob)
+            print(ret)
+            assert ret == {'status': 200}
+
+        # Only the replacements are left, and they have answered
+        assert not set(workers) & set(children(supervisor))
+        assert listeners(conf['mi_port']) == 2
+        for _ in range(10):
+            ret = client.pool_summary()
+            print(ret)
+            assert ret['status'] == 200
+        ret = client.status_baremetal("csv", "name")
+        print(ret)
+        assert ret['result'] == "test0,\ntest1,\n"
+
+        # Each death is logged with the signal which killed the worker
+        lines = []
+        for name in os.listdir(directory):
+            if name.startswith("molteniron-"):
+                with open(os.path.join(directory, name), "r") as fobj:
+                    lines += [line for line in fobj if "worker" in line]
+        print(lines)
+        assert len([line for line in lines
+                    if "was killed by signal %d" % (signal.SIGKILL, )
+                    in line]) == 2
+
+        # SIGTERM stops every worker, and the supervisor once it has
+        # reaped them
+        workers = children(supervisor)
+        os.kill(supervisor, signal.SIGTERM)
+        wait_for(lambda: os.waitpid(supervisor, os.WNOHANG)[0] == supervisor,
+                 "the supervisor to exit")
+        supervisor = None
+        for worker in workers:
+            assert not alive(worker)
+    finally:
+        if supervisor is not None and alive(supervisor):
+            os.kill(supervisor, signal.SIGKILL)
+            os.waitpid(supervisor, 0)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Tests talking to a MoltenIron server over a Unix domain socket.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import molteniron
+from molteniron import moltenirond
+
+
+def run(conf):
+    """Serve on a Unix socket and send requests over it"""
+
+    socket_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(socket_dir, "moltenirond.sock")
+
+    handler_class = moltenirond.MakeMoltenIronHandlerWithConf(conf)
+    server = moltenirond.UnixHTTPServer(socket_path, handler_class, 0o600)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        mode = stat.S_IMODE(os.stat(socket_path).st_mode)
+        print(oct(mode))
+        assert mode == 0o600
+
+        # Nothing listens on this address, so only the socket can work
+        local_conf = dict(conf)
+        local_conf['serverIP'] = "192.0.2.1"
+        local_conf['socket_path'] = socket_path
+        local_conf['retry'] = 0
+
+        with molteniron.Client(local_conf) as client:
+            ret = client.delete_db()
+            print(ret)
+            assert ret == {'status': 200}
+
+            ret = client.add_baremetal("unix1",
+                                       "10.1.7.1",
+                                       "user",
+                                       "password",
+                                       "10.1.8.1",
+                                       "de:ad:be:ef:03:01",
+                                       "ppc64el",
+                                       8,
+                                       2048,
+                                       32)
+            print(ret)
+            assert ret == {'status': 200}
+
+            ret = client.allocate("hamzy", 1)
+            print(ret)
+            assert ret['status'] == 200
+            assert len(ret['nodes']) == 1
+
+            # Both requests went over the same connection
+            assert len(client.idle) == 1
+
+            ret = client.delete_db()
+            print(ret)
+            assert ret == {'status': 200}
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(socket_dir)
+
+    # The socket file is removed when the server is closed
+    assert not os.path.exists(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    run(conf)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""
+Tests the MoltenIron watch command.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import os
+import sys
+import time
+
+from pkg_resources import resource_filename
+import yaml
+
+from molteniron import moltenirond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Molteniron CLI tool")
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.conf_dir:
+        if not os.path.isdir(args.conf_dir):
+            msg = "Error: %s is not a valid directory" % (args.conf_dir, )
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
+    else:
+        YAML_CONF = resource_filename("molteniron", "conf.yaml")
+
+    with open(YAML_CONF, "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    request1 = {
+        "name": "pkvmci816",
+        "ipmi_ip": "10.228.219.134",
+        "status": "ready",
+        "provisioned": "",
+        "timestamp": "",
+        "allocation_pool": "10.228.112.10,10.228.112.11"
+    }
+    node1 = {
+        "ipmi_user": "user",
+        "ipmi_password": "e05cc5f061426e34",
+        "port_hwaddr": "f8:de:29:33:a4:ed",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+    request2 = {
+        "name": "pkvmci818",
+        "ipmi_ip": "10.228.219.133",
+        "status": "ready",
+        "provisioned": "",
+        "timestamp": "",
+        "allocation_pool": "10.228.112.8,10.228.112.9"
+    }
+    node2 = {
+        "ipmi_user": "user",
+        "ipmi_password": "0614d63b6635ea3d",
+        "port_hwaddr": "4c:c5:da:28:2c:2d",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+    request3 = {
+        "name": "pkvmci851",
+        "ipmi_ip": "10.228.118.129",
+        "status": "used",
+        "provisioned": "7a72eccd-3153-4d08-9848-c6d3b1f18f9f",
+        "timestamp": "1460489832",
+        "allocation_pool": "10.228.112.12,10.228.112.13"
+    }
+    node3 = {
+        "ipmi_user": "user",
+        "ipmi_password": "928b056134e4d770",
+        "port_hwaddr": "53:76:c6:09:50:64",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+    request4 = {
+        "name": "pkvmci853",
+        "ipmi_ip": "10.228.118.133",
+        "status": "used",
+        "provisioned": "mjturek",
+        "timestamp": "1460491566",
+        "allocation_pool": "10.228.112.14,10.228.112.15"
+    }
+    node4 = {
+        "ipmi_user": "user",
+        "ipmi_password": "33f448a4fc176492",
+        "port_hwaddr": "85:e0:73:e9:fc:ca",
+        "cpu_arch": "ppc64el",
+        "cpus": 20,
+        "ram_mb": 51000,
+        "disk_gb": 500
+    }
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    database = moltenirond.DataBase(conf, moltenirond.TYPE_SQLITE_MEMORY)
+
+    # Nothing has changed yet, so watch waits for the whole timeout
+    start = time.time()
+    ret = database.watch(0, 0.5)
+    print(ret)
+    # Seqs carry the epoch of the database
+    epoch = ret['seq'].split("-")[0]
+    assert len(epoch) == 8
+
+    def seq(number):
+        """Return seq number in this database"""
+        return "%s-%d" % (epoch, number, )
+
+    assert ret == {'status': 200,
+                   'seq': seq(0),
+                   'reset': False,
+                   'changes': []}
+    assert time.time() - start >= 0.5
+
+    ret = database.addBMNode(request1, node1)
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.addBMNode(request2, node2)
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.watch(0, 10)
+    print(ret)
+    assert ret['status'] == 200
+    assert ret['seq'] == seq(2)
+    assert [(change['seq'], change['node_id'], change['kind'])
+            for change in ret['changes']] == [(1, 1, "added"),
+                                              (2, 2, "added")]
+
+    ret = database.allocateBM("hamzy", 1)
+    print(ret)
+    assert ret['status'] == 200
+
+    # Only the changes after seq are returned, without waiting
+    start = time.time()
+    ret = database.watch(seq(2), 10)
+    print(ret)
+    assert time.time() - start < 5
+    assert ret['seq'] == seq(3)
+    assert len(ret['changes']) == 1
+    change = ret['changes'][0]
+    assert change['node_id'] == 1
+    assert change['kind'] == "allocated"
+    assert change['status'] == "dirty"
+    assert change['provisioned'] == "hamzy"
+
+    ret = database.set_field(2, "cpus", 16, "int")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.deallocateOwner("hamzy")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.removeBMNode(2, False)
+    print(ret)
+    assert ret == {'status': 200}
+
+    ret = database.watch(seq(3), 10)
+    print(ret)
+    assert [(change['node_id'], change['kind'], change['status'])
+            for change in ret['changes']] == [(2, "updated", "ready"),
+                                              (1, "released", "ready"),
+                                              (2, "removed", "ready")]
+    assert ret['seq'] == seq(6)
+
+    # A plain seq, from an older server, past the newest change means the
+    # database was deleted
+    ret = database.watch(100, 10)
+    print(ret)
+    assert ret['reset'] is True
+    assert ret['seq'] == seq(6)
+    assert len(ret['changes']) == 6
+
+    # Once the changes are purged, new ones still come after them
+    with database.engine.begin() as connection:
+        connection.execute("DELETE FROM Changes")
+    ret = database.set_field(1, "cpus", 16, "int")
+    print(ret)
+    assert ret == {'status': 200}
+    ret = database.watch(seq(6), 10)
+    print(ret)
+    assert ret['reset'] is False
+    assert [(change['seq'], change['node_id'], change['kind'])
+            for change in ret['changes']] == [(7, 1, "updated")]
+
+    # A seq from before the database was deleted starts again from the
+    # first change, although the new seqs have caught up with it
+    ret = database.delete_db()
+    print(ret)
+    assert ret == {'status': 200}
+    for number in range(3):
+        ret = database.addBMNode(dict(request1,
+                                      name="test%d" % (number, ),
+                                      ipmi_ip="10.1.2.%d" % (number, )),
+                                 node1)
+        print(ret)
+        assert ret == {'status': 200}
+
+    start = time.time()
+    ret = database.watch(seq(2), 10)
+    print(ret)
+    assert time.time() - start < 5
+    assert ret['reset'] is True
+    assert ret['seq'].endswith("-3")
+    assert ret['seq'] != seq(3)
+    assert [(change['seq'], change['kind'])
+            for change in ret['changes']] == [(1, "added"),
+                                              (2, "added"),
+                                              (3, "added")]
+
+    # And a seq past the new ones does not wait for them to catch up
+    start = time.time()
+    ret = database.watch(seq(7), 10)
+    print(ret)
+    assert time.time() - start < 5
+    assert ret['reset'] is True
+    assert len(ret['changes']) == 3
+
+    database.close()
+    del database
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Tests encoding requests and responses as JSON or MessagePack.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+from datetime import datetime, timezone
+import http.client
+import json
+import sys
+import threading
+
+from molteniron import molteniron
+from molteniron import moltenirond
+
+
+def serve():
+    """Start a server in this process and return it.
+
+    It has no database configured, so every request which gets as far as
+    the database fails with 400, in the format negotiated for it.
+    """
+    handler_class = moltenirond.MakeMoltenIronHandlerWithConf({})
+    server = moltenirond.ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def exchange(server, method, path, body=None, headers=None):
+    """Send one request to server and return the response's (status,
+    Content-Type, body bytes)"""
+    connection = http.client.HTTPConnection("127.0.0.1",
+                                            server.server_address[1],
+                                            timeout=10)
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+
+    return (response.status, response.getheader('Content-Type'), data)
+
+
+if __name__ == "__main__":
+
+    request = molteniron.make_request('allocate',
+                                      {'owner_name': "hamzy",
+                                       'number_of_nodes': 1,
+                                       'node_pool': "default"})
+    response = {'status': 200,
+                'nodes': {'node_1': {'id': 1,
+                                     'name': "pkvmci816",
+                                     'timestamp': datetime(2016, 4, 12,
+                                                           19, 37, 12)}}}
+
+    # JSON is the default, with time stamps as ISO 8601 strings
+    body = molteniron.encode_request(request)
+    ret = moltenirond.decode_request(body.encode("utf-8"),
+                                     moltenirond.media_type(None))
+    assert ret == request
+
+    (status_code, data) = moltenirond.encode_response(response)
+    assert status_code == 200
+    ret = molteniron.decode_response(data, "application/json")
+    print(ret)
+    assert ret['nodes']['node_1']['timestamp'] == "2016-04-12T19:37:12"
+
+    assert (moltenirond.media_type("application/x-msgpack; charset=binary")
+            == moltenirond.MSGPACK)
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    server = serve()
+    body = molteniron.encode_request(request)
+
+    # Without an Accept header, responses are JSON
+    (status, content_type, data) = exchange(
+        server, "POST", "/", body, {'Content-Type': "application/json"})
+    print(status, content_type, data)
+    assert status == 400
+    assert content_type == "application/json"
+    assert json.loads(data.decode("utf-8"))['status'] == 400
+
+    # Nor is JSON turned into anything else when it is asked for
+    (status, content_type, data) = exchange(
+        server, "POST", "/", body, {'Content-Type': "application/json",
+                                    'Accept': "application/json"})
+    assert status == 400
+    assert content_type == "application/json"
+
+    # A server without msgpack answers JSON whatever is accepted, and turns
+    # MessagePack requests away with 415 before running them
+    msgpack = moltenirond.msgpack
+    moltenirond.msgpack = None
+    try:
+        (status, content_type, data) = exchange(
+            server, "POST", "/", body, {'Content-Type': "application/json",
+                                        'Accept': "application/msgpack"})
+        print(status, content_type, data)
+        assert status == 400
+        assert content_type == "application/json"
+
+        (status, content_type, data) = exchange(
+            server, "POST", "/", b"\x81", {'Content-Type':
+                                           "application/msgpack"})
+        print(status, content_type, data)
+        assert status == 415
+        assert content_type == "application/json"
+        assert "application/msgpack" in json.loads(
+            data.decode("utf-8"))['message']
+    finally:
+        moltenirond.msgpack = msgpack
+
+    if moltenirond.msgpack is None:
+        server.shutdown()
+        server.server_close()
+        print("msgpack is not installed, skipping the MessagePack tests")
+        sys.exit(0)
+
+    body = molteniron.encode_request(request, "msgpack")
+    ret = moltenirond.decode_request(body, moltenirond.MSGPACK)
+    assert ret == request
+
+    # Time stamps are native, in UTC
+    (status_code, data) = moltenirond.encode_response(response,
+                                                      moltenirond.MSGPACK)
+    assert status_code == 200
+    ret = molteniron.decode_response(data, "application/msgpack")
+    print(ret)
+    assert ret['nodes']['node_1']['name'] == "pkvmci816"
+    assert (ret['nodes']['node_1']['timestamp']
+            == datetime(2016, 4, 12, 19, 37, 12, tzinfo=timezone.utc))
+
+    try:
+        moltenirond.encode_response({'status': 200, 'result': object()},
+                                    moltenirond.MSGPACK)
+        assert False
+    except TypeError as e:
+        print(e)
+
+    # 8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----8<-----
+    # Responses are MessagePack when it is accepted, whatever the request is
+    body = molteniron.encode_request(request)
+    (status, content_type, data) = exchange(
+        server, "POST", "/", body, {'Content-Type': "application/json",
+                                    'Accept': "application/json;q=0.5,"
+                                              " application/x-msgpack"})
+    print(status, content_type, data)
+    assert status == 400
+    assert content_type == "application/msgpack"
+    ret = molteniron.decode_response(data, content_type)
+    assert ret == {'status': 400, 'message': "'sqlUser'"}
+
+    # And MessagePack requests are answered with JSON unless it is accepted
+    body = molteniron.encode_request(request, "msgpack")
+    (status, content_type, data) = exchange(
+        server, "POST", "/", body, {'Content-Type': "application/msgpack"})
+    print(status, content_type, data)
+    assert status == 400
+    assert content_type == "application/json"
+
+    # A body which is not MessagePack is rejected in the accepted format
+    (status, content_type, data) = exchange(
+        server, "POST", "/", b"\xc1", {'Content-Type': "application/msgpack",
+                                       'Accept': "application/msgpack"})
+    print(status, content_type, data)
+    assert status == 400
+    assert content_type == "application/msgpack"
+
+    # GET negotiates the same way
+    (status, content_type, data) = exchange(
+        server, "GET", "/unknown", None, {'Accept': "application/msgpack"})
+    print(status, content_type, data)
+    assert status == 404
+    assert content_type == "application/msgpack"
+    assert molteniron.decode_response(data, content_type)['status'] == 404
+
+    # A client which prefers MessagePack falls back to JSON for a server
+    # which turns it away
+    conf = {'serverIP': "127.0.0.1", 'mi_port': server.server_address[1]}
+    with molteniron.Client(conf, wire_format="msgpack") as client:
+        moltenirond.msgpack = None
+        try:
+            ret = client.release("hamzy")
+        finally:
+            moltenirond.msgpack = msgpack
+        print(ret)
+        assert ret['status'] == 400
+        assert client.wire_format == "json"
+
+    server.shutdown()
+    server.server_close()
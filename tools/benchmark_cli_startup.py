@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+Measures how long the molteniron command line client takes to start.
+
+The gate runs the client many times per job, so its start up time is
+mostly interpreter, import and configuration loading time.  This reports
+the median wall clock time of a release command, less the time of an empty
+interpreter, both with the parsed configuration cached and without.  The
+command loads the configuration and is answered by a stub server in this
+process, so no MoltenIron server is needed.  The slowest imports are listed
+too, and it fails if the cached start up time exceeds --max-ms.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run the client from the source tree, as its own script would be run
+RUN_CLI = ("import sys;"
+           " sys.argv = ['molteniron'] + sys.argv[1:];"
+           " path = %r;"
+           " exec(compile(open(path).read(), path, 'exec'),"
+           " {'__name__': '__main__'})"
+           % (os.path.join(TOP, "molteniron", "molteniron"), ))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every request with success at once"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        """HTTP POST support"""
+        self.rfile.read(int(self.headers['Content-Length']))
+        data = json.dumps({'status': 200}).encode("utf-8")
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def write_conf(conf_dir, port):
+    """Write a conf.yaml to conf_dir which points at the stub server"""
+    with open(os.path.join(TOP, "molteniron", "conf.yaml"), "r") as fobj:
+        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
+
+    conf['serverIP'] = "127.0.0.1"
+    conf['mi_port'] = port
+    conf.pop('socket_path', None)
+
+    with open(os.path.join(conf_dir, "conf.yaml"), "w") as fobj:
+        yaml.dump(conf, fobj)
+
+
+def run(argv, env):
+    """Return how long running argv took in seconds"""
+    start = time.perf_counter()
+    subprocess.run(argv,
+                   env=env,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   check=False)
+    return time.perf_counter() - start
+
+
+def import_times(argv, env):
+    """Return the cumulative import times, in ms, of top level imports"""
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + argv[1:],
+                          env=env,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True,
+                          check=False)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        (_, cumulative, name) = line[len("import time:"):].split("|")
+        # Top level imports are not indented
+        if not cumulative.strip().isdigit() or name.startswith("  "):
+            continue
+        times.append((int(cumulative) / 1000.0, name.strip()))
+
+    return sorted(times, reverse=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("-n",
+                        "--runs",
+                        type=int,
+                        default=20,
+                        help="How many times to start the client")
+    parser.add_argument("--max-ms",
+                        type=float,
+                        default=None,
+                        help="Fail if the start up time is above this")
+
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    temp_dir = tempfile.mkdtemp(prefix="molteniron-bench-")
+    write_conf(temp_dir, server.server_address[1])
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([TOP] + sys.path[1:])
+    env["XDG_CACHE_HOME"] = os.path.join(temp_dir, "cache")
+
+    # Every run of uncached finds an empty cache directory
+    uncached_env = dict(env)
+    uncached_env["XDG_CACHE_HOME"] = os.path.join(temp_dir, "empty")
+
+    cli = [sys.executable, "-c", RUN_CLI,
+           "--conf-dir", temp_dir,
+           "release", "bench"]
+    empty = [sys.executable, "-c", "pass"]
+
+    def uncached():
+        """Run cli without the parsed configuration cached"""
+        shutil.rmtree(uncached_env["XDG_CACHE_HOME"], ignore_errors=True)
+        return run(cli, uncached_env)
+
+    try:
+        # Warm up the page cache, compile the byte code and cache the
+        # parsed configuration
+        run(cli, env)
+
+        baseline = statistics.median([run(empty, env)
+                                      for _ in range(args.runs)])
+        total = statistics.median([run(cli, env)
+                                   for _ in range(args.runs)])
+        total_uncached = statistics.median([uncached()
+                                            for _ in range(args.runs)])
+        times = import_times(cli, env)[:10]
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    startup = (total - baseline) * 1000.0
+    startup_uncached = (total_uncached - baseline) * 1000.0
+
+    print("interpreter:          %7.1f ms" % (baseline * 1000.0, ))
+    print("molteniron:           %7.1f ms" % (total * 1000.0, ))
+    print("start up:             %7.1f ms" % (startup, ))
+    print("start up, not cached: %7.1f ms" % (startup_uncached, ))
+    print("")
+    print("Slowest imports:")
+    for (ms, name) in times:
+        print("  %7.1f ms %s" % (ms, name, ))
+
+    if args.max_ms is not None and startup > args.max_ms:
+        print("Error: start up took %.1f ms, more than %.1f ms"
+              % (startup, args.max_ms, ), file=sys.stderr)
+        sys.exit(1)
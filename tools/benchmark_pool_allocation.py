@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Measures whether allocations from one node pool wait on another pool.
+
+This first allocates and releases nodes of the quiet pool, alone, and then
+again while --threads clients allocate and release nodes of the busy pool
+as fast as they can.  It reports the latencies of the quiet pool in both
+runs, which should be about the same, and fails if the median latency grew
+by more than --max-ratio times.
+
+It adds --nodes nodes to each pool, so run it against a test server.
+"""
+
+# Copyright (c) 2016 IBM Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable-msg=C0103
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+
+from molteniron import config
+from molteniron import molteniron
+
+
+def add_nodes(client, node_pool, count):
+    """Add count nodes to node_pool"""
+    blob = json.dumps({"ipmi_user": "user",
+                       "ipmi_password": "password",
+                       "port_hwaddr": "de:ad:be:ef:00:01",
+                       "cpu_arch": node_pool,
+                       "cpus": 8,
+                       "ram_mb": 2048,
+                       "disk_gb": 32})
+    for index in range(count):
+        response = client.add_json_blob("bench-%s-%d" % (node_pool, index, ),
+                                        "10.0.%d.%d" % (index // 250,
+                                                        index % 250 + 1, ),
+                                        "",
+                                        blob,
+                                        node_pool)
+        if response['status'] != 200:
+            raise RuntimeError("add_json_blob failed: %s" % (response, ))
+
+
+def cycle(client, owner, node_pool):
+    """Allocate and release a node, returning how long allocating took"""
+    start = time.perf_counter()
+    response = client.allocate(owner, 1, node_pool)
+    elapsed = time.perf_counter() - start
+
+    if response['status'] != 200:
+        raise RuntimeError("allocate failed: %s" % (response, ))
+    client.release(owner)
+
+    return elapsed
+
+
+def measure(client, node_pool, seconds):
+    """Return the latencies of allocating from node_pool for seconds"""
+    latencies = []
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        latencies.append(cycle(client, "bench-quiet", node_pool))
+
+    return latencies
+
+
+def report(name, latencies):
+    """Print the percentiles of latencies"""
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print("%-12s %6d allocations  p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms"
+          % (name,
+             len(latencies),
+             statistics.median(latencies) * 1000.0,
+             p95 * 1000.0,
+             latencies[-1] * 1000.0, ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("-c",
+                        "--conf-dir",
+                        action="store",
+                        type=str,
+                        dest="conf_dir",
+                        help="The directory where configuration is stored")
+    parser.add_argument("--busy-pool",
+                        default="bench-x86",
+                        help="The node pool which the threads allocate from")
+    parser.add_argument("--quiet-pool",
+                        default="bench-ppc64el",
+                        help="The node pool whose latency is measured")
+    parser.add_argument("--nodes",
+                        type=int,
+                        default=None,
+                        help="How many nodes to add to each pool, defaults"
+                             " to one more than --threads")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=8,
+                        help="How many clients allocate from the busy pool")
+    parser.add_argument("--seconds",
+                        type=float,
+                        default=5,
+                        help="How long to measure each run for")
+    parser.add_argument("--max-ratio",
+                        type=float,
+                        default=None,
+                        help="Fail if the busy pool made the quiet pool's"
+                             " median latency this many times slower")
+
+    args = parser.parse_args()
+
+    conf = config.load_conf(config.conf_path(args.conf_dir))
+    client = molteniron.Client(conf, max_connections=args.threads + 1)
+
+    nodes = args.nodes
+    if nodes is None:
+        nodes = args.threads + 1
+    add_nodes(client, args.busy_pool, nodes)
+    add_nodes(client, args.quiet_pool, nodes)
+
+    alone = measure(client, args.quiet_pool, args.seconds)
+
+    stop = threading.Event()
+    busy = []
+    errors = []
+
+    def hammer(index):
+        """Allocate from the busy pool until told to stop"""
+        owner = "bench-busy-%d" % (index, )
+        try:
+            while not stop.is_set():
+                busy.append(cycle(client, owner, args.busy_pool))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=hammer, args=(index, ))
+               for index in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    try:
+        contended = measure(client, args.quiet_pool, args.seconds)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        print("Error: %s" % (errors[0], ), file=sys.stderr)
+        sys.exit(1)
+
+    report("alone:", alone)
+    report("contended:", contended)
+    report("busy pool:", busy)
+
+    ratio = statistics.median(contended) / statistics.median(alone)
+    print("")
+    print("The busy pool made the quiet pool %.2f times slower" % (ratio, ))
+
+    if args.max_ratio is not None and ratio > args.max_ratio:
+        print("Error: more than %.2f times slower" % (args.max_ratio, ),
+              file=sys.stderr)
+        sys.exit(1)
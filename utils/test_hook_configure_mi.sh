@@ -33,98 +33,23 @@ then
   exit 1
 fi
 
-# Is the command-line JSON processor installed?
-hash jq || sudo apt-get install -y jq
-
 # Turn off Bash debugging temporarily to stop password being shown in log files
 set +x
 
 # allocate a BM node to a dsvm guest named dsvm_uuid, then amend the localrc
-# and hardware_info files.
-JSON_RSP=$(molteniron allocate $dsvm_uuid 1)
-
-if [ $? -gt 0 ]
-then
-  # Save the response for local debugging
-  echo "${JSON_RSP}" > /tmp/json.rsp
-
-  errcho "Error: allocate $dsvm_uuid 1"
-
-  MESSAGE=$(echo "${JSON_RSP}" | jq .message)
-
-  # Is there a message response?
-  # NOTE: jq not finding a message key returns null
-  if [ $? -eq 0 -a "${MESSAGE}" != "null" ]
-  then
-      errcho "Error: ${MESSAGE}"
-  fi
-
-  exit 1
-fi
+# and hardware_info files.  The server renders both files' contents, so this
+# is a single request made by a single process.
+test_hook_mi_ipmiblob.py \
+  --hardware-info=/opt/stack/new/devstack/files/hardware_info \
+  --localrc=/opt/stack/new/devstack/localrc \
+  ${dsvm_uuid} \
+  1
+RC=$?
 
-# Convert from a JSON string into a Bash array
-declare -A NODE
-while IFS="=" read -r key value
-do
-  NODE[$key]="$value"
-done < <(
-  echo ${JSON_RSP} | jq --raw-output '.nodes[]|to_entries|map("\(.key)=\(.value|tostring)")|.[]'
-  RC=$?
-  if [ ${RC} -gt 0 ]
-  then
-    echo "error=${RC}"
-  fi
-)
+set -x
 
-if [ -n "${NODE[error]}" ]
-then
-  errcho "Error: jq failed to parse response"
-  errcho "jq .nodes:"
-  errcho ${JSON_RSP} | jq '.nodes[]'
-  errcho "jq .nodes|to_entries|map:"
-  errcho ${JSON_RSP} | jq --raw-output '.nodes[]|to_entries|map("\(.key)=\(.value|tostring)")|.[]'
-  exit 2
-elif [  -z "${NODE[ipmi_ip]}" \
-     -o -z "${NODE[port_hwaddr]}" \
-     -o -z "${NODE[ipmi_user]}" \
-     -o -z "${NODE[ipmi_password]}" ]
+if [ ${RC} -gt 0 ]
 then
-  echo "ERROR: One of NODE's ipmi_ip, port_hwaddr, ipmi_user, or ipmi_password is empty!"
-  if [ -n "${NODE[ipmi_password]}" ]
-  then
-      SAFE_PASSWORD="*hidden*"
-  else
-      SAFE_PASSWORD=""
-  fi
-  echo "NODE[ipmi_ip]       = ${NODE[ipmi_ip]}"
-  echo "NODE[port_hwaddr]   = ${NODE[port_hwaddr]}"
-  echo "NODE[ipmi_user]     = ${NODE[ipmi_user]}"
-  echo "NODE[ipmi_password] = ${SAFE_PASSWORD}"
-  echo "jq command returns:"
-  echo ${JSON_RSP} | jq --raw-output '.nodes[]|to_entries|map("\(.key)=\(.value|tostring)")|.[]'
-  exit 3
+  errcho "Error: allocate ${dsvm_uuid} 1"
+  exit 1
 fi
-
-# Set IPMI info file
-printf "${NODE[ipmi_ip]} ${NODE[port_hwaddr]} ${NODE[ipmi_user]} ${NODE[ipmi_password]}\\n" > "/opt/stack/new/devstack/files/hardware_info"
-
-set -x
-
-# Add the hardware properties to the localrc file
-printf "IRONIC_HW_ARCH=${NODE[cpu_arch]}\\nIRONIC_HW_NODE_CPU=${NODE[cpus]}\\nIRONIC_HW_NODE_RAM=${NODE[ram_mb]}\\nIRONIC_HW_NODE_DISK=${NODE[disk_gb]}\\n" >> "/opt/stack/new/devstack/localrc"
-
-# Add the allocation pools to the localrc
-IFS=',' read -r -a ALLOCATION_POOL <<< ${NODE[allocation_pool]}
-
-POOL=''
-for IP in ${ALLOCATION_POOL[@]}
-do
-  echo "IP=${IP}"
-  if [ -n "${POOL}" ]
-  then
-    POOL+=" --allocation-pool "
-  fi
-  POOL+="start=${IP},end=${IP}"
-done
-# append ip pools to the end of our localrc
-printf "ALLOCATION_POOL=\"${POOL}\"\n" >>  "/opt/stack/new/devstack/localrc"
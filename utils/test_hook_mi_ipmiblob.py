@@ -24,13 +24,10 @@ a MoltenIron server.
 # pylint: disable=redefined-outer-name
 
 import argparse
-import json
 import os
 import sys
 
-from pkg_resources import resource_filename
-import yaml
-
+from molteniron import config
 from molteniron import molteniron
 
 
@@ -78,94 +75,65 @@ if __name__ == "__main__":
             print(msg, file=sys.stderr)
             sys.exit(1)
 
-        YAML_CONF = os.path.realpath("%s/conf.yaml" % (args.conf_dir, ))
-    else:
-        YAML_CONF = resource_filename("molteniron", "conf.yaml")
-
-    with open(YAML_CONF, "r") as fobj:
-        conf = yaml.load(fobj, Loader=yaml.SafeLoader)
-
-        mi.setup_conf(conf)
-        mi.setup_parser(parser)
-
-        # For example:
-        # args_map = {"output": "json",
-        #             "type": "human",
-        #             "func": getattr(mi, "status"),
-        #             "conf_dir": "testenv/etc/molteniron/"}
-        args_map = {"output": "json",
-                    "owner_name": args.owner_name,
-                    "number_of_nodes": args.number_of_nodes,
-                    "node_pool": args.node_pool,
-                    "func": getattr(mi, "allocate"),
-                    "conf_dir": "testenv/etc/molteniron/"}
-
-        # Call the function
-        mi.call_function(args_map)
-
-        # Get the result
-        response_map = mi.get_response_map()
-
-        try:
-            rc = response_map["status"]
-        except KeyError:
-            msg = ("Error: Server returned: %s and we expected a status "
-                   + "somewhere") % (response_map, )
-            print(msg, file=sys.stderr)
-            exit(444)
-
-        if rc != 200:
-            msg = "Error: Status was not 200 %s" % (response_map["message"], )
-            print(msg, file=sys.stderr)
-            exit(rc)
-
-        assert response_map["status"] == 200
-        assert "nodes" in response_map
-
-        nodes = response_map["nodes"]
-
-        assert len(nodes) == 1
-
-        # There can only be one!
-        node_key = list(nodes.keys())[0]
-
-        # {u'status': u'dirty',
-        #  u'provisioned': u'bb6141a2-3585-496a-bc02-1ef89c81e8fb',
-        #  u'name': u'test2',
-        #  u'timestamp': u'2016-11-30T15:50:03',
-        #  u'ipmi_ip': u'10.1.2.2',
-        #  u'blob': u'{"port_hwaddr": "\\"de:ad:be:ef:00:01\\"",
-        #              "cpu_arch": "ppc64el",
-        #              "ram_mb": "2048",
-        #              "disk_gb": "32",
-        #              "cpus": "8",
-        #              "ipmi_user": "\\"user\\"",
-        #              "ipmi_password": "\\"password\\""}',
-        #  u'allocation_pool': u'10.1.2.5,10.1.2.6',
-        #  u'id': 2}
-        node = nodes[node_key]
-
-        assert "blob" in node
-
-        json_blob = node["blob"]
-        blob = json.loads(json_blob)
-
-        with open(args.hardware_info, "w") as hi_obj:
-            # Write one line
-            hi_obj.write(("%(ipmi_ip)s" % node)
-                         + (" %(port_hwaddr)s"
-                            + " %(ipmi_user)s"
-                            + " %(ipmi_password)s\n") % blob)
-
-        pool = node["allocation_pool"].split(",")
-
-        pairs = ["start=%s,end=%s" % (x, x) for x in pool]
-        allocation_pool = " --allocation-pool ".join(pairs)
-
-        with open(args.localrc, "a") as l_obj:
-            # Write multiple lines
-            l_obj.write(("IRONIC_HW_ARCH=%(cpu_arch)s\n"
-                         + "IRONIC_HW_NODE_CPU=%(cpus)s\n"
-                         + "IRONIC_HW_NODE_RAM=%(ram_mb)s\n"
-                         + "IRONIC_HW_NODE_DISK=%(disk_gb)s\n") % blob
-                        + "ALLOCATION_POOL=\"%s\"\n" % (allocation_pool, ))
+    YAML_CONF = config.conf_path(args.conf_dir)
+
+    conf = config.load_conf(YAML_CONF)
+
+    mi.setup_conf(conf)
+    mi.setup_parser(parser)
+
+    # For example:
+    # args_map = {"output": "json",
+    #             "type": "human",
+    #             "func": getattr(mi, "status"),
+    #             "conf_dir": "testenv/etc/molteniron/"}
+    args_map = {"output": "json",
+                "owner_name": args.owner_name,
+                "number_of_nodes": args.number_of_nodes,
+                "node_pool": args.node_pool,
+                "render": True,
+                "func": getattr(mi, "allocate_manifest"),
+                "conf_dir": "testenv/etc/molteniron/"}
+
+    # Call the function
+    mi.call_function(args_map)
+
+    # Get the result
+    response_map = mi.get_response_map()
+
+    try:
+        rc = response_map["status"]
+    except KeyError:
+        msg = ("Error: Server returned: %s and we expected a status "
+               + "somewhere") % (response_map, )
+        print(msg, file=sys.stderr)
+        exit(444)
+
+    if rc != 200:
+        msg = "Error: Status was not 200 %s" % (response_map["message"], )
+        print(msg, file=sys.stderr)
+        exit(rc)
+
+    assert response_map["status"] == 200
+    assert "nodes" in response_map
+
+    nodes = response_map["nodes"]
+
+    assert len(nodes) == args.number_of_nodes
+
+    # {u'status': 200,
+    #  u'nodes': {u'node_1': {...}},
+    #  u'hardware_info': u'10.1.2.1 de:ad:be:ef:00:01 user password\n',
+    #  u'localrc': u'IRONIC_HW_ARCH=ppc64el\n'
+    #              u'IRONIC_HW_NODE_CPU=8\n'
+    #              u'IRONIC_HW_NODE_RAM=2048\n'
+    #              u'IRONIC_HW_NODE_DISK=32\n'
+    #              u'ALLOCATION_POOL="start=10.1.2.3,end=10.1.2.3 '
+    #              u'--allocation-pool start=10.1.2.4,end=10.1.2.4"\n'}
+    with open(args.hardware_info, "w") as hi_obj:
+        # Write one line per node
+        hi_obj.write(response_map["hardware_info"])
+
+    with open(args.localrc, "a") as l_obj:
+        # Write multiple lines
+        l_obj.write(response_map["localrc"])